@@ -1,108 +1,115 @@
-
 # ai_config.py
 # -----------------------------------------------------------------------------
 # MULTI-MODEL AI ARCHITECTURE - OpenRouter Configuration
 # Routes requests to specialized models for optimal performance
-# Updated to use Multi-Key Rotation Client (Async)
+# All calls go through the shared provider layer (ai_provider.py)
 # -----------------------------------------------------------------------------
 
-import json
 import base64
-import asyncio
-from typing import Optional, Dict, Any, List
-# Import the singleton client from our new module
-from openrouter_client import client
-
-# =============================================================================
-# MODELS CONFIGURATION
-# =============================================================================
-
-# We keep the model IDs that work well for this project, 
-# but route them through the multi-key client.
-MODELS = {
-    # Vision/OCR Model - Best for reading invoices, notices, documents
-    "ocr": "qwen/qwen2.5-vl-7b-instruct:free",
-    
-    # Logic/Reasoning Model - Best for tax rules, legal analysis, complex calculations
-    "logic": "nousresearch/hermes-3-llama-3.1-405b:free",
-    
-    # Chat/UI Model - Best for natural language, user interactions, summaries
-    "chat": "meta-llama/llama-3.1-405b-instruct:free",
-    
-    # Fast Chat Model - ULTRA-FAST for simple queries (2-5 second responses)
-    "chat_fast": "meta-llama/llama-3.1-8b-instruct:free"
-}
-
-MODEL_DESCRIPTIONS = {
-    "ocr": "Qwen2.5-VL 7B (Vision/OCR)",
-    "logic": "Hermes 3 405B (Logic/Reasoning)",
-    "chat": "Llama 3.1 405B (Chat/UI)",
-    "chat_fast": "Llama 3.1 8B (Fast Chat)"
-}
+from typing import Optional, Dict, Any, List, AsyncIterator
+# Models, fallback chains, backend, lanes and stats all live in the provider
+from ai_provider import provider, MODELS, MODEL_DESCRIPTIONS, FALLBACK_MODELS, clean_json_response
 
 # =============================================================================
 # CORE API FUNCTIONS (ASYNC WRAPPERS)
 # =============================================================================
 
-# Note: The original implementation was synchronous (using requests).
-# We are moving to async (using aiohttp in openrouter_client).
-# Steps to migrate:
-# 1. Update these wrapper functions to be `async def`.
-# 2. Update `main.py` to `await` these calls.
-
 async def call_openrouter(
     model_type: str, 
     messages: List[Dict[str, Any]], 
     max_tokens: int = 4096,
     temperature: float = None,
-    response_format: str = None
+    response_format: str = None,
+    priority: Optional[str] = None,
+    model_id: Optional[str] = None
 ) -> str:
     """
-    Universal OpenRouter API caller using the multi-key client.
+    Universal model caller (via the provider layer).
+    Runs in the caller's priority lane (interactive / online / bulk - see
+    priority_lanes.py) unless `priority` names one explicitly.
+    `model_id` overrides MODELS[model_type].
     """
     if model_type not in MODELS:
         raise ValueError(f"Unknown model type: {model_type}")
     
     if temperature is None:
         temperature = 0.3 if model_type == "logic" else 0.7
-        
-    model_id = MODELS[model_type]
-    json_mode = (response_format == "json_object")
     
-    print(f"🤖 Calling {MODEL_DESCRIPTIONS[model_type]} via Multi-Key Client...")
+    model_id = model_id or MODELS[model_type]
+    label = MODEL_DESCRIPTIONS.get(model_type, model_type) if model_id == MODELS[model_type] else model_id
+    print(f"🤖 Calling {label} via AI provider...")
     
     try:
-        response = await client.completion(
-            messages=messages,
-            model_id=model_id, # Override client default routing
-            temperature=temperature,
+        response = await provider.complete(
+            model_type,
+            messages,
             max_tokens=max_tokens,
-            json_mode=json_mode
+            temperature=temperature,
+            json_mode=(response_format == "json_object"),
+            priority=priority,
+            model_id=model_id
         )
-        
-        # If response is dict (JSON mode parsed), convert back to string for compatibility
-        # with expected return type of str, OR keep as dict if caller expects it?
-        # Original `call_openrouter` returned `content` string.
-        # `client.completion` returns dict if json_mode=True, else string.
-        # We should probably standardize to string here to match legacy expectation,
-        # unless we update callers.
-        # But wait, `call_openrouter` docstring says "Returns String response".
-        
-        if isinstance(response, (dict, list)):
-            return json.dumps(response)
-            
-        print(f"✅ {MODEL_DESCRIPTIONS[model_type]} responded successfully")
+        print(f"✅ {label} responded successfully")
         return response
         
     except Exception as e:
         print(f"❌ API Error: {e}")
         raise Exception(f"OpenRouter API error: {str(e)}")
 
+
+def stream_openrouter(
+    model_type: str,
+    messages: List[Dict[str, Any]],
+    max_tokens: int = 4096,
+    temperature: float = None,
+    priority: Optional[str] = None
+) -> AsyncIterator[str]:
+    """
+    Streaming variant of call_openrouter: yields text deltas as they arrive.
+    Holds its lane slot until the stream is finished (or the consumer stops).
+    """
+    if model_type not in MODELS:
+        raise ValueError(f"Unknown model type: {model_type}")
+    
+    if temperature is None:
+        temperature = 0.3 if model_type == "logic" else 0.7
+    
+    print(f"🤖 Streaming {MODEL_DESCRIPTIONS.get(model_type, model_type)} via AI provider...")
+    return provider.stream(model_type, messages, max_tokens=max_tokens, temperature=temperature, priority=priority)
+
+
+async def call_with_fallback(
+    model_type: str,
+    messages: List[Dict[str, Any]],
+    max_tokens: int = 4096,
+    temperature: float = None,
+    start_at: int = 0,
+    response_format: Optional[Dict[str, Any]] = None
+) -> str:
+    """
+    Hedged call over MODELS[model_type] + FALLBACK_MODELS[model_type]
+    (see AIProvider.complete_with_fallback).
+    """
+    if temperature is None:
+        temperature = 0.3 if model_type == "logic" else 0.7
+    print(f"🤖 Calling {MODEL_DESCRIPTIONS.get(model_type, model_type)} (+{len(FALLBACK_MODELS.get(model_type, []))} fallbacks) via AI provider...")
+    try:
+        return await provider.complete_with_fallback(
+            model_type, messages, max_tokens=max_tokens, temperature=temperature, start_at=start_at,
+            response_format=response_format
+        )
+    except Exception as e:
+        print(f"❌ API Error: {e}")
+        raise Exception(f"OpenRouter API error: {str(e)}")
+
+
 async def call_vision_model(
     image_base64: str, 
     prompt: str,
     mime_type: str = "image/jpeg",
-    max_tokens: int = 2048
+    max_tokens: int = 2048,
+    start_at: int = 0,
+    response_format: Optional[Dict[str, Any]] = None
 ) -> str:
     messages = [{
         "role": "user",
@@ -116,12 +123,13 @@ async def call_vision_model(
             }
         ]
     }]
-    return await call_openrouter("ocr", messages, max_tokens=max_tokens, temperature=0.2)
+    return await call_with_fallback("ocr", messages, max_tokens=max_tokens, temperature=0.2, start_at=start_at,
+                                    response_format=response_format)
 
 
 async def call_logic_model(prompt: str, max_tokens: int = 2048) -> str:
     messages = [{"role": "user", "content": prompt}]
-    return await call_openrouter("logic", messages, max_tokens=max_tokens, temperature=0.3)
+    return await call_with_fallback("logic", messages, max_tokens=max_tokens, temperature=0.3)
 
 
 async def call_chat_model(prompt: str, max_tokens: int = 2048, system_prompt: str = None) -> str:
@@ -139,17 +147,22 @@ async def call_fast_chat_model(prompt: str, max_tokens: int = 512, system_prompt
     messages.append({"role": "user", "content": prompt})
     return await call_openrouter("chat_fast", messages, max_tokens=max_tokens, temperature=0.7)
 
+
+def stream_chat_model(prompt: str, fast: bool = False, max_tokens: int = None,
+                      system_prompt: str = None, priority: str = None) -> AsyncIterator[str]:
+    """Token stream from the chat model (or the fast 8B model with fast=True)."""
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": prompt})
+    if max_tokens is None:
+        max_tokens = 512 if fast else 2048
+    return stream_openrouter("chat_fast" if fast else "chat", messages, max_tokens=max_tokens,
+                             temperature=0.7, priority=priority)
+
 # =============================================================================
-# HELPER FUNCTIONS (UNCHANGED)
+# HELPER FUNCTIONS
 # =============================================================================
 
-def clean_json_response(text: str) -> str:
-    """Clean JSON from markdown code blocks."""
-    if not text: return "{}"
-    text = text.replace("```json", "").replace("```", "").strip()
-    import re
-    match = re.search(r"(\{.*\})", text, re.DOTALL)
-    return match.group(1) if match else text
-
 def encode_image_to_base64(file_bytes: bytes) -> str:
     return base64.b64encode(file_bytes).decode('utf-8')
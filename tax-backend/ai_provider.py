@@ -0,0 +1,350 @@
+# ai_provider.py
+# -----------------------------------------------------------------------------
+# AI PROVIDER LAYER - One road to every model
+# Uploads, the async pipeline, Jarvis and the legal tools all call models
+# through `provider`: one task → model map (the pipeline passes its own
+# async_ai.MODELS as model_id), one backend (pooled HTTP session + key
+# scheduler), one set of priority lanes, call stats and hedging. So a
+# single rate limiter sees all traffic and caches keyed on model ids agree.
+# Backends are pluggable:
+#   openrouter - OpenRouterClient (multi-key, default)
+#   openai     - any OpenAI-compatible endpoint via the openai SDK
+# ai_config.py and async_ai.py keep their call_* helpers as thin wrappers.
+# -----------------------------------------------------------------------------
+
+import os
+import re
+import json
+import time
+import asyncio
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from openrouter_client import OpenRouterClient, CallStats
+from priority_lanes import lanes, ai_lane, current_lane
+from hedging import hedger
+from usage_ledger import usage_ledger
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# Which backend carries the calls: "openrouter" or "openai"
+BACKEND = os.getenv("AI_BACKEND", "openrouter").lower()
+
+# For AI_BACKEND=openai (self-hosted vLLM, a paid gateway, ...)
+OPENAI_BASE_URL = os.getenv("AI_OPENAI_BASE_URL", "https://openrouter.ai/api/v1")
+OPENAI_API_KEY = os.getenv("AI_OPENAI_API_KEY", "")
+
+# Streams: deltas buffered between the model call and the consumer, and how long
+# the producer waits on a consumer that stopped reading before it gives up the
+# call (and its lane + key slots) instead of holding them for a stalled client
+STREAM_BUFFER = int(os.getenv("AI_STREAM_BUFFER", "256"))
+STREAM_STALL_SECONDS = float(os.getenv("AI_STREAM_STALL_SECONDS", "30"))
+
+# Task → model. Override any entry with AI_MODEL_<TASK>, e.g. AI_MODEL_OCR=...
+MODELS = {
+    # Vision/OCR Model - Best for reading invoices, notices, documents
+    "ocr": "qwen/qwen2.5-vl-7b-instruct:free",
+
+    # Logic/Reasoning Model - Best for tax rules, legal analysis, complex calculations
+    "logic": "nousresearch/hermes-3-llama-3.1-405b:free",
+
+    # Chat/UI Model - Best for natural language, user interactions, summaries
+    "chat": "meta-llama/llama-3.1-405b-instruct:free",
+
+    # Fast Chat Model - ULTRA-FAST for simple queries (2-5 second responses)
+    "chat_fast": "meta-llama/llama-3.1-8b-instruct:free",
+
+    # General-purpose tasks (get_ai_response)
+    "analyze": "meta-llama/llama-3.3-70b-instruct:free",  # Precise JSON, 128K ctx
+    "search": "google/gemma-3-27b-it:free",               # Fast parsing, 131K ctx
+    "report": "qwen/qwen3-coder:free",                    # 262K ctx, structured output
+    "fallback": "openrouter/free",                        # Auto-routes to best available
+}
+for _task in MODELS:
+    MODELS[_task] = os.getenv(f"AI_MODEL_{_task.upper()}", MODELS[_task])
+
+MODEL_DESCRIPTIONS = {
+    "ocr": "Qwen2.5-VL 7B (Vision/OCR)",
+    "logic": "Hermes 3 405B (Logic/Reasoning)",
+    "chat": "Llama 3.1 405B (Chat/UI)",
+    "chat_fast": "Llama 3.1 8B (Fast Chat)"
+}
+
+# Fallback chains - tried in order when the model before is slow (hedged at its
+# p90 latency) or fails. Override with e.g. AI_FALLBACK_OCR="model-a,model-b".
+FALLBACK_MODELS = {
+    "ocr": ["google/gemma-3-27b-it:free", "mistralai/mistral-small-3.1-24b-instruct:free"],
+    "logic": ["meta-llama/llama-3.3-70b-instruct:free"],
+}
+for _task in FALLBACK_MODELS:
+    _override = os.getenv(f"AI_FALLBACK_{_task.upper()}")
+    if _override is not None:
+        FALLBACK_MODELS[_task] = [m.strip() for m in _override.split(",") if m.strip()]
+
+
+def clean_json_response(text: str) -> str:
+    """Extract the JSON object from a model reply (strips markdown code fences)."""
+    if not text:
+        return "{}"
+    text = text.replace("```json", "").replace("```", "").strip()
+    match = re.search(r"(\{.*\})", text, re.DOTALL)
+    return match.group(1) if match else text
+
+
+# =============================================================================
+# BACKENDS
+# =============================================================================
+
+class ModelBackend:
+    """Transport for chat completions. `task` is the stats label, `model` the model id."""
+
+    name = "base"
+
+    async def complete(self, task: str, model: str, messages: List[Dict[str, Any]], temperature: float,
+                       max_tokens: int, json_mode: bool, lane: str,
+                       response_format: Optional[Dict[str, Any]] = None) -> Any:
+        raise NotImplementedError
+
+    def stream(self, task: str, model: str, messages: List[Dict[str, Any]], temperature: float,
+               max_tokens: int, lane: str) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {}
+
+
+class OpenRouterBackend(ModelBackend):
+    """OpenRouterClient: pooled aiohttp session, token-bucket key scheduler, SSE streaming."""
+
+    name = "openrouter"
+
+    def __init__(self, client: Optional[OpenRouterClient] = None):
+        self.client = client or OpenRouterClient()
+
+    async def complete(self, task, model, messages, temperature, max_tokens, json_mode, lane, response_format=None):
+        return await self.client.completion(
+            messages,
+            model_task=task,
+            model_id=model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            json_mode=json_mode,
+            response_format=response_format
+        )
+
+    def stream(self, task, model, messages, temperature, max_tokens, lane):
+        return self.client.stream_completion(
+            messages,
+            model_task=task,
+            model_id=model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            priority=lane
+        )
+
+    async def close(self):
+        await self.client.close()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "keys": self.client.scheduler.snapshot(),
+            "connections": self.client.connection_stats.snapshot(),
+        }
+
+
+class OpenAICompatibleBackend(ModelBackend):
+    """Any OpenAI-compatible endpoint through the openai SDK (one pooled AsyncOpenAI client)."""
+
+    name = "openai"
+
+    def __init__(self, stats: CallStats, base_url: str = OPENAI_BASE_URL, api_key: str = OPENAI_API_KEY):
+        # Optional dependency - only needed when this backend is selected
+        from openai import AsyncOpenAI, RateLimitError
+        self._rate_limit_error = RateLimitError
+        self.stats = stats
+        self._client = AsyncOpenAI(
+            base_url=base_url,
+            api_key=api_key,
+            default_headers={"HTTP-Referer": "https://kairo.app", "X-Title": "KAIRO"}
+        )
+
+    async def complete(self, task, model, messages, temperature, max_tokens, json_mode, lane, response_format=None):
+        kwargs = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+        if json_mode:
+            kwargs["response_format"] = {"type": "json_object"}
+        elif response_format:
+            kwargs["response_format"] = response_format
+        started = time.monotonic()
+        try:
+            response = await self._client.chat.completions.create(**kwargs)
+        except self._rate_limit_error:
+            self.stats.record(task, time.monotonic() - started, rate_limited=True, ok=False)
+            raise
+        except Exception:
+            self.stats.record(task, time.monotonic() - started, ok=False)
+            raise
+        self.stats.record(task, time.monotonic() - started)
+        usage_ledger.record(task, model, response.usage.model_dump() if response.usage else None,
+                            time.monotonic() - started, lane=lane)
+        return response.choices[0].message.content
+
+    async def stream(self, task, model, messages, temperature, max_tokens, lane):
+        started = time.monotonic()
+        usage = None
+        response = await self._client.chat.completions.create(
+            model=model, messages=messages, temperature=temperature, max_tokens=max_tokens, stream=True,
+            stream_options={"include_usage": True}
+        )
+        async for chunk in response:
+            if chunk.usage:
+                usage = chunk.usage.model_dump()
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                yield delta
+        usage_ledger.record(task, model, usage, time.monotonic() - started, lane=lane, streamed=True)
+
+    async def close(self):
+        await self._client.close()
+
+
+# =============================================================================
+# PROVIDER
+# =============================================================================
+
+class AIProvider:
+    """
+    The one entry point for model calls: resolves task → model, waits for a
+    slot in the caller's priority lane and hands the call to the backend.
+    """
+
+    def __init__(self, backend: Optional[ModelBackend] = None):
+        # Call stats are shared by every backend (the pipeline autoscaler reads them)
+        self.stats = OpenRouterClient.stats
+        if backend is None:
+            backend = OpenAICompatibleBackend(self.stats) if BACKEND == "openai" else OpenRouterBackend()
+        self.backend = backend
+
+    def model_for(self, task: str) -> str:
+        return MODELS.get(task, MODELS["fallback"])
+
+    async def complete(
+        self,
+        task: str,
+        messages: List[Dict[str, Any]],
+        max_tokens: int = 4096,
+        temperature: float = 0.7,
+        json_mode: bool = False,
+        priority: Optional[str] = None,
+        model_id: Optional[str] = None,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """
+        One completion as text (JSON mode replies are re-serialized).
+        Runs in the caller's lane unless `priority` names one; `model_id`
+        overrides the task's model. `response_format` (a JSON schema) is passed
+        through to the backend and the raw reply returned.
+        """
+        lane = priority or current_lane()
+        # The lane also orders the key scheduler's line inside the backend
+        with ai_lane(lane):
+            async with lanes.slot(lane):
+                response = await self.backend.complete(
+                    task, model_id or self.model_for(task), messages, temperature, max_tokens, json_mode, lane,
+                    response_format=response_format
+                )
+        if isinstance(response, (dict, list)):
+            return json.dumps(response)
+        return response
+
+    async def complete_with_fallback(
+        self,
+        task: str,
+        messages: List[Dict[str, Any]],
+        max_tokens: int = 4096,
+        temperature: float = 0.7,
+        start_at: int = 0,
+        response_format: Optional[Dict[str, Any]] = None,
+        model_id: Optional[str] = None
+    ) -> str:
+        """
+        complete() over the task's model + FALLBACK_MODELS[task], hedged: a slow
+        model gets a parallel request to the next one, a failed one hands over.
+        `start_at` rotates the chain (a retry after a bad answer starts on another model);
+        `model_id` replaces the task's model at the head of the chain.
+        """
+        chain = [model_id or self.model_for(task)] + FALLBACK_MODELS.get(task, [])
+        start_at %= len(chain)
+        chain = chain[start_at:] + chain[:start_at]
+        return await hedger.run(
+            chain,
+            lambda model: self.complete(task, messages, max_tokens=max_tokens, temperature=temperature,
+                                        model_id=model, response_format=response_format)
+        )
+
+    async def stream(
+        self,
+        task: str,
+        messages: List[Dict[str, Any]],
+        max_tokens: int = 4096,
+        temperature: float = 0.7,
+        priority: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """
+        Text deltas as they arrive. The model call runs in a producer task that
+        owns the lane slot (and, in the backend, the key slot) and feeds a
+        bounded buffer, so the slots are held while the model is generating -
+        not while a slow client reads. A consumer that stops reading for
+        STREAM_STALL_SECONDS loses the call (TimeoutError on its next read).
+        """
+        lane = priority or current_lane()
+        buffer: asyncio.Queue = asyncio.Queue(maxsize=STREAM_BUFFER)
+
+        async def produce():
+            async with lanes.slot(lane):
+                stream = self.backend.stream(task, self.model_for(task), messages, temperature, max_tokens, lane)
+                try:
+                    async for delta in stream:
+                        await asyncio.wait_for(buffer.put(delta), timeout=STREAM_STALL_SECONDS)
+                finally:
+                    await stream.aclose()
+
+        producer = asyncio.create_task(produce())
+        getter = None
+        try:
+            while True:
+                getter = asyncio.ensure_future(buffer.get())
+                await asyncio.wait({getter, producer}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield getter.result()
+                    continue
+                getter.cancel()
+                # Model call finished (or failed) - hand over what is buffered, then its outcome
+                while not buffer.empty():
+                    yield buffer.get_nowait()
+                producer.result()
+                return
+        finally:
+            if getter is not None:
+                getter.cancel()
+            producer.cancel()
+
+    async def close(self):
+        """Release backend connections (app shutdown)."""
+        await self.backend.close()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend.name,
+            "calls": {task: self.stats.snapshot(task) for task in ("ocr", "logic", "chat", "chat_fast")},
+            "lanes": lanes.snapshot(),
+            "hedging": hedger.snapshot(),
+            **self.backend.snapshot(),
+        }
+
+
+# Global instance - every model call in the backend goes through this
+provider = AIProvider()
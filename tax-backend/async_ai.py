@@ -1,38 +1,31 @@
 # async_ai.py
 # -----------------------------------------------------------------------------
 # ASYNC AI PIPELINE - High-Performance OpenRouter Integration
-# Uses AsyncOpenAI for non-blocking API calls with concurrent processing
+# Non-blocking model calls for the document pipeline, via the shared provider
+# layer (ai_provider.py) - same keys, rate limiter, lanes and stats as /upload
 # -----------------------------------------------------------------------------
 
+import os
 import asyncio
-import base64
-import json
-import re
-from typing import Dict, Any, Optional, List
-from openai import AsyncOpenAI
+from typing import Any, Dict, Optional
+
+from ai_provider import provider, clean_json_response
 
 # =============================================================================
-# CONFIGURATION
+# MODELS CONFIGURATION
 # =============================================================================
 
-OPENROUTER_API_KEY = "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"
-
-# Initialize Async Client (single instance for connection pooling)
-async_client = AsyncOpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=OPENROUTER_API_KEY,
-    default_headers={
-        "HTTP-Referer": "https://taxai.local",
-        "X-Title": "Tax.AI Enterprise"
-    }
-)
-
-# Model Configuration
+# The pipeline's own models (the interactive paths use ai_provider.MODELS).
+# Calls are still labelled "ocr" / "logic" / "chat", so stats and the
+# autoscaler see pipeline and /upload load together. The provider's fallback
+# chains back these up. Override with AI_PIPELINE_MODEL_<TASK>.
 MODELS = {
     "ocr": "qwen/qwen2.5-vl-32b-instruct",      # Vision/OCR - Best for documents
     "logic": "nousresearch/hermes-3-llama-3.1-405b",  # Reasoning - Tax/Legal analysis
     "chat": "meta-llama/llama-3.1-405b-instruct"      # Chat - User interactions
 }
+for _task in MODELS:
+    MODELS[_task] = os.getenv(f"AI_PIPELINE_MODEL_{_task.upper()}", MODELS[_task])
 
 # =============================================================================
 # ASYNC API CALLS - Non-blocking, concurrent execution
@@ -42,18 +35,19 @@ async def call_ocr_async(
     image_b64: str,
     prompt: str,
     mime_type: str = "image/jpeg",
-    max_tokens: int = 4096
+    max_tokens: int = 4096,
+    response_format: Optional[Dict[str, Any]] = None
 ) -> str:
     """
-    Async OCR call to Qwen2.5-VL vision model.
+    Async OCR call to the vision model (falls back along the OCR chain).
     Non-blocking - can process multiple images concurrently.
     """
     try:
         print(f"🔄 [ASYNC] OCR starting...")
         
-        response = await async_client.chat.completions.create(
-            model=MODELS["ocr"],
-            messages=[{
+        result = await provider.complete_with_fallback(
+            "ocr",
+            [{
                 "role": "user",
                 "content": [
                     {"type": "text", "text": prompt},
@@ -64,10 +58,11 @@ async def call_ocr_async(
                 ]
             }],
             max_tokens=max_tokens,
-            temperature=0.2
+            temperature=0.2,
+            response_format=response_format,
+            model_id=MODELS["ocr"]
         )
         
-        result = response.choices[0].message.content
         print(f"✅ [ASYNC] OCR complete")
         return result
         
@@ -84,14 +79,14 @@ async def call_logic_async(prompt: str, max_tokens: int = 4096) -> str:
     try:
         print(f"🔄 [ASYNC] Logic starting...")
         
-        response = await async_client.chat.completions.create(
-            model=MODELS["logic"],
-            messages=[{"role": "user", "content": prompt}],
+        result = await provider.complete_with_fallback(
+            "logic",
+            [{"role": "user", "content": prompt}],
             max_tokens=max_tokens,
-            temperature=0.3
+            temperature=0.3,
+            model_id=MODELS["logic"]
         )
         
-        result = response.choices[0].message.content
         print(f"✅ [ASYNC] Logic complete")
         return result
         
@@ -117,14 +112,9 @@ async def call_chat_async(
             messages.append({"role": "system", "content": system_prompt})
         messages.append({"role": "user", "content": prompt})
         
-        response = await async_client.chat.completions.create(
-            model=MODELS["chat"],
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=0.7
-        )
+        result = await provider.complete("chat", messages, max_tokens=max_tokens, temperature=0.7,
+                                         model_id=MODELS["chat"])
         
-        result = response.choices[0].message.content
         print(f"✅ [ASYNC] Chat complete")
         return result
         
@@ -133,17 +123,6 @@ async def call_chat_async(
         raise
 
 
-# =============================================================================
-# HELPER FUNCTIONS
-# =============================================================================
-
-def clean_json_response(text: str) -> str:
-    """Extract JSON from markdown code blocks."""
-    text = text.replace("```json", "").replace("```", "").strip()
-    match = re.search(r"(\{.*\})", text, re.DOTALL)
-    return match.group(1) if match else text
-
-
 # =============================================================================
 # TEST FUNCTION
 # =============================================================================
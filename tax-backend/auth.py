@@ -12,6 +12,8 @@ from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
 import sqlite3
 
+from db_pool import get_pool
+
 # =============================================================================
 # CONFIGURATION
 # =============================================================================
@@ -120,79 +122,71 @@ def verify_token(token: str) -> Optional[Dict[str, Any]]:
 
 def init_users_table(db_path: str = "tax_data.db"):
     """Create users table if it doesn't exist and migrate if needed."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    with get_pool(db_path).write() as conn:
+        cursor = conn.cursor()
     
-    # Check if table exists
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
-    table_exists = cursor.fetchone() is not None
+        # Check if table exists
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
+        table_exists = cursor.fetchone() is not None
     
-    if table_exists:
-        # Check if we need to migrate (add missing columns)
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [col[1] for col in cursor.fetchall()]
+        if table_exists:
+            # Check if we need to migrate (add missing columns)
+            cursor.execute("PRAGMA table_info(users)")
+            columns = [col[1] for col in cursor.fetchall()]
         
-        if 'display_name' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN display_name TEXT DEFAULT 'User'")
-            print("✅ Added display_name column to users table")
+            if 'display_name' not in columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN display_name TEXT DEFAULT 'User'")
+                print("✅ Added display_name column to users table")
         
-        if 'avatar_url' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN avatar_url TEXT DEFAULT NULL")
-            print("✅ Added avatar_url column to users table")
+            if 'avatar_url' not in columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN avatar_url TEXT DEFAULT NULL")
+                print("✅ Added avatar_url column to users table")
         
-        if 'preferences' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN preferences TEXT DEFAULT '{}'")
-            print("✅ Added preferences column to users table")
+            if 'preferences' not in columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN preferences TEXT DEFAULT '{}'")
+                print("✅ Added preferences column to users table")
         
-        if 'last_login' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN last_login TIMESTAMP DEFAULT NULL")
-            print("✅ Added last_login column to users table")
+            if 'last_login' not in columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN last_login TIMESTAMP DEFAULT NULL")
+                print("✅ Added last_login column to users table")
         
-        if 'whatsapp_phone' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN whatsapp_phone TEXT UNIQUE DEFAULT NULL")
-            print("✅ Added whatsapp_phone column to users table")
-    else:
-        # Create fresh table
-        cursor.execute("""
-            CREATE TABLE users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL UNIQUE,
-                email TEXT NOT NULL UNIQUE,
-                password_hash TEXT NOT NULL,
-                display_name TEXT DEFAULT 'User',
-                avatar_url TEXT DEFAULT NULL,
-                preferences TEXT DEFAULT '{"darkMode": true}',
-                whatsapp_phone TEXT UNIQUE DEFAULT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP DEFAULT NULL
-            )
-        """)
-        print("✅ Created users table")
-    
-    # Create default admin user if no users exist (for testing)
-    cursor.execute("SELECT COUNT(*) FROM users")
-    if cursor.fetchone()[0] == 0:
-        default_password, _ = hash_password("password123")
-        cursor.execute("""
-            INSERT INTO users (username, email, password_hash, display_name, preferences)
-            VALUES (?, ?, ?, ?, ?)
-        """, ("rahul", "rahul@example.com", default_password, "Rahul", 
-              '{"darkMode": true, "notifications": {"email": true, "desktop": false}}'))
-        print("✅ Created default user: rahul@example.com / password123")
-    
-    conn.commit()
-    conn.close()
+            if 'whatsapp_phone' not in columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN whatsapp_phone TEXT UNIQUE DEFAULT NULL")
+                print("✅ Added whatsapp_phone column to users table")
+        else:
+            # Create fresh table
+            cursor.execute("""
+                CREATE TABLE users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT NOT NULL UNIQUE,
+                    email TEXT NOT NULL UNIQUE,
+                    password_hash TEXT NOT NULL,
+                    display_name TEXT DEFAULT 'User',
+                    avatar_url TEXT DEFAULT NULL,
+                    preferences TEXT DEFAULT '{"darkMode": true}',
+                    whatsapp_phone TEXT UNIQUE DEFAULT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_login TIMESTAMP DEFAULT NULL
+                )
+            """)
+            print("✅ Created users table")
+    
+        # Create default admin user if no users exist (for testing)
+        cursor.execute("SELECT COUNT(*) FROM users")
+        if cursor.fetchone()[0] == 0:
+            default_password, _ = hash_password("password123")
+            cursor.execute("""
+                INSERT INTO users (username, email, password_hash, display_name, preferences)
+                VALUES (?, ?, ?, ?, ?)
+            """, ("rahul", "rahul@example.com", default_password, "Rahul", 
+                  '{"darkMode": true, "notifications": {"email": true, "desktop": false}}'))
+            print("✅ Created default user: rahul@example.com / password123")
 
 
 def get_user_by_email(email: str, db_path: str = "tax_data.db") -> Optional[Dict]:
     """Get user by email address."""
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT * FROM users WHERE email = ?", (email.lower(),))
-    row = cursor.fetchone()
-    conn.close()
+    with get_pool(db_path).read() as conn:
+        row = conn.execute("SELECT * FROM users WHERE email = ?", (email.lower(),)).fetchone()
     
     if row:
         return dict(row)
@@ -201,13 +195,8 @@ def get_user_by_email(email: str, db_path: str = "tax_data.db") -> Optional[Dict
 
 def get_user_by_id(user_id: int, db_path: str = "tax_data.db") -> Optional[Dict]:
     """Get user by ID."""
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with get_pool(db_path).read() as conn:
+        row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
     
     if row:
         return dict(row)
@@ -217,21 +206,16 @@ def get_user_by_id(user_id: int, db_path: str = "tax_data.db") -> Optional[Dict]
 def create_user(username: str, email: str, password: str, display_name: str = None, 
                 db_path: str = "tax_data.db") -> Optional[Dict]:
     """Create a new user account."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
     try:
         password_hash, _ = hash_password(password)
         display = display_name or username.title()
         
-        cursor.execute("""
-            INSERT INTO users (username, email, password_hash, display_name)
-            VALUES (?, ?, ?, ?)
-        """, (username.lower(), email.lower(), password_hash, display))
-        
-        user_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with get_pool(db_path).write() as conn:
+            cursor = conn.execute("""
+                INSERT INTO users (username, email, password_hash, display_name)
+                VALUES (?, ?, ?, ?)
+            """, (username.lower(), email.lower(), password_hash, display))
+            user_id = cursor.lastrowid
         
         return {
             "id": user_id,
@@ -241,7 +225,6 @@ def create_user(username: str, email: str, password: str, display_name: str = No
         }
         
     except sqlite3.IntegrityError as e:
-        conn.close()
         if "email" in str(e):
             raise ValueError("Email already registered")
         elif "username" in str(e):
@@ -251,29 +234,20 @@ def create_user(username: str, email: str, password: str, display_name: str = No
 
 def update_user_preferences(user_id: int, preferences: Dict, db_path: str = "tax_data.db") -> bool:
     """Update user preferences (dark mode, notifications, etc.)."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
     try:
         prefs_json = json.dumps(preferences)
-        cursor.execute("UPDATE users SET preferences = ? WHERE id = ?", (prefs_json, user_id))
-        conn.commit()
-        success = cursor.rowcount > 0
-        conn.close()
-        return success
+        with get_pool(db_path).write() as conn:
+            cursor = conn.execute("UPDATE users SET preferences = ? WHERE id = ?", (prefs_json, user_id))
+        return cursor.rowcount > 0
     except Exception as e:
-        conn.close()
         print(f"Error updating preferences: {e}")
         return False
 
 
 def update_last_login(user_id: int, db_path: str = "tax_data.db"):
     """Update user's last login timestamp."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with get_pool(db_path).write() as conn:
+        conn.execute("UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?", (user_id,))
 
 
 # =============================================================================
@@ -282,16 +256,11 @@ def update_last_login(user_id: int, db_path: str = "tax_data.db"):
 
 def get_user_by_whatsapp(phone: str, db_path: str = "tax_data.db") -> Optional[Dict]:
     """Get user by WhatsApp phone number."""
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
     # Normalize phone number (remove spaces, dashes, etc.)
     normalized_phone = phone.replace(" ", "").replace("-", "").replace("(", "").replace(")", "")
     
-    cursor.execute("SELECT * FROM users WHERE whatsapp_phone = ?", (normalized_phone,))
-    row = cursor.fetchone()
-    conn.close()
+    with get_pool(db_path).read() as conn:
+        row = conn.execute("SELECT * FROM users WHERE whatsapp_phone = ?", (normalized_phone,)).fetchone()
     
     if row:
         return dict(row)
@@ -300,40 +269,27 @@ def get_user_by_whatsapp(phone: str, db_path: str = "tax_data.db") -> Optional[D
 
 def update_user_whatsapp(user_id: int, phone: str, db_path: str = "tax_data.db") -> bool:
     """Link WhatsApp phone number to user account."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
     try:
         # Normalize phone number
         normalized_phone = phone.replace(" ", "").replace("-", "").replace("(", "").replace(")", "")
         
-        cursor.execute("UPDATE users SET whatsapp_phone = ? WHERE id = ?", (normalized_phone, user_id))
-        conn.commit()
-        success = cursor.rowcount > 0
-        conn.close()
-        return success
+        with get_pool(db_path).write() as conn:
+            cursor = conn.execute("UPDATE users SET whatsapp_phone = ? WHERE id = ?", (normalized_phone, user_id))
+        return cursor.rowcount > 0
     except sqlite3.IntegrityError:
-        conn.close()
         raise ValueError("WhatsApp phone number already linked to another account")
     except Exception as e:
-        conn.close()
         print(f"Error updating WhatsApp phone: {e}")
         return False
 
 
 def remove_user_whatsapp(user_id: int, db_path: str = "tax_data.db") -> bool:
     """Remove WhatsApp phone number from user account."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute("UPDATE users SET whatsapp_phone = NULL WHERE id = ?", (user_id,))
-        conn.commit()
-        success = cursor.rowcount > 0
-        conn.close()
-        return success
+        with get_pool(db_path).write() as conn:
+            cursor = conn.execute("UPDATE users SET whatsapp_phone = NULL WHERE id = ?", (user_id,))
+        return cursor.rowcount > 0
     except Exception as e:
-        conn.close()
         print(f"Error removing WhatsApp phone: {e}")
         return False
 
@@ -3,6 +3,7 @@ from pydantic import BaseModel
 from typing import Optional, Dict, Any
 from auth import authenticate_user, create_user, update_user_preferences
 from auth_dependencies import get_current_user_from_header
+from repositories import run_db
 
 router = APIRouter(prefix="/auth", tags=["Authentication"])
 
@@ -21,7 +22,8 @@ class UpdatePreferencesRequest(BaseModel):
 
 @router.post("/login")
 async def login(data: LoginRequest):
-    result = authenticate_user(data.email, data.password)
+    # Password hashing and the last-login write run on the DB threads
+    result = await run_db(authenticate_user, data.email, data.password)
     if not result:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -40,14 +42,15 @@ async def login(data: LoginRequest):
 async def register(data: RegisterRequest):
     try:
         # Create user
-        create_user(
+        await run_db(
+            create_user,
             username=data.username,
             email=data.email,
             password=data.password,
             display_name=data.display_name
         )
         # Auto-login
-        result = authenticate_user(data.email, data.password)
+        result = await run_db(authenticate_user, data.email, data.password)
         if not result:
              raise HTTPException(status_code=500, detail="Registration successful but auto-login failed")
              
@@ -68,7 +71,7 @@ async def update_preferences_endpoint(
     data: UpdatePreferencesRequest,
     user: dict = Depends(get_current_user_from_header)
 ):
-    success = update_user_preferences(user["id"], data.preferences)
+    success = await run_db(update_user_preferences, user["id"], data.preferences)
     if not success:
         raise HTTPException(status_code=500, detail="Failed to update preferences")
     return {"status": "success", "preferences": data.preferences}
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Fake OpenRouter: an offline chat-completions server for load tests.
+
+Replays responses recorded by OpenRouterClient's record mode
+(OPENROUTER_RECORD_DIR) with a configurable latency distribution, and
+injects 429s / 5xx so the key scheduler, lanes and hedging behave like they
+do against the real service - without spending quota.
+
+Response for a request, in order of preference:
+  1. the recording with the same fingerprint (same model + same messages)
+  2. a random recording for the same model
+  3. a synthetic answer (invoice JSON for vision requests, else a ledger JSON
+     or "EXPLAIN: ..." for Jarvis prompts)
+
+Latency specs (per model with --model-latency MODEL=SPEC, --latency for the rest):
+  fixed:SECONDS            uniform:LOW,HIGH
+  lognormal:MEDIAN,SIGMA   recorded  (latencies captured with the response)
+
+Point the backend at it:
+    python benchmarks/fake_openrouter.py --fixtures fixtures/ --port 8099 \\
+        --latency lognormal:2,0.6 --rate-429 0.05 --key-rpm 20 --scale 0.1
+    OPENROUTER_BASE_URL=http://127.0.0.1:8099/api/v1 OPENROUTER_API_KEYS=sk-fake-1,sk-fake-2 \\
+        uvicorn main:app
+
+GET /stats returns request / 429 / 5xx counts and served latency percentiles.
+"""
+
+import os
+import sys
+import glob
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+from collections import defaultdict
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from aiohttp import web
+
+from openrouter_client import request_fingerprint
+
+SYNTHETIC_INVOICE = {
+    "gst_no": "27AAPFU0939F1ZV", "invoice_no": "INV-001", "invoice_date": "2025-04-01",
+    "vendor_name": "Load Test Traders", "buyer_name": "Kairo Demo Pvt Ltd", "buyer_gstin": "",
+    "vendor_state": "Maharashtra", "place_of_supply": "Maharashtra", "hsn_code": "8471",
+    "tax_rate": 18, "taxable_value": 10000.0, "cgst_amount": 900.0, "sgst_amount": 900.0,
+    "igst_amount": 0, "cess_amount": 0, "grand_total": 11800.0,
+    "ledger_name": "Purchase A/c", "group_name": "Purchase Accounts",
+}
+
+SYNTHETIC_LOGIC = {
+    "hsn_code": "8471", "hsn_description": "Computers", "ledger": "Computer Equipment",
+    "ledger_name": "Computer Equipment", "group": "Fixed Assets", "group_name": "Fixed Assets",
+    "tax_rate": 18, "confidence": 0.9,
+}
+
+
+def parse_latency(spec):
+    """'lognormal:2,0.6' → ('lognormal', [2.0, 0.6])."""
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v.strip()]
+    expected = {"fixed": 1, "uniform": 2, "lognormal": 2, "recorded": 0}
+    if kind not in expected or len(values) != expected[kind]:
+        raise argparse.ArgumentTypeError(f"bad latency spec {spec!r}")
+    return kind, values
+
+
+class FakeOpenRouter:
+    def __init__(self, fixtures_dir=None, latency="fixed:0.05", model_latency=None, scale=1.0,
+                 rate_429=0.0, rate_5xx=0.0, key_rpm=0.0, retry_after=2.0, seed=0):
+        self.rng = random.Random(seed)
+        self.latency = parse_latency(latency) if isinstance(latency, str) else latency
+        self.model_latency = {m: parse_latency(s) if isinstance(s, str) else s
+                              for m, s in (model_latency or {}).items()}
+        self.scale = scale
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.key_rpm = key_rpm
+        self.retry_after = retry_after
+        self.by_fingerprint = {}
+        self.by_model = defaultdict(list)
+        self.recorded_latency = defaultdict(list)
+        self._buckets = {}
+        self.counts = defaultdict(int)
+        self.served = []
+        if fixtures_dir:
+            self.load(fixtures_dir)
+
+    def load(self, fixtures_dir):
+        for path in sorted(glob.glob(os.path.join(fixtures_dir, "*.jsonl"))):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get("status") != 200 or not entry.get("response"):
+                        continue
+                    self.by_fingerprint[entry["fingerprint"]] = entry
+                    self.by_model[entry["model"]].append(entry)
+                    self.recorded_latency[entry["model"]].append(entry["latency"])
+        print(f"📼 Loaded {len(self.by_fingerprint)} recorded responses "
+              f"for {len(self.by_model)} models from {fixtures_dir}")
+
+    def delay(self, model):
+        kind, values = self.model_latency.get(model, self.latency)
+        if kind == "recorded":
+            samples = self.recorded_latency.get(model)
+            seconds = self.rng.choice(samples) if samples else 0.05
+        elif kind == "fixed":
+            seconds = values[0]
+        elif kind == "uniform":
+            seconds = self.rng.uniform(values[0], values[1])
+        else:
+            seconds = self.rng.lognormvariate(math.log(values[0]), values[1])
+        return seconds * self.scale
+
+    def rate_limited(self, key):
+        """Per-key token bucket (free tier: 20/min, burst of 5), then random injection."""
+        if self.key_rpm:
+            now = time.monotonic()
+            tokens, updated = self._buckets.get(key, (5.0, now))
+            tokens = min(5.0, tokens + (now - updated) * self.key_rpm / 60.0)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return True
+            self._buckets[key] = (tokens - 1, now)
+        return self.rng.random() < self.rate_429
+
+    def answer(self, body):
+        model = body.get("model", "")
+        messages = body.get("messages", [])
+        recorded = self.by_fingerprint.get(request_fingerprint(model, messages))
+        if recorded is None and self.by_model.get(model):
+            recorded = self.rng.choice(self.by_model[model])
+        if recorded is not None:
+            self.counts["replayed"] += 1
+            return recorded["response"]["choices"][0]["message"]["content"]
+        self.counts["synthetic"] += 1
+        content = messages[-1].get("content") if messages else ""
+        if isinstance(content, list):
+            return json.dumps(SYNTHETIC_INVOICE)
+        if "EXPLAIN:" in (content or ""):
+            return "EXPLAIN: This is a canned answer from the fake OpenRouter server."
+        return json.dumps(SYNTHETIC_LOGIC)
+
+    async def completions(self, request):
+        body = await request.json()
+        model = body.get("model", "")
+        self.counts["requests"] += 1
+        if self.rate_limited(request.headers.get("Authorization", "")):
+            self.counts["429"] += 1
+            return web.json_response({"error": {"code": 429, "message": "Rate limit exceeded (fake)"}},
+                                     status=429, headers={"Retry-After": str(self.retry_after)})
+        started = time.monotonic()
+        await asyncio.sleep(self.delay(model))
+        if self.rng.random() < self.rate_5xx:
+            self.counts["5xx"] += 1
+            return web.json_response({"error": {"code": 502, "message": "Upstream error (fake)"}}, status=502)
+        content = self.answer(body)
+        usage = {
+            "prompt_tokens": len(json.dumps(body.get("messages", []))) // 4,
+            "completion_tokens": len(content) // 4,
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        self.served.append(time.monotonic() - started)
+
+        if not body.get("stream"):
+            return web.json_response({
+                "id": f"fake-{self.counts['requests']}", "model": model, "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write(b": OPENROUTER PROCESSING\n\n")
+        for i in range(0, len(content), 16):
+            chunk = {"model": model, "choices": [{"index": 0, "delta": {"content": content[i:i + 16]}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(0.005 * self.scale)
+        await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def stats(self, request):
+        served = sorted(self.served)
+
+        def pct(p):
+            return round(served[min(len(served) - 1, int(p * len(served)))], 3) if served else None
+
+        return web.json_response({**self.counts, "latency_p50": pct(0.5), "latency_p95": pct(0.95)})
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/api/v1/chat/completions", self.completions)
+        app.router.add_post("/chat/completions", self.completions)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+
+async def start_fake_openrouter(host="127.0.0.1", port=0, **options):
+    """Run in the current loop. Returns (runner, server, base_url) - base_url goes in OPENROUTER_BASE_URL."""
+    server = FakeOpenRouter(**options)
+    runner = web.AppRunner(server.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, server, f"http://{host}:{port}/api/v1"
+
+
+def model_latency_arg(value):
+    model, _, spec = value.rpartition("=")
+    if not model:
+        raise argparse.ArgumentTypeError("use MODEL=SPEC")
+    return model, parse_latency(spec)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--fixtures", help="directory of recorded *.jsonl (OPENROUTER_RECORD_DIR)")
+    parser.add_argument("--latency", type=parse_latency, default=parse_latency("lognormal:2,0.6"))
+    parser.add_argument("--model-latency", type=model_latency_arg, action="append", default=[])
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every latency (0.1 = 10x faster)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="probability of a random 429")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="probability of a 502")
+    parser.add_argument("--key-rpm", type=float, default=0.0, help="per-key requests/minute before 429s (0 = off)")
+    parser.add_argument("--retry-after", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeOpenRouter(
+        fixtures_dir=args.fixtures, latency=args.latency, model_latency=dict(args.model_latency),
+        scale=args.scale, rate_429=args.rate_429, rate_5xx=args.rate_5xx, key_rpm=args.key_rpm,
+        retry_after=args.retry_after, seed=args.seed,
+    )
+    print(f"🧪 Fake OpenRouter on http://{args.host}:{args.port}/api/v1")
+    web.run_app(server.app(), host=args.host, port=args.port, access_log=None, print=None)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Benchmark: vision payloads with and without image pre-processing.
+
+For every sample bill in uploads/ (images, plus PDF pages when poppler is
+installed) it compares what would be sent to the vision model today
+(original bytes, or a 200 dpi PNG render) against the pre-processed
+version (deskew, crop, grayscale, downscale, JPEG/WebP within budget):
+
+  * payload size  - base64 bytes actually put in the request
+  * latency       - pre-processing time + upload time at --uplink-mbps
+                    (+ the real model round trip with --live)
+  * accuracy      - with --live, both variants are sent to the OCR model and
+                    the key fields compared; reference is the original image
+                    unless --truth points at {"<file name>": {field: value}}
+
+Usage:
+    python benchmarks/image_prep_benchmark.py
+    python benchmarks/image_prep_benchmark.py --live --limit 5      # needs OPENROUTER_API_KEYS
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import asyncio
+import argparse
+import contextlib
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+KEY_FIELDS = ("gst_no", "invoice_no", "invoice_date", "taxable_value",
+              "cgst_amount", "sgst_amount", "igst_amount", "grand_total")
+
+MIME_BY_EXT = {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+def load_samples(limit):
+    """(name, original_bytes, mime) for images and rendered PDF first pages."""
+    from offload import render_pdf_page_png
+    upload_dir = os.path.join(BACKEND_DIR, "uploads")
+    samples, skipped_pdfs = [], 0
+    for name in sorted(os.listdir(upload_dir)) if os.path.isdir(upload_dir) else []:
+        ext = name.rsplit(".", 1)[-1].lower()
+        with open(os.path.join(upload_dir, name), "rb") as f:
+            content = f.read()
+        if ext in MIME_BY_EXT:
+            samples.append((name, content, MIME_BY_EXT[ext]))
+        elif ext == "pdf":
+            try:
+                # What the vision path used to send for a PDF page
+                samples.append((name, render_pdf_page_png(content, 200, 1), "image/png"))
+            except Exception:
+                skipped_pdfs += 1
+        if limit and len(samples) >= limit:
+            break
+    return samples, skipped_pdfs
+
+
+def normalize(value):
+    if value is None:
+        return None
+    text = str(value).strip().upper().replace(",", "")
+    try:
+        return round(float(text), 2)
+    except ValueError:
+        return text
+
+
+def field_agreement(reference, candidate):
+    matched = sum(1 for k in KEY_FIELDS if normalize(reference.get(k)) == normalize(candidate.get(k)))
+    return matched / len(KEY_FIELDS)
+
+
+async def ocr(b64_data, mime_type):
+    from ai_config import call_vision_model, clean_json_response
+    from pipeline import OCR_PROMPT
+    start = time.perf_counter()
+    response = await call_vision_model(b64_data, OCR_PROMPT, mime_type)
+    elapsed = time.perf_counter() - start
+    try:
+        return json.loads(clean_json_response(response)), elapsed
+    except ValueError:
+        return {}, elapsed
+
+
+async def run(args):
+    from offload import run_cpu_bound, shutdown_executors
+    from image_prep import preprocess_image, settings
+
+    samples, skipped_pdfs = load_samples(args.limit)
+    truth = {}
+    if args.truth:
+        with open(args.truth) as f:
+            truth = json.load(f)
+    bytes_per_second = args.uplink_mbps * 1_000_000 / 8
+
+    rows = []
+    for name, original, mime in samples:
+        start = time.perf_counter()
+        processed, processed_mime = await run_cpu_bound(preprocess_image, original)
+        prep_seconds = time.perf_counter() - start
+        b64_before = base64.b64encode(original).decode()
+        b64_after = base64.b64encode(processed).decode()
+        row = {
+            "name": name, "before": len(b64_before), "after": len(b64_after), "prep": prep_seconds,
+            "upload_before": len(b64_before) / bytes_per_second,
+            "upload_after": len(b64_after) / bytes_per_second,
+        }
+        if args.live:
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                data_before, model_before = await ocr(b64_before, mime)
+                data_after, model_after = await ocr(b64_after, processed_mime)
+            reference = truth.get(name) or data_before
+            row.update(model_before=model_before, model_after=model_after,
+                       acc_after=field_agreement(reference, data_after))
+        rows.append(row)
+
+    # Concurrent throughput of the pre-processing pool itself
+    start = time.perf_counter()
+    await asyncio.gather(*(run_cpu_bound(preprocess_image, s[1]) for s in samples * args.repeat))
+    pool_wall = time.perf_counter() - start
+    shutdown_executors()
+
+    print("=" * 96)
+    print(f"IMAGE PRE-PROCESSING  samples={len(rows)} (pdfs skipped without poppler: {skipped_pdfs})  "
+          f"uplink={args.uplink_mbps} Mbit/s")
+    print(f"settings: {settings()}")
+    print("=" * 96)
+    print(f"{'file':<36} {'b64 before':>11} {'b64 after':>10} {'ratio':>6} {'prep ms':>8} {'upload ms':>16}"
+          + ("  model s (before→after)  acc" if args.live else ""))
+    for r in rows:
+        line = (f"{r['name'][-36:]:<36} {r['before']:>11,} {r['after']:>10,} {r['after'] / r['before']:>6.2f} "
+                f"{r['prep'] * 1000:>8.0f} {r['upload_before'] * 1000:>7.0f}→{r['upload_after'] * 1000:<7.0f}")
+        if args.live:
+            line += f"  {r['model_before']:>6.2f}→{r['model_after']:<6.2f}         {r['acc_after']:.2f}"
+        print(line)
+    if rows:
+        before = sum(r["before"] for r in rows)
+        after = sum(r["after"] for r in rows)
+        saved = sum(r["upload_before"] - r["upload_after"] - r["prep"] for r in rows) / len(rows)
+        print("-" * 96)
+        print(f"total payload {before:,} → {after:,} bytes ({after / before:.0%}); "
+              f"mean end-to-end saving before model time: {saved * 1000:.0f} ms/file")
+        print(f"pool throughput: {len(samples) * args.repeat} images in {pool_wall:.2f}s "
+              f"({len(samples) * args.repeat / pool_wall:.1f}/s)")
+        if args.live:
+            model_before = sum(r["model_before"] for r in rows) / len(rows)
+            model_after = sum(r["model_after"] for r in rows) / len(rows)
+            accuracy = sum(r["acc_after"] for r in rows) / len(rows)
+            print(f"model round trip: {model_before:.2f}s → {model_after:.2f}s mean; "
+                  f"key-field agreement after pre-processing: {accuracy:.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--limit", type=int, default=0, help="max samples (0 = all)")
+    parser.add_argument("--uplink-mbps", type=float, default=20.0)
+    parser.add_argument("--repeat", type=int, default=4, help="copies per sample for the pool throughput run")
+    parser.add_argument("--live", action="store_true", help="call the OCR model for both variants")
+    parser.add_argument("--truth", help="JSON file of expected fields per sample file name")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Load test: concurrent /upload traffic + read traffic (/history, /clients).
+
+Runs the real FastAPI app in-process (httpx ASGI transport, single event loop,
+exactly like one uvicorn worker) against a throwaway database, with the model
+calls replaced by a fixed-latency fake so no OpenRouter quota is spent.
+With --fake-openrouter the model calls stay real and go through the whole
+client stack (key scheduler, lanes, hedging) to benchmarks/fake_openrouter.py
+instead - replaying --fixtures and injecting --rate-429.
+
+What it shows: read latency percentiles with no uploads vs. while uploads are
+in flight. If anything in the upload path blocks the loop, the "under load"
+p99 jumps by roughly the blocking time.
+
+Usage:
+    python benchmarks/load_test_upload.py --uploads 40 --model-latency 1.5
+    python benchmarks/load_test_upload.py --fake-openrouter --fixtures fixtures/ --rate-429 0.05
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import contextlib
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+FAKE_OCR = {
+    "gst_no": "27AAPFU0939F1ZV", "invoice_no": "INV-001", "invoice_date": "2025-04-01",
+    "vendor_name": "Load Test Traders", "hsn_code": "8471", "tax_rate": 18,
+    "taxable_value": 10000.0, "cgst_amount": 900.0, "sgst_amount": 900.0,
+    "igst_amount": 0, "cess_amount": 0, "grand_total": 11800.0,
+}
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    k = max(0, min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+def summarize(label, samples):
+    if not samples:
+        return f"{label:<22} no samples"
+    ms = [s * 1000 for s in samples]
+    return (f"{label:<22} n={len(ms):<5} p50={percentile(ms, 50):7.1f}ms  "
+            f"p95={percentile(ms, 95):7.1f}ms  p99={percentile(ms, 99):7.1f}ms  "
+            f"max={max(ms):7.1f}ms")
+
+
+def pick_sample_files():
+    """Use the real sample bills in uploads/ (images + PDFs)."""
+    upload_dir = os.path.join(BACKEND_DIR, "uploads")
+    files = []
+    for name in sorted(os.listdir(upload_dir)) if os.path.isdir(upload_dir) else []:
+        ext = name.rsplit(".", 1)[-1].lower()
+        mime = {"pdf": "application/pdf", "png": "image/png", "jpg": "image/jpeg",
+                "jpeg": "image/jpeg", "webp": "image/webp"}.get(ext)
+        if mime:
+            with open(os.path.join(upload_dir, name), "rb") as f:
+                files.append((name, f.read(), mime))
+    if not files:
+        files.append(("blank.png", b"\x89PNG\r\n\x1a\n" + b"\x00" * 4096, "image/png"))
+    return files
+
+
+async def read_loop(client, headers, stop, samples):
+    paths = ["/history", "/clients"]
+    while not stop.is_set():
+        path = random.choice(paths)
+        start = time.perf_counter()
+        await client.get(path, headers=headers)
+        samples.append(time.perf_counter() - start)
+        await asyncio.sleep(0.01)
+
+
+async def run(args):
+    import httpx
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("OpenRouterClient").setLevel(logging.WARNING)
+    random.seed(args.seed)
+    work_dir = tempfile.mkdtemp(prefix="kairo_loadtest_")
+    os.chdir(work_dir)
+
+    fake = None
+    if args.fake_openrouter:
+        # Read at import time by openrouter_client / rate_scheduler
+        os.environ.setdefault("OPENROUTER_API_KEYS", "sk-fake-1,sk-fake-2,sk-fake-3,sk-fake-4")
+        # The stub decides when to 429 - don't let our own free-tier buckets throttle first
+        os.environ.setdefault("OPENROUTER_KEY_RPM", "6000")
+        os.environ.setdefault("OPENROUTER_KEY_RPD", "1000000")
+        import openrouter_client
+        from fake_openrouter import start_fake_openrouter
+        fake_runner, fake, base_url = await start_fake_openrouter(
+            fixtures_dir=args.fixtures, latency=("lognormal", [args.model_latency, 0.5]),
+            rate_429=args.rate_429, key_rpm=args.key_rpm, seed=args.seed,
+        )
+        openrouter_client.OPENROUTER_BASE_URL = base_url + "/chat/completions"
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        import main
+        import auth
+        from migrate_database import migrate_database_for_multi_tenancy
+        migrate_database_for_multi_tenancy(main.DB_FILE)
+
+    async def fake_vision(image_base64, prompt, mime_type="image/jpeg", max_tokens=2048):
+        await asyncio.sleep(args.model_latency * random.uniform(0.5, 1.5))
+        return json.dumps(FAKE_OCR)
+
+    async def fake_logic(prompt, max_tokens=2048):
+        await asyncio.sleep(args.model_latency * 0.3)
+        return json.dumps({"hsn_code": "8471", "ledger": "Computer Equipment", "group": "Fixed Assets"})
+
+    if fake is None:
+        main.call_vision_model = fake_vision
+        main.call_logic_model = fake_logic
+
+    token = auth.generate_token(1, "rahul", "rahul@example.com")
+    headers = {"Authorization": f"Bearer {token}"}
+    samples = pick_sample_files()
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=600) as client:
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            # Seed some history so reads do real work
+            for i in range(args.seed_rows):
+                await client.post("/manual", headers=headers, json={
+                    "vendor_name": f"Seed Vendor {i}", "grand_total": 1180.0,
+                    "taxable_value": 1000.0, "cgst_amount": 90.0, "sgst_amount": 90.0,
+                    "invoice_no": f"SEED-{i}", "ledger_name": "Purchase A/c",
+                    "group_name": "Purchase Accounts", "hsn_code": "8471",
+                })
+
+            # Phase 1: reads only
+            baseline, stop = [], asyncio.Event()
+            readers = [asyncio.create_task(read_loop(client, headers, stop, baseline)) for _ in range(args.readers)]
+            await asyncio.sleep(args.baseline_seconds)
+            stop.set()
+            await asyncio.gather(*readers)
+
+            # Phase 2: reads while uploads are in flight
+            loaded, stop = [], asyncio.Event()
+            upload_times, statuses = [], []
+            readers = [asyncio.create_task(read_loop(client, headers, stop, loaded)) for _ in range(args.readers)]
+
+            async def one_upload(i):
+                name, content, mime = samples[i % len(samples)]
+                start = time.perf_counter()
+                r = await client.post("/upload", headers=headers,
+                                      files={"file": (f"{i}_{name}", content, mime)})
+                upload_times.append(time.perf_counter() - start)
+                statuses.append(r.status_code)
+
+            wall = time.perf_counter()
+            await asyncio.gather(*(one_upload(i) for i in range(args.uploads)))
+            wall = time.perf_counter() - wall
+            stop.set()
+            await asyncio.gather(*readers)
+
+    print("=" * 78)
+    print(f"UPLOAD LOAD TEST  uploads={args.uploads} readers={args.readers} "
+          f"model_latency={args.model_latency}s files={len(samples)}")
+    print("=" * 78)
+    print(summarize("reads (idle)", baseline))
+    print(summarize("reads (under upload)", loaded))
+    print(summarize("uploads", upload_times))
+    ok = sum(1 for s in statuses if s == 200)
+    print(f"uploads ok={ok}/{len(statuses)}  wall={wall:.2f}s  throughput={len(statuses) / wall:.2f} files/s")
+    if fake is not None:
+        print(f"fake openrouter: {dict(fake.counts)}")
+        from ai_provider import provider
+        await provider.close()
+        await fake_runner.cleanup()
+    os.chdir(BACKEND_DIR)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=30)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--model-latency", type=float, default=1.0)
+    parser.add_argument("--baseline-seconds", type=float, default=3.0)
+    parser.add_argument("--seed-rows", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0, help="random seed (latencies, file order)")
+    parser.add_argument("--fake-openrouter", action="store_true",
+                        help="real client stack against benchmarks/fake_openrouter.py")
+    parser.add_argument("--fixtures", help="recorded responses for the fake server (OPENROUTER_RECORD_DIR)")
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--key-rpm", type=float, default=0.0)
+    asyncio.run(run(parser.parse_args()))
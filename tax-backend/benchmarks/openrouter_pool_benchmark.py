@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Benchmark: per-call aiohttp sessions vs. the shared pooled session.
+
+Starts a local stub of the OpenRouter chat-completions endpoint (aiohttp,
+fixed --latency per response) and sends the same calls two ways:
+
+  * per-call  - a new ClientSession per request (how OpenRouterClient used to work)
+  * pooled    - OpenRouterClient.completion on its long-lived session
+
+Reports TCP connections opened (seen by the stub server), connection reuse
+(from the client's trace hooks) and latency percentiles, so the per-call
+setup cost is visible. The stub is plain HTTP on localhost, so the saving
+shown is a floor: against openrouter.ai each new connection also pays DNS
+and a TLS handshake.
+
+Usage:
+    python benchmarks/openrouter_pool_benchmark.py --calls 200 --concurrency 16
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ.setdefault("OPENROUTER_API_KEYS", "sk-or-bench-1,sk-or-bench-2")
+
+import aiohttp
+from aiohttp import web
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1)))))]
+
+
+def summarize(label, samples, connections, extra=""):
+    ms = [s * 1000 for s in samples]
+    return (f"{label:<10} n={len(ms):<5} p50={percentile(ms, 50):7.2f}ms  p95={percentile(ms, 95):7.2f}ms  "
+            f"mean={sum(ms) / len(ms):7.2f}ms  tcp_connections={connections:<5} {extra}")
+
+
+async def start_stub(latency):
+    """Minimal chat-completions endpoint that counts the TCP connections it accepts."""
+    connections = set()
+
+    async def completions(request):
+        connections.add(id(request.transport))
+        await asyncio.sleep(latency)
+        body = await request.json()
+        return web.json_response({
+            "id": "stub", "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11},
+        })
+
+    app = web.Application()
+    app.router.add_post("/api/v1/chat/completions", completions)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/api/v1/chat/completions", connections
+
+
+async def drive(calls, concurrency, one_call):
+    gate = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def worker():
+        async with gate:
+            start = time.perf_counter()
+            await one_call()
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(worker() for _ in range(calls)))
+    return latencies
+
+
+async def run(args):
+    logging.getLogger("OpenRouterClient").setLevel(logging.WARNING)
+    import openrouter_client
+    from openrouter_client import OpenRouterClient
+
+    runner, url, connections = await start_stub(args.latency)
+    openrouter_client.OPENROUTER_BASE_URL = url
+    messages = [{"role": "user", "content": "ping"}]
+    payload = {"model": "stub/model", "messages": messages, "max_tokens": 8}
+
+    async def per_call():
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, json=payload, headers={"Authorization": "Bearer sk-or-bench"}) as response:
+                await response.json()
+
+    client = OpenRouterClient()
+
+    async def pooled():
+        await client.completion(messages, model_id="stub/model", max_tokens=8)
+
+    try:
+        connections.clear()
+        old = await drive(args.calls, args.concurrency, per_call)
+        old_connections = len(connections)
+
+        connections.clear()
+        new = await drive(args.calls, args.concurrency, pooled)
+        new_connections = len(connections)
+        reuse = client.connection_stats.snapshot()
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+    saved = (sum(old) / len(old) - sum(new) / len(new)) * 1000
+    print("=" * 100)
+    print(f"OPENROUTER CONNECTION POOL  calls={args.calls} concurrency={args.concurrency} "
+          f"stub_latency={args.latency * 1000:.0f}ms")
+    print("=" * 100)
+    print(summarize("per-call", old, old_connections))
+    print(summarize("pooled", new, new_connections,
+                    f"reused={reuse['connections_reused']} ({reuse['reuse_ratio']:.0%})"))
+    print(f"mean latency saved per call: {saved:.2f}ms (plain HTTP on localhost - add DNS + TLS in production)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.02, help="stub response latency in seconds")
+    asyncio.run(run(parser.parse_args()))
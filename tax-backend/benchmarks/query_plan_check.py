@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Regression check: no hot query may fall back to a full table scan.
+
+Copies a database (default: the backend's tax_data.db) to a scratch
+directory, brings it to the current schema the way startup does
+(promoted columns, invoices → documents consolidation, workload indexes),
+then runs EXPLAIN QUERY PLAN for every query in query_indexes.HOT_QUERIES.
+Prints each plan and exits 1 if any of them contains a SCAN, so it can
+gate CI. The original database is never touched.
+
+Usage:
+    python benchmarks/query_plan_check.py
+    python benchmarks/query_plan_check.py --db /path/to/tax_data.db --quiet
+"""
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import argparse
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from migrate_database import promote_json_columns, consolidate_invoices_into_documents
+from query_indexes import HOT_QUERIES, ensure_indexes, full_scans, query_plan
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=os.path.join(BACKEND_DIR, "tax_data.db"))
+    parser.add_argument("--quiet", action="store_true", help="only print failing plans")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="query_plan_check_")
+    try:
+        db_path = os.path.join(workdir, "tax_data.db")
+        shutil.copy(args.db, db_path)
+        promote_json_columns(db_path)
+        consolidate_invoices_into_documents(db_path)
+        ensure_indexes(db_path)
+
+        failing = full_scans(db_path)
+        if not args.quiet:
+            conn = sqlite3.connect(db_path)
+            print()
+            for name, (sql, params) in HOT_QUERIES.items():
+                mark = "❌" if name in failing else "✅"
+                print(f"{mark} {name}")
+                for detail in query_plan(conn, sql, params):
+                    print(f"      {detail}")
+            conn.close()
+
+        if failing:
+            print(f"\n❌ {len(failing)} of {len(HOT_QUERIES)} hot queries scan a whole table:")
+            for name, plan in failing.items():
+                print(f"   {name}: {' | '.join(plan)}")
+            sys.exit(1)
+        print(f"\n✅ {len(HOT_QUERIES)} hot queries, no full scans")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Benchmark: sqlite3.connect() per request vs. the WAL connection pool.
+
+Seeds a scratch database with invoice rows, then runs the same mixed
+workload from --threads threads two ways:
+
+  * per-call  - a new sqlite3.connect() per operation, rollback journal,
+                default pragmas (how get_db_connection() and auth.py used to work)
+  * pooled    - db_pool.ConnectionPool: WAL, tuned pragmas, pooled readers,
+                one serialized writer (PooledConnection, like get_db_connection())
+
+Reads look like /history (latest rows, JSON decoded); writes look like
+/manual (one INSERT + commit). Reports throughput, per-kind latency
+percentiles and "database is locked" failures.
+
+Usage:
+    python benchmarks/sqlite_pool_benchmark.py --ops 4000 --threads 8 --write-ratio 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import tempfile
+import argparse
+import threading
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from db_pool import ConnectionPool
+
+READ_SQL = "SELECT id, json_data, payment_status FROM invoices WHERE user_id = ? ORDER BY id DESC LIMIT 50"
+WRITE_SQL = "INSERT INTO invoices (json_data, payment_status, user_id, client_id) VALUES (?, 'Unpaid', ?, ?)"
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1)))))]
+
+
+def invoice_json(rng, i):
+    return json.dumps({
+        "vendor_name": f"Vendor {rng.randint(1, 500)}", "invoice_no": f"INV-{i}",
+        "invoice_date": "2025-04-01", "grand_total": round(rng.uniform(100, 100000), 2),
+        "taxable_value": round(rng.uniform(100, 90000), 2), "hsn_code": "8471", "tax_rate": 18,
+    })
+
+
+def seed(path, rows, rng):
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE invoices (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            json_data TEXT,
+            payment_status TEXT,
+            user_id INTEGER,
+            client_id INTEGER
+        )
+    ''')
+    conn.executemany(
+        "INSERT INTO invoices (json_data, payment_status, user_id, client_id) VALUES (?, 'Unpaid', ?, ?)",
+        [(invoice_json(rng, i), rng.randint(1, 5), rng.randint(1, 40)) for i in range(rows)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def per_call_op(path, kind, rng, i):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    try:
+        if kind == "read":
+            rows = conn.execute(READ_SQL, (rng.randint(1, 5),)).fetchall()
+            [json.loads(r["json_data"]) for r in rows]
+        else:
+            conn.execute(WRITE_SQL, (invoice_json(rng, i), rng.randint(1, 5), rng.randint(1, 40)))
+            conn.commit()
+    finally:
+        conn.close()
+
+
+def pooled_op(pool, kind, rng, i):
+    conn = pool.connection()
+    try:
+        if kind == "read":
+            rows = conn.execute(READ_SQL, (rng.randint(1, 5),)).fetchall()
+            [json.loads(r["json_data"]) for r in rows]
+        else:
+            conn.execute(WRITE_SQL, (invoice_json(rng, i), rng.randint(1, 5), rng.randint(1, 40)))
+            conn.commit()
+    finally:
+        conn.close()
+
+
+def run(label, op, ops, threads, write_ratio, seed_value):
+    latencies = {"read": [], "write": []}
+    errors = {"locked": 0, "other": 0}
+    lock = threading.Lock()
+    counter = iter(range(ops))
+
+    def worker(worker_id):
+        rng = random.Random(seed_value + worker_id)
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            kind = "write" if rng.random() < write_ratio else "read"
+            started = time.perf_counter()
+            try:
+                op(kind, rng, i)
+            except sqlite3.OperationalError as e:
+                with lock:
+                    errors["locked" if "locked" in str(e) else "other"] += 1
+                continue
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies[kind].append(elapsed)
+
+    started = time.perf_counter()
+    pool_threads = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool_threads:
+        t.start()
+    for t in pool_threads:
+        t.join()
+    wall = time.perf_counter() - started
+
+    done = len(latencies["read"]) + len(latencies["write"])
+    print(f"{label:<9} {done / wall:8.0f} ops/s  wall={wall:6.2f}s  locked={errors['locked']:<4} other_errors={errors['other']}")
+    for kind in ("read", "write"):
+        ms = [s * 1000 for s in latencies[kind]]
+        if ms:
+            print(f"          {kind:<5} n={len(ms):<6} p50={percentile(ms, 50):7.2f}ms  p95={percentile(ms, 95):7.2f}ms  "
+                  f"p99={percentile(ms, 99):7.2f}ms")
+    return done / wall
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ops", type=int, default=4000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--rows", type=int, default=20000, help="invoices seeded before the run")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="sqlite_pool_bench_")
+    try:
+        template = os.path.join(workdir, "template.db")
+        seed(template, args.rows, random.Random(args.seed))
+        per_call_db = os.path.join(workdir, "per_call.db")
+        pooled_db = os.path.join(workdir, "pooled.db")
+        shutil.copy(template, per_call_db)
+        shutil.copy(template, pooled_db)
+
+        print(f"🗄️ {args.rows} seeded rows, {args.ops} ops, {args.threads} threads, "
+              f"{args.write_ratio:.0%} writes\n")
+        baseline = run("per-call", lambda kind, rng, i: per_call_op(per_call_db, kind, rng, i),
+                       args.ops, args.threads, args.write_ratio, args.seed)
+        pool = ConnectionPool(pooled_db)
+        pooled = run("pooled", lambda kind, rng, i: pooled_op(pool, kind, rng, i),
+                     args.ops, args.threads, args.write_ratio, args.seed)
+        print(f"\n   pool: {pool.stats()}")
+        pool.close()
+        print(f"   speed-up: {pooled / baseline:.2f}x")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
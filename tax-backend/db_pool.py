@@ -0,0 +1,305 @@
+# db_pool.py
+# -----------------------------------------------------------------------------
+# SQLITE CONNECTION POOL - WAL, tuned pragmas, one serialized writer
+# Connections are opened once and reused instead of sqlite3.connect() per
+# request. The database runs in WAL mode, so readers never wait for a writer.
+# Reads use pooled read-only connections; every write goes through the one
+# writer connection, which is held by one caller at a time (a lock), so writes
+# queue in-process instead of spinning on SQLite's "database is locked".
+# `pool.connection()` wraps both for the existing `conn = get_db_connection()`
+# ... `conn.commit()` / `conn.close()` code in main.py.
+# -----------------------------------------------------------------------------
+
+import os
+import re
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# Idle read connections kept per database (more are opened on demand, then closed)
+READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "8"))
+
+# How long a statement waits on a lock held by another process (ms), and how
+# long a caller waits for the in-process writer
+BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# Memory-mapped I/O and page cache per connection
+MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+
+# Applied once when a connection is opened. synchronous=NORMAL is safe in
+# WAL mode (a power cut can lose the last commits, never corrupt the file).
+PRAGMAS = (
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA mmap_size = {MMAP_SIZE}",
+    f"PRAGMA cache_size = -{CACHE_SIZE_KB}",
+    "PRAGMA temp_store = MEMORY",
+)
+
+_READ_STATEMENT = re.compile(r"^\s*(?:--[^\n]*\n\s*)*(SELECT|EXPLAIN|VALUES|WITH|PRAGMA)\b", re.IGNORECASE)
+_WRITE_KEYWORD = re.compile(r"\b(INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)
+
+
+def is_read_only(sql: str) -> bool:
+    """True for statements a read-only connection can run (SELECT, PRAGMA without =, ...)."""
+    match = _READ_STATEMENT.match(sql)
+    if not match:
+        return False
+    keyword = match.group(1).upper()
+    if keyword == "WITH":
+        return not _WRITE_KEYWORD.search(sql)
+    if keyword == "PRAGMA":
+        return "=" not in sql
+    return True
+
+
+class ConnectionPool:
+    """Read connections (pooled, query_only) + one lock-guarded writer for one database file."""
+
+    def __init__(self, db_path: str = "tax_data.db", read_pool_size: int = READ_POOL_SIZE):
+        self.db_path = db_path
+        self.read_pool_size = read_pool_size
+        self._idle: List[sqlite3.Connection] = []
+        self._idle_lock = threading.Lock()
+        self._writer: Optional[sqlite3.Connection] = None
+        self._writer_lock = threading.Lock()
+        self._wal_ready = False
+        # Per-process counters for stats
+        self.opened = 0
+        self.reused = 0
+        self.writes = 0
+        self.writer_wait_seconds = 0.0
+
+    def _open(self, read_only: bool) -> sqlite3.Connection:
+        # Pooled connections move between the event loop and executor threads;
+        # the pool guarantees one user at a time
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        if not self._wal_ready:
+            # Persistent property of the file - set once, before any query_only connection
+            conn.execute("PRAGMA journal_mode = WAL")
+            self._wal_ready = True
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        if read_only:
+            conn.execute("PRAGMA query_only = ON")
+        self.opened += 1
+        return conn
+
+    # -------------------------------------------------------------------------
+    # Readers
+    # -------------------------------------------------------------------------
+
+    def acquire_reader(self) -> sqlite3.Connection:
+        """An idle read connection, or a new one. Never blocks."""
+        with self._idle_lock:
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop()
+        return self._open(read_only=True)
+
+    def release_reader(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._idle_lock:
+            if len(self._idle) < self.read_pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def read(self) -> Iterator[sqlite3.Connection]:
+        """`with pool.read() as conn:` - a read-only connection (writes raise)."""
+        conn = self.acquire_reader()
+        try:
+            yield conn
+        finally:
+            self.release_reader(conn)
+
+    # -------------------------------------------------------------------------
+    # Writer
+    # -------------------------------------------------------------------------
+
+    def acquire_writer(self) -> sqlite3.Connection:
+        """
+        The writer connection, once no one else holds it (OperationalError after BUSY_TIMEOUT_MS).
+        Blocks the calling thread while it waits - call from the DB/I/O threads
+        (repositories.run_db, offload.run_blocking), never on the event loop.
+        """
+        started = time.monotonic()
+        if not self._writer_lock.acquire(timeout=BUSY_TIMEOUT_MS / 1000):
+            raise sqlite3.OperationalError("database is locked (writer busy)")
+        self.writer_wait_seconds += time.monotonic() - started
+        self.writes += 1
+        try:
+            if self._writer is None:
+                self._writer = self._open(read_only=False)
+        except Exception:
+            self._writer_lock.release()
+            raise
+        return self._writer
+
+    def release_writer(self, commit: bool):
+        conn = self._writer
+        try:
+            if conn is not None and conn.in_transaction:
+                if commit:
+                    conn.commit()
+                else:
+                    conn.rollback()
+        finally:
+            self._writer_lock.release()
+
+    @contextmanager
+    def write(self) -> Iterator[sqlite3.Connection]:
+        """`with pool.write() as conn:` - the writer; commits on success, rolls back on error."""
+        conn = self.acquire_writer()
+        ok = False
+        try:
+            yield conn
+            ok = True
+        finally:
+            self.release_writer(commit=ok)
+
+    def connection(self) -> "PooledConnection":
+        """A sqlite3.Connection look-alike for code that mixes reads and writes."""
+        return PooledConnection(self)
+
+    def close(self):
+        with self._idle_lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "db_path": self.db_path,
+            "opened": self.opened,
+            "reused": self.reused,
+            "idle_readers": len(self._idle),
+            "writes": self.writes,
+            "writer_wait_seconds": round(self.writer_wait_seconds, 3),
+        }
+
+
+class PooledCursor:
+    """Cursor over a PooledConnection: each execute goes to the reader or the writer."""
+
+    def __init__(self, owner: "PooledConnection"):
+        self._owner = owner
+        self._cursor: Optional[sqlite3.Cursor] = None
+
+    def execute(self, sql: str, parameters: Any = ()) -> "PooledCursor":
+        self._cursor = self._owner.execute(sql, parameters)
+        return self
+
+    def executemany(self, sql: str, seq_of_parameters: Any) -> "PooledCursor":
+        self._cursor = self._owner.executemany(sql, seq_of_parameters)
+        return self
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name: str) -> Any:
+        # fetchone / fetchall / lastrowid / rowcount / description of the last statement
+        return getattr(self._cursor, name)
+
+
+class PooledConnection:
+    """
+    Reads run on a pooled read connection. The first write takes the writer
+    (and the writer lock) until commit(), rollback() or close(); statements
+    in between - reads included - use the writer, so they see their own
+    uncommitted rows. close() hands everything back (uncommitted writes are
+    rolled back, like sqlite3).
+    """
+
+    def __init__(self, pool: ConnectionPool):
+        self._pool = pool
+        self._reader: Optional[sqlite3.Connection] = None
+        self._writer: Optional[sqlite3.Connection] = None
+        self.row_factory = sqlite3.Row
+
+    def _route(self, sql: str) -> sqlite3.Connection:
+        if self._writer is None and not is_read_only(sql):
+            self._writer = self._pool.acquire_writer()
+        if self._writer is not None:
+            return self._writer
+        if self._reader is None:
+            self._reader = self._pool.acquire_reader()
+        return self._reader
+
+    def _cursor_for(self, sql: str) -> sqlite3.Cursor:
+        cursor = self._route(sql).cursor()
+        cursor.row_factory = self.row_factory
+        return cursor
+
+    def execute(self, sql: str, parameters: Any = ()) -> sqlite3.Cursor:
+        return self._cursor_for(sql).execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters: Any) -> sqlite3.Cursor:
+        return self._cursor_for(sql).executemany(sql, seq_of_parameters)
+
+    def executescript(self, script: str) -> sqlite3.Cursor:
+        if self._writer is None:
+            self._writer = self._pool.acquire_writer()
+        return self._writer.executescript(script)
+
+    def cursor(self) -> PooledCursor:
+        return PooledCursor(self)
+
+    def commit(self):
+        if self._writer is not None:
+            self._writer = None
+            self._pool.release_writer(commit=True)
+
+    def rollback(self):
+        if self._writer is not None:
+            self._writer = None
+            self._pool.release_writer(commit=False)
+
+    def close(self):
+        self.rollback()
+        if self._reader is not None:
+            reader, self._reader = self._reader, None
+            self._pool.release_reader(reader)
+
+    def __del__(self):
+        # A forgotten close() must not keep the writer lock forever
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path: str = "tax_data.db") -> ConnectionPool:
+    """The shared pool for a database file (one per path per process)."""
+    key = os.path.abspath(db_path)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(db_path)
+        return pool
+
+
+def close_pools():
+    """Close every pooled connection (app shutdown)."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
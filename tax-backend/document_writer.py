@@ -0,0 +1,196 @@
+# document_writer.py
+# -----------------------------------------------------------------------------
+# BATCHED DOCUMENT WRITER - Multi-row inserts into documents
+# Used by the pipeline save stage so a bulk upload commits once per batch
+# instead of once per bill (SQLite has a single writer lock)
+# -----------------------------------------------------------------------------
+
+import json
+import sqlite3
+from typing import Dict, Any, List, Optional
+
+# json_data fields that exports and aggregates read, mirrored into real columns
+# on documents, which the invoices view exposes (migrate_database.promote_json_columns backfills them)
+PROMOTED_COLUMNS = {
+    "taxable_value": "REAL",
+    "cgst_amount": "REAL",
+    "sgst_amount": "REAL",
+    "igst_amount": "REAL",
+    "tax_rate": "REAL",
+    "place_of_supply": "TEXT",
+    "vendor_state": "TEXT",
+    "gst_no": "TEXT",
+}
+
+# Promoted columns not already in the insert list below
+_TAX_COLUMNS = ["cgst_amount", "sgst_amount", "igst_amount", "tax_rate", "place_of_supply", "vendor_state"]
+
+# Columns written for every pipeline document (same set /upload writes)
+DOCUMENT_COLUMNS = [
+    "client_id", "vendor_id", "doc_type", "invoice_no", "invoice_date", "vendor_name", "gst_no",
+    "grand_total", "taxable_value", "tax_amount", "hsn_code", "ledger_name", "group_name",
+    "review_status", "confidence_level", "entered_by", "file_path", "file_type", "file_size",
+    "payment_status", "json_data", "user_id",
+] + _TAX_COLUMNS
+
+# Keep each statement well under SQLite's bound-variable limit
+MAX_ROWS_PER_STATEMENT = 500
+
+
+def to_real(value: Any) -> Optional[float]:
+    """'₹1,180.00' / '18%' / 1180 → float; empty or unreadable → None (NULL, not 0)."""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return float(str(value).replace(",", "").replace("₹", "").replace("%", "").strip())
+    except ValueError:
+        return None
+
+
+def promoted_values(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Column values for PROMOTED_COLUMNS from one invoice's json_data dict."""
+    values = {}
+    for column, sql_type in PROMOTED_COLUMNS.items():
+        value = data.get(column)
+        if sql_type == "REAL":
+            values[column] = to_real(value)
+        else:
+            values[column] = value if value is None or isinstance(value, str) else str(value)
+    return values
+
+
+def tax_values(data: Dict[str, Any]) -> tuple:
+    """promoted_values in _TAX_COLUMNS order (the tail of DOCUMENT_COLUMNS)."""
+    values = promoted_values(data)
+    return tuple(values[column] for column in _TAX_COLUMNS)
+
+
+def review_status_for(confidence_level: str) -> str:
+    """Same auto-approval rule as the sync /upload path."""
+    if confidence_level == 'high':
+        return 'approved'
+    if confidence_level == 'medium':
+        return 'pending'
+    return 'needs_review'
+
+
+def file_type_for(filename: str) -> str:
+    file_ext = (filename or '').split('.')[-1].lower()
+    return 'pdf' if file_ext == 'pdf' else 'image' if file_ext in ['jpg', 'jpeg', 'png'] else 'other'
+
+
+def _duplicate_key(data: Dict, client_id: Optional[int]):
+    """Mirrors `invoice_no = ? AND gst_no = ? AND client_id = ?` (NULL never matches)."""
+    if data.get('invoice_no') is None or data.get('gst_no') is None or client_id is None:
+        return None
+    return (data.get('invoice_no'), data.get('gst_no'), client_id)
+
+
+def _resolve_vendor_ids(conn: sqlite3.Connection, names: List[str]) -> Dict[str, int]:
+    """Get-or-create vendors for a batch without intermediate commits."""
+    vendor_ids: Dict[str, int] = {}
+    for name in names:
+        key = name.lower()
+        if key in vendor_ids:
+            continue
+        row = conn.execute("SELECT id FROM vendors WHERE LOWER(vendor_name) = LOWER(?)", (name,)).fetchone()
+        if row:
+            vendor_ids[key] = row[0]
+        else:
+            cursor = conn.execute("INSERT INTO vendors (vendor_name, frequency_count) VALUES (?, 0)", (name,))
+            vendor_ids[key] = cursor.lastrowid
+            print(f"✅ Auto-created vendor: {name}")
+    return vendor_ids
+
+
+def _insert_many(conn: sqlite3.Connection, table: str, columns: List[str], rows: List[tuple],
+                 returning_id: bool = False) -> List[int]:
+    """One multi-row INSERT per chunk. Returns new ids in row order when asked."""
+    ids: List[int] = []
+    placeholders = "(" + ", ".join("?" for _ in columns) + ")"
+    for start in range(0, len(rows), MAX_ROWS_PER_STATEMENT):
+        chunk = rows[start:start + MAX_ROWS_PER_STATEMENT]
+        sql = (f"INSERT INTO {table} ({', '.join(columns)}) VALUES "
+               + ", ".join(placeholders for _ in chunk))
+        params = [value for row in chunk for value in row]
+        if returning_id:
+            # We hold the write lock, so one statement gets ascending rowids in VALUES order
+            new_ids = sorted(r[0] for r in conn.execute(sql + " RETURNING id", params).fetchall())
+            ids.extend(new_ids)
+        else:
+            conn.execute(sql, params)
+    return ids
+
+
+def insert_documents_batch(conn: sqlite3.Connection, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Insert a batch of processed bills into documents (the invoices view shows them too).
+    Does NOT commit - the caller owns the transaction.
+
+    Each record: {"data": final_result, "client_id", "user_id", "doc_type", "entered_by",
+                  "file_path", "file_type", "file_size", "confidence_level"}
+    Returns one dict per record: {"id", "vendor_id", "review_status", "duplicate"}
+    """
+    outcomes: List[Dict[str, Any]] = [{"id": None, "vendor_id": None, "review_status": None, "duplicate": False}
+                                      for _ in records]
+
+    # 1. Duplicate check (against the table and within this batch)
+    seen = set()
+    fresh: List[int] = []
+    for i, rec in enumerate(records):
+        key = _duplicate_key(rec["data"], rec.get("client_id"))
+        if key is not None:
+            exists = key in seen or conn.execute(
+                "SELECT id FROM documents WHERE invoice_no = ? AND gst_no = ? AND client_id = ?", key
+            ).fetchone()
+            if exists:
+                outcomes[i]["duplicate"] = True
+                continue
+            seen.add(key)
+        fresh.append(i)
+
+    if not fresh:
+        return outcomes
+
+    # 2. Vendors
+    names = [records[i]["data"].get("vendor_name") for i in fresh if records[i]["data"].get("vendor_name")]
+    vendor_ids = _resolve_vendor_ids(conn, names)
+
+    # 3. documents (one multi-row insert)
+    doc_rows = []
+    for i in fresh:
+        rec = records[i]
+        data = rec["data"]
+        confidence_level = rec.get("confidence_level") or 'medium'
+        review_status = review_status_for(confidence_level)
+        vendor_id = vendor_ids.get((data.get("vendor_name") or "").lower())
+        outcomes[i].update(vendor_id=vendor_id, review_status=review_status)
+        doc_rows.append((
+            rec.get("client_id"), vendor_id, rec.get("doc_type", "gst_invoice"), data.get('invoice_no'),
+            data.get('invoice_date'), data.get('vendor_name'), data.get('gst_no'), data.get('grand_total'),
+            to_real(data.get('taxable_value')), data.get('tax_amount'), data.get('hsn_code'),
+            data.get('ledger_name'), data.get('group_name'), review_status, confidence_level,
+            rec.get("entered_by"), rec.get("file_path"), rec.get("file_type"), rec.get("file_size"),
+            'Unpaid', json.dumps(data), rec.get("user_id")
+        ) + tax_values(data))
+    new_ids = _insert_many(conn, "documents", DOCUMENT_COLUMNS, doc_rows, returning_id=True)
+    for i, new_id in zip(fresh, new_ids):
+        outcomes[i]["id"] = new_id
+
+    # 4. Vendor usage + client activity, one statement each
+    used_vendor_ids = [outcomes[i]["vendor_id"] for i in fresh if outcomes[i]["vendor_id"]]
+    if used_vendor_ids:
+        conn.executemany('''
+            UPDATE vendors
+            SET frequency_count = frequency_count + 1,
+                last_used_date = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', [(vid,) for vid in used_vendor_ids])
+    client_ids = sorted({records[i].get("client_id") for i in fresh if records[i].get("client_id")})
+    if client_ids:
+        conn.execute(
+            f"UPDATE clients SET last_activity_date = CURRENT_TIMESTAMP WHERE id IN ({', '.join('?' for _ in client_ids)})",
+            client_ids
+        )
+
+    return outcomes
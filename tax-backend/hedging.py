@@ -0,0 +1,194 @@
+# hedging.py
+# -----------------------------------------------------------------------------
+# HEDGED MODEL CALLS - Cut the latency tail of free-tier models
+# A call walks a per-task chain of models (primary first). If the model in
+# flight hasn't answered by its own p90 latency, the next model in the chain
+# is fired as well; the first good answer wins and the rest are cancelled.
+# A model that fails hands over to the next one straight away.
+# Per-model latency histograms (log buckets, decayed) set the hedge delay.
+# -----------------------------------------------------------------------------
+
+import os
+import time
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+from priority_lanes import current_lane, INTERACTIVE, ONLINE
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# Set AI_HEDGE_ENABLED=0 to only fall back on errors (never fire a second request early)
+ENABLED = os.getenv("AI_HEDGE_ENABLED", "1") != "0"
+
+# Hedge once the model in flight is slower than this quantile of its history
+HEDGE_QUANTILE = float(os.getenv("AI_HEDGE_QUANTILE", "0.9"))
+
+# Until a model has this many samples its delay is AI_HEDGE_DEFAULT_DELAY
+MIN_SAMPLES = int(os.getenv("AI_HEDGE_MIN_SAMPLES", "20"))
+DEFAULT_DELAY_SECONDS = float(os.getenv("AI_HEDGE_DEFAULT_DELAY", "20"))
+
+# Clamp on the learned delay (a hedge every 0.5s would just double the load)
+MIN_DELAY_SECONDS = float(os.getenv("AI_HEDGE_MIN_DELAY", "2"))
+MAX_DELAY_SECONDS = float(os.getenv("AI_HEDGE_MAX_DELAY", "60"))
+
+# Lanes allowed to hedge - bulk work would only double its own quota use
+HEDGE_LANES = set(os.getenv("AI_HEDGE_LANES", f"{INTERACTIVE},{ONLINE}").split(","))
+
+# Histogram: buckets grow by 25% from 0.25s (last bucket ≈ 200s); counts are
+# halved whenever a model passes HISTOGRAM_WINDOW samples so it tracks drift
+BUCKET_BOUNDS = [0.25 * (1.25 ** i) for i in range(31)]
+HISTOGRAM_WINDOW = int(os.getenv("AI_HEDGE_HISTOGRAM_WINDOW", "500"))
+
+
+# Models that answered hedged calls inside `record_models()` (shared list, so
+# calls made from child tasks - parallel PDF pages - land in it too)
+_answered: ContextVar[Optional[List[str]]] = ContextVar("hedge_answered", default=None)
+
+
+@contextmanager
+def record_models() -> Iterator[List[str]]:
+    """`with record_models() as answered:` - every model that wins a hedged call inside is appended."""
+    answered: List[str] = []
+    token = _answered.set(answered)
+    try:
+        yield answered
+    finally:
+        _answered.reset(token)
+
+
+class LatencyHistogram:
+    """Log-bucketed latency counts for one model, exponentially decayed."""
+
+    def __init__(self):
+        self.counts = [0.0] * (len(BUCKET_BOUNDS) + 1)
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        index = len(BUCKET_BOUNDS)
+        for i, bound in enumerate(BUCKET_BOUNDS):
+            if seconds <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.total += 1
+        if self.total >= HISTOGRAM_WINDOW:
+            self.counts = [c / 2 for c in self.counts]
+            self.total /= 2
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding quantile q (None if empty)."""
+        if not self.total:
+            return None
+        target = q * self.total
+        seen = 0.0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return BUCKET_BOUNDS[min(i, len(BUCKET_BOUNDS) - 1)]
+        return BUCKET_BOUNDS[-1]
+
+
+class Hedger:
+    """Runs one model call across a fallback chain with latency-driven hedging."""
+
+    def __init__(self):
+        self._histograms: Dict[str, LatencyHistogram] = {}
+        self.calls = 0
+        self.hedges = 0           # second request fired because the first was slow
+        self.fallbacks = 0        # next model started because the previous one failed
+        self.fallback_wins = 0    # answered by a model other than the primary
+        self.cancelled = 0        # losing requests cancelled
+
+    def observe(self, model: str, seconds: float):
+        self._histograms.setdefault(model, LatencyHistogram()).observe(seconds)
+
+    def hedge_delay(self, model: str) -> float:
+        """Seconds to wait on `model` before hedging: its p90 once it has history."""
+        histogram = self._histograms.get(model)
+        if histogram is None or histogram.total < MIN_SAMPLES:
+            return DEFAULT_DELAY_SECONDS
+        return min(MAX_DELAY_SECONDS, max(MIN_DELAY_SECONDS, histogram.quantile(HEDGE_QUANTILE)))
+
+    async def run(self, chain: List[str], call: Callable[[str], Awaitable[Any]], lane: Optional[str] = None) -> Any:
+        """
+        `await hedger.run([primary, fallback, ...], lambda model: ...)` - result of
+        the first model to answer. Raises the last error if every model failed.
+        """
+        if not chain:
+            raise ValueError("Empty model chain")
+        hedging = ENABLED and (lane or current_lane()) in HEDGE_LANES
+        running: Dict[asyncio.Task, Tuple[str, float]] = {}
+        launched = 0
+        last_error: Optional[BaseException] = None
+        self.calls += 1
+
+        def launch() -> str:
+            nonlocal launched
+            model = chain[launched]
+            launched += 1
+            running[asyncio.ensure_future(call(model))] = (model, time.monotonic())
+            return model
+
+        launch()
+        try:
+            while running:
+                timeout = None
+                if hedging and launched < len(chain):
+                    # The hedge clock runs on the most recently started request
+                    newest, started = max(running.values(), key=lambda item: item[1])
+                    timeout = max(0.0, self.hedge_delay(newest) - (time.monotonic() - started))
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.hedges += 1
+                    print(f"🪁 {newest} slower than its p{int(HEDGE_QUANTILE * 100)} - hedging with {launch()}")
+                    continue
+                for task in done:
+                    model, started = running.pop(task)
+                    if task.exception() is None:
+                        self.observe(model, time.monotonic() - started)
+                        if model != chain[0]:
+                            self.fallback_wins += 1
+                        answered = _answered.get()
+                        if answered is not None:
+                            answered.append(model)
+                        return task.result()
+                    last_error = task.exception()
+                    print(f"⚠️ {model} failed: {last_error}")
+                if not running and launched < len(chain):
+                    self.fallbacks += 1
+                    print(f"↪️ Falling back to {launch()}")
+            raise last_error
+        finally:
+            for task, (model, started) in running.items():
+                task.cancel()
+                # A cancelled loser took at least this long - keeps the slow tail in the histogram
+                self.observe(model, time.monotonic() - started)
+                self.cancelled += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        models = {}
+        for model, histogram in self._histograms.items():
+            models[model] = {
+                "samples": round(histogram.total, 1),
+                "p50": round(histogram.quantile(0.5), 3),
+                "p90": round(histogram.quantile(0.9), 3),
+                "hedge_delay": round(self.hedge_delay(model), 2),
+            }
+        return {
+            "enabled": ENABLED,
+            "quantile": HEDGE_QUANTILE,
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "fallbacks": self.fallbacks,
+            "fallback_wins": self.fallback_wins,
+            "cancelled": self.cancelled,
+            "models": models,
+        }
+
+
+# Global instance (latency history is shared by every caller)
+hedger = Hedger()
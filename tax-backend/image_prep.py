@@ -0,0 +1,193 @@
+# image_prep.py
+# -----------------------------------------------------------------------------
+# IMAGE PRE-PROCESSING - Shrinks what we send to the vision model
+# Deskew → crop margins → grayscale → downscale → JPEG/WebP within a byte budget.
+# A 200 dpi PNG page of several MB becomes a few hundred KB of JPEG, which
+# base64 (+33%) and the OpenRouter upload feel directly.
+# Pure Pillow, runs in the offload process pool.
+# -----------------------------------------------------------------------------
+
+import os
+from io import BytesIO
+from typing import Any, Dict, Tuple
+
+from offload import run_cpu_bound, run_blocking, render_pdf_page_png, encode_base64
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# Set IMAGE_PREP_ENABLED=0 to send uploads to the model untouched
+ENABLED = os.getenv("IMAGE_PREP_ENABLED", "1") != "0"
+
+# Long edge after downscaling. Qwen2.5-VL reads invoice text reliably at this size
+# and bills by image tokens, so anything larger is cost without accuracy.
+MAX_DIMENSION = int(os.getenv("IMAGE_PREP_MAX_DIMENSION", "1600"))
+
+# Target encoded size. Quality steps down, then the image shrinks, until it fits.
+BYTE_BUDGET = int(os.getenv("IMAGE_PREP_BYTE_BUDGET", str(400 * 1024)))
+
+# "jpeg" (accepted by every provider) or "webp" (smaller, not universally supported)
+OUTPUT_FORMAT = os.getenv("IMAGE_PREP_FORMAT", "jpeg").lower()
+
+GRAYSCALE = os.getenv("IMAGE_PREP_GRAYSCALE", "1") != "0"
+
+# Deskew search range (degrees) - phone photos of bills are rarely off by more
+MAX_SKEW_DEGREES = float(os.getenv("IMAGE_PREP_MAX_SKEW", "5"))
+
+QUALITY_STEPS = (85, 75, 65, 55, 45)
+MIN_DIMENSION = 800
+
+# Pixels darker than this count as ink for cropping / deskew
+INK_THRESHOLD = 200
+CROP_PADDING = 12
+
+_MIME = {"jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+# =============================================================================
+# STEPS
+# =============================================================================
+
+def _ink_mask(gray):
+    """1-bit-like mask: ink = 255, paper = 0."""
+    return gray.point(lambda v: 255 if v < INK_THRESHOLD else 0)
+
+
+def _row_profile_score(mask) -> float:
+    """Variance of row ink density - highest when text lines are horizontal."""
+    from PIL import Image
+    rows = list(mask.resize((1, mask.height), Image.BOX).getdata())
+    mean = sum(rows) / len(rows)
+    return sum((r - mean) ** 2 for r in rows) / len(rows)
+
+
+def estimate_skew(gray) -> float:
+    """
+    Projection-profile deskew on a small copy: try rotations, keep the one
+    whose rows are most sharply "on/off". Coarse 1° sweep, then 0.25° refine.
+    """
+    from PIL import Image
+    small = gray.copy()
+    small.thumbnail((600, 600))
+    mask = _ink_mask(small)
+
+    def score(angle: float) -> float:
+        return _row_profile_score(mask.rotate(angle, resample=Image.NEAREST, expand=False, fillcolor=0))
+
+    span = int(MAX_SKEW_DEGREES)
+    best = max(range(-span, span + 1), key=score)
+    fine = [best + step / 4 for step in range(-4, 5)]
+    return max(fine, key=score)
+
+
+def rotate(image, angle: float):
+    from PIL import Image
+    if abs(angle) < 0.25:
+        return image
+    white = 255 if image.mode == "L" else (255, 255, 255)
+    return image.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=white)
+
+
+def content_box(gray):
+    """Bounding box of the ink plus a small padding, or None to keep the whole image."""
+    box = _ink_mask(gray).getbbox()
+    if not box:
+        return None
+    left, top, right, bottom = box
+    left, top = max(0, left - CROP_PADDING), max(0, top - CROP_PADDING)
+    right, bottom = min(gray.width, right + CROP_PADDING), min(gray.height, bottom + CROP_PADDING)
+    # Don't "crop" to a speck of noise
+    if (right - left) * (bottom - top) < 0.2 * gray.width * gray.height:
+        return None
+    return (left, top, right, bottom)
+
+
+def downscale(image, max_dimension: int):
+    from PIL import Image
+    if max(image.size) <= max_dimension:
+        return image
+    image = image.copy()
+    image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    return image
+
+
+def encode_within_budget(image, fmt: str = OUTPUT_FORMAT, budget: int = BYTE_BUDGET) -> bytes:
+    """Step quality down, then dimensions, until the encoding fits the budget."""
+    from PIL import Image
+    fmt = fmt if fmt in _MIME else "jpeg"
+    encoded = b""
+    while True:
+        for quality in QUALITY_STEPS:
+            buffer = BytesIO()
+            image.save(buffer, format=fmt.upper(), quality=quality, optimize=(fmt == "jpeg"))
+            encoded = buffer.getvalue()
+            if len(encoded) <= budget:
+                return encoded
+        if max(image.size) <= MIN_DIMENSION:
+            return encoded
+        image = image.resize((int(image.width * 0.85), int(image.height * 0.85)), Image.LANCZOS)
+
+
+# =============================================================================
+# WORK UNITS (top-level so they pickle into the process pool)
+# =============================================================================
+
+def preprocess_image(file_bytes: bytes) -> Tuple[bytes, str]:
+    """Full pre-processing of one image. Returns (encoded bytes, mime type)."""
+    from PIL import Image, ImageOps
+    image = Image.open(BytesIO(file_bytes))
+    # WebP in stays WebP (it was already going to the model as WebP, and JPEG would be larger)
+    fmt = "webp" if image.format == "WEBP" else OUTPUT_FORMAT if OUTPUT_FORMAT in _MIME else "jpeg"
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA", "P"):
+        # Flatten transparency onto white paper
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    gray = image.convert("L")
+
+    # Geometry is measured on the grayscale copy and applied to the output
+    angle = estimate_skew(gray)
+    gray = rotate(gray, angle)
+    output = gray if GRAYSCALE else rotate(image.convert("RGB"), angle)
+    box = content_box(gray)
+    if box:
+        output = output.crop(box)
+    output = downscale(output, MAX_DIMENSION)
+    return encode_within_budget(output, fmt), _MIME[fmt]
+
+
+def render_pdf_page_for_vision(file_bytes: bytes, dpi: int, page: int) -> Tuple[bytes, str]:
+    """Rasterize + pre-process in one pool hop (the big PNG never leaves the worker)."""
+    png = render_pdf_page_png(file_bytes, dpi, page)
+    if not ENABLED:
+        return png, "image/png"
+    return preprocess_image(png)
+
+
+# =============================================================================
+# ASYNC ENTRY POINT
+# =============================================================================
+
+async def prepare_for_vision(file_bytes: bytes, mime_type: str) -> Tuple[str, str]:
+    """
+    Pre-process an image upload and base64 it for the vision model.
+    Returns (b64_data, mime_type). Anything Pillow can't read is sent as-is.
+    """
+    if ENABLED:
+        try:
+            file_bytes, mime_type = await run_cpu_bound(preprocess_image, file_bytes)
+        except Exception as e:
+            print(f"⚠️ Image pre-processing skipped: {e}")
+    return await run_blocking(encode_base64, file_bytes), mime_type
+
+
+def settings() -> Dict[str, Any]:
+    return {
+        "enabled": ENABLED,
+        "max_dimension": MAX_DIMENSION,
+        "byte_budget": BYTE_BUDGET,
+        "format": OUTPUT_FORMAT,
+        "grayscale": GRAYSCALE,
+    }
@@ -6,7 +6,7 @@
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from typing import Optional
@@ -19,10 +19,11 @@ import shutil
 import os
 import uuid
 import io
+import asyncio
 import pypdf
 from datetime import datetime
 from difflib import SequenceMatcher
-from typing import List, Tuple
+from typing import List, Tuple, NamedTuple
 from fastapi.responses import JSONResponse
 
 # --- MULTI-MODEL AI CONFIGURATION ---
@@ -31,10 +32,52 @@ from ai_config import (
     call_logic_model,        # Hermes 3 405B for reasoning
     call_chat_model,         # Llama 3.1 405B for chat
     call_fast_chat_model,    # Llama 3.2 8B for FAST chat (NEW)
-    clean_json_response,
-    encode_image_to_base64
+    stream_chat_model,       # Token stream from either chat model
+    encode_image_to_base64,
+    MODELS as AI_MODELS
 )
 
+# --- BLOCKING WORK OFFLOAD (thread/process pools + upload limit) ---
+from offload import (
+    upload_slots,
+    run_blocking,
+    encode_base64,
+    read_file,
+    shutdown_executors
+)
+
+# --- PRIORITY LANES (interactive / online / bulk model calls) ---
+from priority_lanes import set_lane, INTERACTIVE
+
+# --- HEDGED MODEL CALLS (latency histograms + fallback chains) ---
+from hedging import hedger, record_models
+from usage_ledger import usage_ledger, attribute, set_attribution, GROUP_COLUMNS
+from db_pool import get_pool, close_pools
+
+# --- ASYNC DATA ACCESS (repositories run their SQL on the DB thread pool) ---
+from repositories import invoice_repo, client_repo, vendor_repo, document_repo, run_db, on_db_thread, shutdown_db_executor
+from document_writer import to_real, tax_values
+from migrate_database import promote_json_columns, consolidate_invoices_into_documents
+from query_indexes import ensure_indexes
+
+# --- PAGE-AWARE PDF INGESTION (text layer first, parallel page rasterization) ---
+from pdf_ingest import extract_pdf
+
+# --- STRUCTURED EXTRACTION (schema JSON mode, tolerant parser, targeted follow-ups) ---
+from structured_output import extract_invoice_fields, missing_critical, parse_json_tolerant
+
+# --- IMAGE PRE-PROCESSING (smaller vision payloads) ---
+from image_prep import prepare_for_vision
+
+# --- CONTENT-ADDRESSED UPLOAD STORAGE (streamed writes + refcounts) ---
+from upload_store import save_upload, upload_store
+
+# --- OCR RESULT CACHE (SHA-256 of the upload → extraction) ---
+from ocr_cache import ocr_cache, content_hash, cache_version, cacheable
+
+# --- LOGIC-MODEL RESPONSE CACHE (normalized vendor/HSN → classification) ---
+from response_cache import response_cache, response_key, vendor_key, normalize_text
+
 # --- AUTHENTICATION MODULE ---
 from auth import (
     authenticate_user,
@@ -470,6 +513,9 @@ def init_db():
             is_exported_to_tally BOOLEAN DEFAULT 0,
             json_data TEXT,
             upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            user_id INTEGER,
+            show_in_history INTEGER DEFAULT 1,
+            legacy_invoice_id INTEGER,
             FOREIGN KEY (client_id) REFERENCES clients(id),
             FOREIGN KEY (vendor_id) REFERENCES vendors(id)
         )
@@ -563,49 +609,38 @@ def init_db():
     ''')
     
     # ========================================================================
-    # LEGACY TABLE: Keep old invoices table for backward compatibility
+    # LEGACY TABLE: invoices is a view over documents now
+    # (migrate_database.consolidate_invoices_into_documents, run below).
+    # A database from before that still has the table - bring it up to date
+    # so the migration can copy it.
     # ========================================================================
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS invoices (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            invoice_no TEXT,
-            gst_no TEXT,
-            invoice_date TEXT,
-            vendor_name TEXT,
-            grand_total REAL,
-            json_data TEXT,
-            upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Auto-Migration for legacy invoices table
-    cursor.execute('PRAGMA table_info(invoices)')
-    columns = [info[1] for info in cursor.fetchall()]
-    
-    if 'file_path' not in columns: cursor.execute('ALTER TABLE invoices ADD COLUMN file_path TEXT')
-    if 'payment_status' not in columns: cursor.execute("ALTER TABLE invoices ADD COLUMN payment_status TEXT DEFAULT 'Unpaid'")
-    if 'is_manual' not in columns: cursor.execute("ALTER TABLE invoices ADD COLUMN is_manual BOOLEAN DEFAULT 0")
-    if 'hsn_code' not in columns: cursor.execute('ALTER TABLE invoices ADD COLUMN hsn_code TEXT')
-    if 'ledger_name' not in columns: cursor.execute('ALTER TABLE invoices ADD COLUMN ledger_name TEXT')
-    if 'group_name' not in columns: cursor.execute('ALTER TABLE invoices ADD COLUMN group_name TEXT')
-    if 'client_id' not in columns: cursor.execute('ALTER TABLE invoices ADD COLUMN client_id INTEGER')
-    # CRITICAL: Add user_id for multi-tenant data isolation
-    if 'user_id' not in columns: cursor.execute('ALTER TABLE invoices ADD COLUMN user_id INTEGER')
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = 'invoices'")
+    legacy = cursor.fetchone()
+    if legacy and legacy[0] == 'table':
+        cursor.execute('PRAGMA table_info(invoices)')
+        columns = [info[1] for info in cursor.fetchall()]
+        
+        if 'file_path' not in columns: cursor.execute('ALTER TABLE invoices ADD COLUMN file_path TEXT')
+        if 'payment_status' not in columns: cursor.execute("ALTER TABLE invoices ADD COLUMN payment_status TEXT DEFAULT 'Unpaid'")
+        if 'is_manual' not in columns: cursor.execute("ALTER TABLE invoices ADD COLUMN is_manual BOOLEAN DEFAULT 0")
+        if 'hsn_code' not in columns: cursor.execute('ALTER TABLE invoices ADD COLUMN hsn_code TEXT')
+        if 'ledger_name' not in columns: cursor.execute('ALTER TABLE invoices ADD COLUMN ledger_name TEXT')
+        if 'group_name' not in columns: cursor.execute('ALTER TABLE invoices ADD COLUMN group_name TEXT')
+        if 'client_id' not in columns: cursor.execute('ALTER TABLE invoices ADD COLUMN client_id INTEGER')
+        # CRITICAL: Add user_id for multi-tenant data isolation
+        if 'user_id' not in columns: cursor.execute('ALTER TABLE invoices ADD COLUMN user_id INTEGER')
 
     # ========================================================================
     # CREATE INDEXES FOR PERFORMANCE
+    # (composite/expression indexes for the hot queries: query_indexes.py)
     # ========================================================================
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_client ON documents(client_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_vendor ON documents(vendor_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_type ON documents(doc_type)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_review ON documents(review_status)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_date ON documents(invoice_date)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_bank_client ON bank_transactions(client_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_comm_client ON communications(client_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_vendors_name ON vendors(vendor_name)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_clients_name ON clients(company_name)')
-    # CRITICAL: Index for multi-tenant isolation
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoices_user ON invoices(user_id)')
 
     conn.commit()
     conn.close()
@@ -618,14 +653,19 @@ def init_db():
     print("   5. communications - WhatsApp/Email/SMS log")
     print("   6. message_templates - Communication templates")
     print("   7. users - Multi-user support")
-    print("   8. invoices - Legacy backward compatibility")
+    print("   8. invoices - Legacy view over documents")
 
 init_db()
+# Hot json_data fields as real columns (resumable; no-op once done)
+promote_json_columns(DB_FILE)
+# One bill table: documents (invoices becomes a view; no-op once done)
+consolidate_invoices_into_documents(DB_FILE)
+# Workload indexes, once the migrations have added their columns
+ensure_indexes(DB_FILE)
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Pooled connection (WAL; reads on shared readers, writes through the single writer). close() returns it."""
+    return get_pool(DB_FILE).connection()
 
 # --- HELPER FUNCTIONS ---
 def safe_float(val):
@@ -743,10 +783,13 @@ def check_calculations(data):
         data['math_status'] = "Check Error"
         return data
 
-def extract_invoice_data(file_bytes, mime_type):
+async def extract_invoice_data(file_bytes, mime_type, digest=None):
     """
     Extract invoice data using Qwen2.5-VL vision model.
     Model: qwen/qwen2.5-vl-32b-instruct (via OpenRouter)
+    PDF rasterization and base64 encoding run in the offload pools,
+    so a slow scan never stalls other requests on this worker.
+    Pass `digest` (SHA-256 of file_bytes) if it's already known to skip re-hashing.
     """
     prompt = """You are an expert OCR system for Indian GST Invoices.
 
@@ -796,67 +839,44 @@ Tax rate MUST be a number (5, 12, 18, or 28), NOT a string with %.
 Return ONLY a valid JSON object like this:
 {"gst_no": "27ABCDE1234F1Z5", "invoice_no": "INV-001", "invoice_date": "2025-04-01", "vendor_name": "ABC Traders", "buyer_name": "XYZ Ltd", "buyer_gstin": "07XXXXX0000X1Z5", "vendor_state": "Maharashtra", "place_of_supply": "Maharashtra", "hsn_code": "8471", "tax_rate": 18, "taxable_value": 10000.00, "cgst_amount": 900.00, "sgst_amount": 900.00, "igst_amount": 0, "cess_amount": 0, "grand_total": 11800.00, "ledger_name": "Purchase A/c", "group_name": "Purchase Accounts"}"""
 
+    # ⚡ Exact re-upload? Serve the cached extraction - zero model tokens
+    if digest is None:
+        digest = await run_blocking(content_hash, file_bytes)
+    cache_key = cache_version(AI_MODELS["ocr"], prompt)
+    cached = await run_blocking(ocr_cache.get, digest, cache_key)
+    if cached:
+        print(f"⚡ OCR cache hit ({digest[:12]}) - skipping vision model")
+        return cached
     
     for attempt in range(3):
         try:
             print(f"🔄 Sending to Qwen2.5-VL (OCR Model) - Attempt {attempt + 1}...")
             
-            # Handle PDF files - convert to image first
-            # Vision models don't support PDF, only images
-            import base64
-            
-            if mime_type == 'application/pdf' or (isinstance(mime_type, str) and 'pdf' in mime_type.lower()):
-                print("📄 PDF detected - converting to image...")
-                try:
-                    # Try using pdf2image (requires poppler)
-                    from pdf2image import convert_from_bytes
-                    images = convert_from_bytes(file_bytes, first_page=1, last_page=1, dpi=200)
-                    if images:
-                        # Convert PIL image to bytes
-                        from io import BytesIO
-                        img_buffer = BytesIO()
-                        images[0].save(img_buffer, format='PNG')
-                        file_bytes_to_use = img_buffer.getvalue()
-                        mime_type_to_use = 'image/png'
-                        print("✅ PDF converted to PNG successfully")
-                    else:
-                        raise ValueError("No images extracted from PDF")
-                except ImportError:
-                    # Fallback: try using pypdf to extract text instead
-                    print("⚠️ pdf2image not available, trying pypdf text extraction...")
+            # Which models answered decides whether the result may be cached
+            with record_models() as answered:
+                # Handle PDF files page by page: text-layer pages skip vision entirely,
+                # scanned pages are rasterized in parallel (vision models don't take PDFs)
+                if mime_type == 'application/pdf' or (isinstance(mime_type, str) and 'pdf' in mime_type.lower()):
+                    print("📄 PDF detected - reading pages...")
                     try:
-                        from pypdf import PdfReader
-                        from io import BytesIO
-                        pdf = PdfReader(BytesIO(file_bytes))
-                        if len(pdf.pages) > 0:
-                            text = pdf.pages[0].extract_text()
-                            if text and len(text.strip()) > 50:
-                                # Create a simple text-based fallback response
-                                print(f"📝 Extracted text: {text[:100]}...")
-                                # Return fallback - let the AI classify based on text
-                                return {"invoice_no": "EXTRACT_TEXT", "vendor_name": "PDF Text", "grand_total": 0, "raw_text": text}
-                    except Exception as pdf_err:
-                        print(f"⚠️ pypdf fallback failed: {pdf_err}")
-                    # Last resort - return error
-                    return {"invoice_no": "PDF_ERROR", "vendor_name": "Install pdf2image", "grand_total": 0, 
-                            "error": "PDF processing requires pdf2image. Install with: pip install pdf2image"}
-                except Exception as conv_err:
-                    print(f"❌ PDF conversion error: {conv_err}")
-                    return {"invoice_no": "PDF_ERROR", "vendor_name": "Conversion Failed", "grand_total": 0}
-            else:
-                file_bytes_to_use = file_bytes
-                mime_type_to_use = mime_type
-            
-            # Convert bytes to base64
-            b64_data = base64.b64encode(file_bytes_to_use).decode('utf-8')
-            
-            # Call Qwen2.5-VL vision model
-            response = call_vision_model(b64_data, prompt, mime_type_to_use)
-
-            
-            # Clean and parse JSON response
-            text = clean_json_response(response)
-            data = json.loads(text)
+                        data = await extract_pdf(file_bytes, prompt, call_vision_model, call_logic_model)
+                        unresolved = missing_critical(data)
+                    except ImportError:
+                        return {"invoice_no": "PDF_ERROR", "vendor_name": "Install pdf2image", "grand_total": 0, 
+                                "error": "Scanned PDF pages require pdf2image. Install with: pip install pdf2image"}
+                else:
+                    # Deskew/crop/downscale/re-encode + base64 in the pools (scans can be several MB)
+                    b64_data, vision_mime = await prepare_for_vision(file_bytes, mime_type)
+                
+                    # Call Qwen2.5-VL vision model - hedged with the OCR fallback chain when it
+                    # runs slow; a retry after an unreadable answer starts on the next model
+                    async def ask(text, max_tokens, response_format, attempt=attempt):
+                        return await call_vision_model(b64_data, text, vision_mime, max_tokens=max_tokens or 2048,
+                                                       start_at=attempt, response_format=response_format)
+                
+                    # Schema JSON mode + tolerant parse; fields that still fail get one short
+                    # follow-up on the same image instead of a full re-extraction
+                    data, unresolved = await extract_invoice_fields(ask, prompt)
             
             # Step 1: Validate GSTIN checksum
             gst_valid = validate_gstin_checksum(data.get('gst_no'))
@@ -871,6 +891,10 @@ Return ONLY a valid JSON object like this:
             # Step 4: Enrich GST data (vendor_state, place_of_supply, gst_nature)
             data = enrich_gst_data(data)
             
+            if cacheable(answered, (AI_MODELS["ocr"], AI_MODELS["logic"]), unresolved):
+                await run_blocking(ocr_cache.put, digest, cache_key, data)
+            else:
+                print(f"ℹ️ Not caching extraction (answered by {', '.join(answered) or 'none'}; unresolved: {', '.join(unresolved) or 'none'})")
             print(f"✅ Invoice extracted: {data.get('vendor_name', 'Unknown')}")
             return data
 
@@ -878,11 +902,11 @@ Return ONLY a valid JSON object like this:
             
         except json.JSONDecodeError as e:
             print(f"⚠️ JSON parse error: {e}")
-            if attempt < 2: time.sleep(2); continue
+            if attempt < 2: continue  # next attempt asks a different model - no need to wait
             return {"invoice_no": "ERROR", "vendor_name": "Parse Fail", "grand_total": 0}
         except Exception as e:
             print(f"❌ OCR Error: {e}")
-            if attempt < 2: time.sleep(3); continue
+            if attempt < 2: await asyncio.sleep(3); continue
             return {"invoice_no": "ERROR", "vendor_name": "AI Fail", "grand_total": 0}
     
     return {"invoice_no": "TIMEOUT", "vendor_name": "Model Busy", "grand_total": 0}
@@ -1139,9 +1163,9 @@ def smart_resolve_vendor(invoice_data: dict) -> dict:
     2. Phone Match - If phone number visible, find by phone
     3. Fuzzy Match - Find similar existing vendors
     """
-    vendor_name = invoice_data.get('vendor_name', '')
-    gstin = invoice_data.get('gst_no', '')
-    phone = invoice_data.get('vendor_phone', '')
+    vendor_name = invoice_data.get('vendor_name') or ''
+    gstin = invoice_data.get('gst_no') or ''
+    phone = invoice_data.get('vendor_phone') or ''
     
     # If we already have a valid vendor name, skip resolution
     if vendor_name and vendor_name not in ['', 'Unknown', 'AI Fail', 'Cash Sales']:
@@ -1208,9 +1232,9 @@ def generate_auto_narration(invoice_data: dict) -> dict:
     Auto-generate professional Tally narrations based on invoice content.
     Format: "Being [expense type] from [vendor] vide Invoice No. [number]"
     """
-    vendor = invoice_data.get('vendor_name', 'vendor')
+    vendor = invoice_data.get('vendor_name') or 'vendor'
     invoice_no = invoice_data.get('invoice_no', '')
-    ledger = invoice_data.get('ledger_name', '')
+    ledger = invoice_data.get('ledger_name') or ''
     group = invoice_data.get('group_name', '')
     amount = invoice_data.get('grand_total', 0)
     date = invoice_data.get('invoice_date', '')
@@ -1288,7 +1312,7 @@ def check_itc_eligibility(invoice_data: dict, doc_type: str) -> dict:
         return invoice_data
     
     # Check ledger type
-    ledger = invoice_data.get('ledger_name', '').lower()
+    ledger = (invoice_data.get('ledger_name') or '').lower()
     
     # Staff welfare - No ITC
     if 'staff welfare' in ledger or 'canteen' in ledger or 'food' in ledger:
@@ -1297,7 +1321,7 @@ def check_itc_eligibility(invoice_data: dict, doc_type: str) -> dict:
         return invoice_data
     
     # Check for restaurant bills (no ITC as per GST law)
-    vendor = invoice_data.get('vendor_name', '').lower()
+    vendor = (invoice_data.get('vendor_name') or '').lower()
     items = invoice_data.get('line_items', [])
     item_text = ' '.join([i.get('description', '') for i in items]).lower() if items else ''
     
@@ -1608,7 +1632,7 @@ def format_tally_date(date_str: str) -> str:
     # Fallback to today
     return datetime.now().strftime('%Y%m%d')
 
-async def determine_gst_rate(invoice_data: dict) -> int:
+def determine_gst_rate(invoice_data: dict) -> int:
     """
     Intelligent GST Rate Determination logic.
     Uses HSN code, Item Description, and AI to find correct rate.
@@ -2083,7 +2107,7 @@ async def generate_gst_tally_xml(invoices: list, company_name: str = "ABC Trader
         sgst = safe_float(inv.get('sgst_amount', 0))
         
         # Determine GST rate
-        gst_rate = await determine_gst_rate(inv)
+        gst_rate = determine_gst_rate(inv)
         half_rate = gst_rate // 2
         
         # Determine if IGST or CGST+SGST based on place of supply
@@ -2182,8 +2206,20 @@ async def generate_gst_tally_xml(invoices: list, company_name: str = "ABC Trader
     return pretty_xml
 
 
-@app.post("/search/ai")
-async def ai_search(query: SearchQuery):
+class JarvisPrompt(NamedTuple):
+    """A Jarvis query that needs the chat model."""
+    prompt: str
+    simple: bool    # route to the fast 8B model
+
+
+JARVIS_ERROR = {"explanation": "Sorry, I couldn't process that. Try asking in a different way!", "type": "help"}
+
+
+def _plan_jarvis_query(query: SearchQuery):
+    """
+    Everything /search/ai does before the model call. Returns either a finished
+    response (navigation, month filter, help) or a JarvisPrompt.
+    """
     print(f"🤖 KAIRO analyzing: {query.query}")
     print(f"   Context: {query.context}")
     
@@ -2600,91 +2636,176 @@ Just type what you need in simple words!
     If returning SQL, output ONLY the query starting with SELECT.
     """
     
+    return JarvisPrompt(prompt, _is_simple_jarvis_query(user_query))
+
+
+def _is_simple_jarvis_query(user_query: str) -> bool:
+    """
+    SMART MODEL ROUTING - Use fast model for simple queries
+    """
+    # Detect if query is simple or complex
+    query_lower = user_query.lower()
+    word_count = len(user_query.split())
+    
+    # Simple query indicators: short, no complex keywords
+    complex_keywords = [
+        'analyze', 'calculate', 'explain in detail', 'legal', 'section',
+        'compliance', 'regulation', 'implications', 'breakdown', 
+        'show me all', 'list all', 'detailed'
+    ]
+    
+    has_complex_keyword = any(keyword in query_lower for keyword in complex_keywords)
+    is_sql_query = any(word in query_lower for word in ['show', 'list', 'find', 'how many', 'total'])
+    
+    # Use fast model if:
+    # - Query is short (< 20 words) AND
+    # - No complex keywords AND
+    # - Not asking for data/SQL
+    return (
+        word_count < 20 and 
+        not has_complex_keyword and 
+        not is_sql_query
+    )
+
+
+def _jarvis_answer(ai_response: str):
+    """Turn the model's reply into the /search/ai response: an explanation or SQL results."""
+    ai_response = ai_response.replace("```sql", "").replace("```", "").strip()
     
-    try:
-        # =====================================================================
-        # SMART MODEL ROUTING - Use fast model for simple queries
-        # =====================================================================
-        
-        # Detect if query is simple or complex
-        query_lower = user_query.lower()
-        word_count = len(user_query.split())
-        
-        # Simple query indicators: short, no complex keywords
-        complex_keywords = [
-            'analyze', 'calculate', 'explain in detail', 'legal', 'section',
-            'compliance', 'regulation', 'implications', 'breakdown', 
-            'show me all', 'list all', 'detailed'
-        ]
-        
-        has_complex_keyword = any(keyword in query_lower for keyword in complex_keywords)
-        is_sql_query = any(word in query_lower for word in ['show', 'list', 'find', 'how many', 'total'])
-        
-        # Use fast model if:
-        # - Query is short (< 20 words) AND
-        # - No complex keywords AND
-        # - Not asking for data/SQL
-        is_simple_query = (
-            word_count < 20 and 
-            not has_complex_keyword and 
-            not is_sql_query
-        )
+    # Check if it's an explanation
+    if ai_response.upper().startswith("EXPLAIN:"):
+        explanation = ai_response.replace("EXPLAIN:", "").strip()
+        print(f"💡 KAIRO Explanation: {explanation[:100]}...")
+        return {"explanation": explanation, "type": "help"}
+    
+    # Security Check for SQL
+    sql_query = ai_response
+    if not sql_query.upper().startswith("SELECT"):
+        return {"explanation": ai_response, "type": "help"}
         
+    print(f"🔍 Executing SQL: {sql_query}")
+    
+    # Execute SQL
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    rows = cursor.execute(sql_query).fetchall()
+    
+    # Format Results
+    results = []
+    for row in rows:
+        try:
+            if 'id' in row.keys():
+                if 'json_data' in row.keys():
+                    data = json.loads(row['json_data'])
+                    data['id'] = row['id']
+                    data['payment_status'] = row['payment_status'] if 'payment_status' in row.keys() else 'Unpaid'
+                    results.append(data)
+                else:
+                    full_row = conn.execute("SELECT json_data, payment_status FROM invoices WHERE id = ?", (row['id'],)).fetchone()
+                    if full_row:
+                        data = json.loads(full_row['json_data'])
+                        data['id'] = row['id']
+                        data['payment_status'] = full_row['payment_status']
+                        results.append(data)
+        except:
+            continue
+            
+    conn.close()
+    return results
+
+
+@app.post("/search/ai")
+async def ai_search(query: SearchQuery, authorization: str = Header(None)):
+    # Someone is waiting on screen - model calls for this request take the interactive lane
+    set_lane(INTERACTIVE)
+    set_attribution(flow="jarvis", user_id=_optional_user_id(authorization),
+                    client_id=(query.context or {}).get("client_id"))
+    plan = _plan_jarvis_query(query)
+    if not isinstance(plan, JarvisPrompt):
+        return plan
+    
+    try:
         # Route to appropriate model
-        if is_simple_query:
+        if plan.simple:
             print(f"⚡ Using FAST model (Llama 3.2 8B) for simple query")
-            ai_response = await call_fast_chat_model(prompt, max_tokens=512)
+            ai_response = await call_fast_chat_model(plan.prompt, max_tokens=512)
         else:
             print(f"🧠 Using COMPLEX model (Llama 3.1 405B) for detailed analysis")
-            ai_response = await call_chat_model(prompt)
-        
-        ai_response = ai_response.replace("```sql", "").replace("```", "").strip()
-
+            ai_response = await call_chat_model(plan.prompt)
         
-        # Check if it's an explanation
-        if ai_response.upper().startswith("EXPLAIN:"):
-            explanation = ai_response.replace("EXPLAIN:", "").strip()
-            print(f"💡 KAIRO Explanation: {explanation[:100]}...")
-            return {"explanation": explanation, "type": "help"}
-        
-        # Security Check for SQL
-        sql_query = ai_response
-        if not sql_query.upper().startswith("SELECT"):
-            return {"explanation": ai_response, "type": "help"}
-            
-        print(f"🔍 Executing SQL: {sql_query}")
-        
-        # Execute SQL
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        rows = cursor.execute(sql_query).fetchall()
-        
-        # Format Results
-        results = []
-        for row in rows:
-            try:
-                if 'id' in row.keys():
-                    if 'json_data' in row.keys():
-                        data = json.loads(row['json_data'])
-                        data['id'] = row['id']
-                        data['payment_status'] = row['payment_status'] if 'payment_status' in row.keys() else 'Unpaid'
-                        results.append(data)
-                    else:
-                        full_row = conn.execute("SELECT json_data, payment_status FROM invoices WHERE id = ?", (row['id'],)).fetchone()
-                        if full_row:
-                            data = json.loads(full_row['json_data'])
-                            data['id'] = row['id']
-                            data['payment_status'] = full_row['payment_status']
-                            results.append(data)
-            except:
-                continue
-                
-        conn.close()
-        return results
+        return await run_blocking(_jarvis_answer, ai_response)
 
     except Exception as e:
         print(f"❌ Jarvis Error: {e}")
-        return {"explanation": "Sorry, I couldn't process that. Try asking in a different way!", "type": "help"}
+        return JARVIS_ERROR
+
+
+@app.post("/search/ai/stream")
+async def ai_search_stream(query: SearchQuery, authorization: str = Header(None)):
+    """
+    Server-Sent Events variant of /search/ai - explanations appear word by word.
+    
+    When the model answers with "EXPLAIN:", each `data:` line is {"delta": "..."}
+    as tokens arrive. Anything else (navigation, help, SQL results) comes as one
+    `event: result` carrying exactly what /search/ai would return.
+    The stream always ends with `event: done`.
+    """
+    set_lane(INTERACTIVE)
+    plan = _plan_jarvis_query(query)
+    user_id = _optional_user_id(authorization)
+    
+    def result_event(result) -> str:
+        return f"event: result\ndata: {json.dumps(result)}\n\n"
+    
+    async def event_stream():
+        # The body runs in the response task, so attribution is set here, not above
+        set_attribution(flow="jarvis", user_id=user_id, client_id=(query.context or {}).get("client_id"))
+        if not isinstance(plan, JarvisPrompt):
+            yield result_event(plan)
+            yield "event: done\ndata: {}\n\n"
+            return
+        
+        print(f"📡 Streaming {'FAST' if plan.simple else 'COMPLEX'} model answer")
+        stream = stream_chat_model(plan.prompt, fast=plan.simple, priority=INTERACTIVE)
+        text = ""
+        explaining = False
+        sent = 0
+        try:
+            async for delta in stream:
+                text += delta
+                if not explaining:
+                    head = text.lstrip().replace("```sql", "").replace("```", "").lstrip()
+                    if len(head) < len("EXPLAIN:") and "EXPLAIN:".startswith(head.upper()):
+                        continue  # can't tell yet
+                    if not head.upper().startswith("EXPLAIN:"):
+                        continue  # SQL or plain text - answered whole at the end
+                    explaining = True
+                    # Drop the marker; everything after it is streamed as it arrives
+                    text = head[len("EXPLAIN:"):]
+                    sent = 0
+                    print(f"💡 KAIRO Explanation (streaming)")
+                if not sent:
+                    text = text.lstrip()
+                if len(text) > sent:
+                    yield f"data: {json.dumps({'delta': text[sent:]})}\n\n"
+                    sent = len(text)
+            if not explaining:
+                yield result_event(await run_blocking(_jarvis_answer, text))
+        except Exception as e:
+            print(f"❌ Jarvis Error: {e}")
+            if not explaining:
+                yield result_event(JARVIS_ERROR)
+            else:
+                yield f"event: error\ndata: {json.dumps({'error': 'Answer interrupted'})}\n\n"
+        finally:
+            await stream.aclose()
+        yield "event: done\ndata: {}\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # --- API ENDPOINTS ---
 
@@ -2708,40 +2829,67 @@ async def get_history(
         except:
             pass
     
-    conn = get_db_connection()
+    # If no user_id (not authenticated), return empty array gracefully
+    if user_id is None:
+        print("⚠️ /history called without authentication - returning empty array")
+        return []
     try:
-        # If no user_id (not authenticated), return empty array gracefully
-        if user_id is None:
-            print("⚠️ /history called without authentication - returning empty array")
-            return []
-        
-        # CRITICAL: Filter by user_id to prevent cross-user data access
-        invoices = conn.execute(
-            "SELECT * FROM invoices WHERE user_id = ? ORDER BY id DESC",
-            (user_id,)
-        ).fetchall()
-        results = []
-        for row in invoices:
-            try:
-                data = json.loads(row['json_data'])
-                data['id'] = row['id']
-                data['file_path'] = row['file_path'] if 'file_path' in row.keys() else None
-                data['payment_status'] = row['payment_status'] if 'payment_status' in row.keys() else "Unpaid"
-                # Include HSN, Ledger, Group from database columns (they override json_data if present)
-                if 'hsn_code' in row.keys() and row['hsn_code']:
-                    data['hsn_code'] = row['hsn_code']
-                if 'ledger_name' in row.keys() and row['ledger_name']:
-                    data['ledger_name'] = row['ledger_name']
-                if 'group_name' in row.keys() and row['group_name']:
-                    data['group_name'] = row['group_name']
-                results.append(data)
-            except: continue
+        results = await invoice_repo.history(user_id)
         print(f"✅ /history returned {len(results)} invoices for user_id={user_id}")
         return results
     except Exception as e:
         print(f"❌ /history error: {e}")
         return []
-    finally: conn.close()
+
+def _save_uploaded_document(data: dict, client_id, user_id, doc_type, review_status,
+                            confidence_level, entered_by, file_path, file_type, file_size):
+    """
+    Duplicate check, vendor and documents row for /upload (blocking - run via run_db).
+    Returns (document id, vendor id), or None if the bill already exists for the client.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+    
+        # Check for duplicates
+        existing = cursor.execute(
+            "SELECT id FROM documents WHERE invoice_no = ? AND gst_no = ? AND client_id = ?", 
+            (data.get('invoice_no'), data.get('gst_no'), client_id)
+        ).fetchone()
+        if existing:
+            return None
+    
+        # Get or create vendor
+        vendor_id = None
+        if data.get('vendor_name'):
+            vendor_id = get_or_create_vendor(data['vendor_name'], conn)
+    
+        # One row in documents - the invoices view (/history) reads the same row
+        # CRITICAL: Include user_id for multi-tenant data isolation
+        cursor.execute('''
+            INSERT INTO documents (
+                client_id, vendor_id, doc_type, invoice_no, invoice_date, vendor_name, gst_no,
+                grand_total, taxable_value, tax_amount, hsn_code, ledger_name, group_name,
+                review_status, confidence_level, entered_by, file_path, file_type, file_size,
+                payment_status, json_data, user_id,
+                cgst_amount, sgst_amount, igst_amount, tax_rate, place_of_supply, vendor_state
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            client_id, vendor_id, doc_type, data.get('invoice_no'), data.get('invoice_date'),
+            data.get('vendor_name'), data.get('gst_no'), data.get('grand_total'),
+            to_real(data.get('taxable_value')), data.get('tax_amount'), data.get('hsn_code'),
+            data.get('ledger_name'), data.get('group_name'), review_status, confidence_level,
+            entered_by, file_path, file_type, file_size, 'Unpaid', json.dumps(data), user_id
+        ) + tax_values(data))
+        new_id = cursor.lastrowid
+    
+        # Update client last activity (same transaction)
+        if client_id:
+            cursor.execute("UPDATE clients SET last_activity_date = CURRENT_TIMESTAMP WHERE id = ?", (client_id,))
+        conn.commit()
+        return new_id, vendor_id
+    finally:
+        conn.close()
 
 @app.post("/upload")
 async def process_invoice(
@@ -2761,133 +2909,92 @@ async def process_invoice(
     print(f"   Client ID: {client_id}")
     print(f"   Document Type: {doc_type}")
     print(f"   Entered By: {entered_by}")
+    set_attribution(flow="upload", user_id=user_id, client_id=client_id)
     
-    # Save file
-    unique_filename = f"{uuid.uuid4()}_{file.filename}"
-    file_path = os.path.join(UPLOAD_DIR, unique_filename)
-    file_content = await file.read()
-    file_size = len(file_content)
-    
-    with open(file_path, "wb") as buffer:
-        buffer.write(file_content)
-    
-    # Extract data using AI
-    data = extract_invoice_data(file_content, file.content_type)
-    data["filename"] = file.filename
-    data["file_url"] = f"/files/{unique_filename}"
+    # Save file - streamed to disk in chunks, stored once per unique content
+    stored = await save_upload(file)
+    file_path, file_size = stored.path, stored.size
     
-    # 🤖 AI-powered HSN, Ledger, and Group detection
-    ai_classification = detect_hsn_ledger_group(data)
-    data['hsn_code'] = ai_classification['hsn_code']
-    data['ledger_name'] = ai_classification['ledger_name']
-    data['group_name'] = ai_classification['group_name']
-    data['ai_confidence'] = ai_classification['ai_confidence']
-    confidence_level = ai_classification['ai_confidence']
-    
-    # 🔍 SMART ENTITY RESOLUTION - "Sherlock Holmes" method
-    # Tries GSTIN match, Phone match, and Fuzzy matching before falling back to "Cash Sales"
-    data = smart_resolve_vendor(data)
-    
-    # ✍️ AUTO-NARRATION WRITER - Generate Tally-style narration
-    data = generate_auto_narration(data)
+    try:
+        # Heavy stages are capped per worker so uploads can't starve /history, /clients etc.
+        async with upload_slots:
+            # Extract data using AI
+            file_content = await run_blocking(read_file, file_path)
+            data = await extract_invoice_data(file_content, file.content_type, digest=stored.content_hash)
+            del file_content
+            data["filename"] = file.filename
+            data["file_url"] = stored.url
+        
+            # 🤖 AI-powered HSN, Ledger, and Group detection
+            ai_classification = await detect_hsn_ledger_group(data)
+            data['hsn_code'] = ai_classification['hsn_code']
+            data['ledger_name'] = ai_classification['ledger_name']
+            data['group_name'] = ai_classification['group_name']
+            data['ai_confidence'] = ai_classification['ai_confidence']
+            confidence_level = ai_classification['ai_confidence']
+        
+            # 🔍 SMART ENTITY RESOLUTION - "Sherlock Holmes" method
+            # Tries GSTIN match, Phone match, and Fuzzy matching before falling back to "Cash Sales"
+            # Fuzzy matching scans the whole vendor master, so it runs in the I/O pool
+            data = await run_blocking(smart_resolve_vendor, data)
+    
+        # ✍️ AUTO-NARRATION WRITER - Generate Tally-style narration
+        data = generate_auto_narration(data)
+    
+        # 🛡️ ITC SAFE-GUARD - Check if ITC can be claimed
+        data = check_itc_eligibility(data, doc_type)
+    
+        print(f"🎯 AI Classification: HSN={data['hsn_code']}, Ledger={data['ledger_name']}, Group={data['group_name']} (Confidence: {confidence_level})")
+        print(f"✍️ Auto-Narration: {data.get('narration', 'N/A')[:50]}...")
+        print(f"🛡️ ITC Eligible: {data.get('claim_itc', True)}")
+        if data.get('resolution_method'):
+            print(f"🔍 Vendor Resolution: {data.get('vendor_name')} via {data.get('resolution_method')}")
+    
+        # Determine review status based on confidence
+        if confidence_level == 'high':
+            review_status = 'approved'  # Auto-approve high confidence
+        elif confidence_level == 'medium':
+            review_status = 'pending'
+        else:
+            review_status = 'needs_review'  # Low confidence needs attention
     
-    # 🛡️ ITC SAFE-GUARD - Check if ITC can be claimed
-    data = check_itc_eligibility(data, doc_type)
+        # Determine file type
+        file_ext = file.filename.split('.')[-1].lower()
+        file_type = 'pdf' if file_ext == 'pdf' else 'image' if file_ext in ['jpg', 'jpeg', 'png'] else 'other'
     
-    print(f"🎯 AI Classification: HSN={data['hsn_code']}, Ledger={data['ledger_name']}, Group={data['group_name']} (Confidence: {confidence_level})")
-    print(f"✍️ Auto-Narration: {data.get('narration', 'N/A')[:50]}...")
-    print(f"🛡️ ITC Eligible: {data.get('claim_itc', True)}")
-    if data.get('resolution_method'):
-        print(f"🔍 Vendor Resolution: {data.get('vendor_name')} via {data.get('resolution_method')}")
+        # The writer lock can wait - on the DB threads, not the event loop
+        saved = await run_db(
+            _save_uploaded_document, data, client_id, user_id, doc_type, review_status,
+            confidence_level, entered_by, file_path, file_type, file_size
+        )
+        if saved is None:
+            data['gst_status'] = "DUPLICATE BILL"
+            data['error'] = "This bill already exists for this client"
+            # Nothing references this upload - drop the reference taken when it was stored
+            await run_blocking(upload_store.release, file_path)
+            return data
+        new_id, vendor_id = saved
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+        data['id'] = new_id
+        data['review_status'] = review_status
+        data['confidence_level'] = confidence_level
+        data['vendor_id'] = vendor_id
     
-    # Check for duplicates
-    existing = cursor.execute(
-        "SELECT id FROM documents WHERE invoice_no = ? AND gst_no = ? AND client_id = ?", 
-        (data.get('invoice_no'), data.get('gst_no'), client_id)
-    ).fetchone()
+        print(f"✅ Document saved: ID={new_id}, Status={review_status}")
     
-    if existing:
-        data['gst_status'] = "DUPLICATE BILL"
-        data['error'] = "This bill already exists for this client"
-        conn.close()
         return data
-    
-    # Get or create vendor
-    vendor_id = None
-    if data.get('vendor_name'):
-        vendor_id = get_or_create_vendor(data['vendor_name'], conn)
-    
-    # Determine review status based on confidence
-    if confidence_level == 'high':
-        review_status = 'approved'  # Auto-approve high confidence
-    elif confidence_level == 'medium':
-        review_status = 'pending'
-    else:
-        review_status = 'needs_review'  # Low confidence needs attention
-    
-    # Determine file type
-    file_ext = file.filename.split('.')[-1].lower()
-    file_type = 'pdf' if file_ext == 'pdf' else 'image' if file_ext in ['jpg', 'jpeg', 'png'] else 'other'
-    
-    # Insert into new documents table
-    cursor.execute('''
-        INSERT INTO documents (
-            client_id, vendor_id, doc_type, invoice_no, invoice_date, vendor_name, gst_no,
-            grand_total, taxable_value, tax_amount, hsn_code, ledger_name, group_name,
-            review_status, confidence_level, entered_by, file_path, file_type, file_size,
-            payment_status, json_data
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        client_id, vendor_id, doc_type, data.get('invoice_no'), data.get('invoice_date'),
-        data.get('vendor_name'), data.get('gst_no'), data.get('grand_total'),
-        data.get('taxable_value'), data.get('tax_amount'), data.get('hsn_code'),
-        data.get('ledger_name'), data.get('group_name'), review_status, confidence_level,
-        entered_by, file_path, file_type, file_size, 'Unpaid', json.dumps(data)
-    ))
-    
-    conn.commit()
-    new_id = cursor.lastrowid
-    
-    # Also insert into legacy invoices table for backward compatibility
-    # CRITICAL: Include user_id for multi-tenant data isolation
-    cursor.execute('''
-        INSERT INTO invoices (
-            invoice_no, gst_no, invoice_date, vendor_name, grand_total, json_data, 
-            file_path, hsn_code, ledger_name, group_name, client_id, user_id
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        data.get('invoice_no'), data.get('gst_no'), data.get('invoice_date'),
-        data.get('vendor_name'), data.get('grand_total'), json.dumps(data),
-        file_path, data.get('hsn_code'), data.get('ledger_name'), data.get('group_name'),
-        client_id, user_id  # CRITICAL: Save user_id
-    ))
-    conn.commit()
-    
-    # Update client last activity
-    if client_id:
-        cursor.execute("UPDATE clients SET last_activity_date = CURRENT_TIMESTAMP WHERE id = ?", (client_id,))
-        conn.commit()
-    
-    conn.close()
-    
-    data['id'] = new_id
-    data['review_status'] = review_status
-    data['confidence_level'] = confidence_level
-    data['vendor_id'] = vendor_id
-    
-    print(f"✅ Document saved: ID={new_id}, Status={review_status}")
-    
-    return data
+    except Exception:
+        # Failed before a row referenced the upload - drop the reference taken when it was stored
+        await run_blocking(upload_store.release, file_path)
+        raise
 
 
 # =============================================================================
 # ASYNC PIPELINE ENDPOINTS - High-Performance Concurrent Processing
 # =============================================================================
 
-from pipeline import process_document_async, get_task_status, wait_for_task, pipeline
+from pipeline import process_document_async, get_task_status, wait_for_task, pipeline, PipelineFull
+from ai_provider import provider as ai_provider
 
 @app.on_event("startup")
 async def startup_pipeline():
@@ -2896,12 +3003,36 @@ async def startup_pipeline():
     print("🚀 Async Pipeline Workers started!")
 
 
+@app.on_event("shutdown")
+async def shutdown_pipeline():
+    """Drain (or checkpoint) in-flight pipeline tasks, then release the pools and the model backend's connections."""
+    await pipeline.stop_workers()
+    await ai_provider.close()
+    await usage_ledger.close()
+    shutdown_executors()
+    shutdown_db_executor()
+    close_pools()
+
+
+def _optional_user_id(authorization: Optional[str]) -> Optional[int]:
+    """user_id from a Bearer token if one was sent (pipeline rows are attributed like /upload)."""
+    if authorization and authorization.startswith("Bearer "):
+        try:
+            from auth import verify_token
+            payload = verify_token(authorization.split(" ")[1])
+            return payload.get("user_id") if payload else None
+        except:
+            pass
+    return None
+
+
 @app.post("/upload/async")
 async def process_invoice_async_endpoint(
     file: UploadFile = File(...),
     client_id: int = None,
     doc_type: str = "gst_invoice",
-    entered_by: str = None
+    entered_by: str = None,
+    authorization: str = Header(None)
 ):
     """
     ASYNC Upload - Returns immediately with task_id.
@@ -2910,30 +3041,38 @@ async def process_invoice_async_endpoint(
     Use /upload/status/{task_id} to check progress.
     """
     print(f"\n📥 [ASYNC] Queuing: {file.filename}")
+    user_id = _optional_user_id(authorization)
     
-    # Save file
-    unique_filename = f"{uuid.uuid4()}_{file.filename}"
-    file_path = os.path.join(UPLOAD_DIR, unique_filename)
-    file_content = await file.read()
+    # Backpressure - refuse before writing the file
+    if not pipeline.has_capacity(1):
+        raise HTTPException(status_code=429, detail="Processing queue is full, retry shortly",
+                            headers={"Retry-After": "30"})
     
-    with open(file_path, "wb") as buffer:
-        buffer.write(file_content)
+    # Save file (streamed, content-addressed) - the pipeline reads it back by path
+    stored = await save_upload(file)
+    file_path = stored.path
     
     # Submit to async pipeline (returns immediately)
-    task_id = await process_document_async(
-        file_bytes=file_content,
-        mime_type=file.content_type,
-        filename=file.filename,
-        client_id=client_id,
-        doc_type=doc_type,
-        entered_by=entered_by
-    )
+    try:
+        task_id = await process_document_async(
+            file_bytes=None,
+            mime_type=file.content_type,
+            filename=file.filename,
+            client_id=client_id,
+            doc_type=doc_type,
+            entered_by=entered_by,
+            file_path=file_path,
+            user_id=user_id
+        )
+    except PipelineFull as e:
+        await run_blocking(upload_store.release, file_path)
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "30"})
     
     return {
         "status": "queued",
         "task_id": task_id,
         "filename": file.filename,
-        "file_url": f"/files/{unique_filename}"
+        "file_url": stored.url
     }
 
 
@@ -2959,7 +3098,8 @@ async def bulk_upload_async_endpoint(
     files: List[UploadFile] = File(...),
     client_id: int = None,
     doc_type: str = "gst_invoice",
-    entered_by: str = None
+    entered_by: str = None,
+    authorization: str = Header(None)
 ):
     """
     BULK UPLOAD - Process multiple files concurrently.
@@ -2968,40 +3108,145 @@ async def bulk_upload_async_endpoint(
     Returns list of task_ids to track progress.
     """
     print(f"\n📦 [BULK] Processing {len(files)} files concurrently...")
+    user_id = _optional_user_id(authorization)
+    
+    # Backpressure - the whole batch must fit, otherwise nothing is written
+    if not pipeline.has_capacity(len(files)):
+        raise HTTPException(
+            status_code=429,
+            detail=f"Processing queue is full - {pipeline.ocr_queue.qsize()} documents waiting. "
+                   f"Retry shortly or send a smaller batch.",
+            headers={"Retry-After": "30"}
+        )
     
     task_ids = []
+    rejected = []
+    batch_id = str(uuid.uuid4())
     
     for file in files:
-        # Save file
-        unique_filename = f"{uuid.uuid4()}_{file.filename}"
-        file_path = os.path.join(UPLOAD_DIR, unique_filename)
-        file_content = await file.read()
-        
-        with open(file_path, "wb") as buffer:
-            buffer.write(file_content)
+        # Save file (streamed, content-addressed) - queued by path, not bytes,
+        # so a 500-file batch doesn't sit in memory
+        stored = await save_upload(file)
+        file_path = stored.path
         
-        # Queue for processing
-        task_id = await process_document_async(
-            file_bytes=file_content,
-            mime_type=file.content_type,
-            filename=file.filename,
-            client_id=client_id,
-            doc_type=doc_type,
-            entered_by=entered_by
-        )
+        # Queue for processing (another upload may have taken the last slots meanwhile)
+        try:
+            task_id = await process_document_async(
+                file_bytes=None,
+                mime_type=file.content_type,
+                filename=file.filename,
+                client_id=client_id,
+                doc_type=doc_type,
+                entered_by=entered_by,
+                file_path=file_path,
+                user_id=user_id,
+                batch_id=batch_id
+            )
+        except PipelineFull:
+            await run_blocking(upload_store.release, file_path)
+            rejected.append(file.filename)
+            continue
         
         task_ids.append({
             "task_id": task_id,
             "filename": file.filename,
-            "file_url": f"/files/{unique_filename}"
+            "file_url": stored.url
         })
     
     print(f"✅ [BULK] {len(task_ids)} files queued for concurrent processing")
     
+    if rejected and not task_ids:
+        raise HTTPException(status_code=429, detail="Processing queue is full, retry shortly",
+                            headers={"Retry-After": "30"})
+    
     return {
-        "status": "queued",
+        "status": "queued" if not rejected else "partial",
+        "batch_id": batch_id,
+        "stream_url": f"/upload/stream/{batch_id}",
         "total_files": len(task_ids),
-        "tasks": task_ids
+        "tasks": task_ids,
+        "rejected": rejected
+    }
+
+
+@app.get("/upload/stream/{batch_id}")
+async def stream_batch_progress(batch_id: str):
+    """
+    Server-Sent Events for a whole /upload/bulk batch - replaces polling
+    /upload/status once per file.
+    
+    Each `data:` line is a JSON status change for one file:
+    {"task_id", "filename", "status", "error", "result"}.
+    A final `event: done` carries the batch totals, then the stream closes.
+    """
+    async def event_stream():
+        counts = {"completed": 0, "failed": 0}
+        seen = False
+        async for event in pipeline.watch_batch(batch_id):
+            if event is None:
+                yield ": keepalive\n\n"
+                continue
+            seen = True
+            if event["status"] in counts:
+                counts[event["status"]] += 1
+            yield f"data: {json.dumps(event)}\n\n"
+        if not seen:
+            yield f"event: error\ndata: {json.dumps({'error': 'Unknown batch_id'})}\n\n"
+            return
+        yield f"event: done\ndata: {json.dumps({'batch_id': batch_id, **counts})}\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/pipeline/stats")
+async def pipeline_stats():
+    """
+    Pipeline health: queue depths, in-flight tasks by stage, per-stage throughput,
+    adaptive worker limits, recent OpenRouter latency / 429 rates and OCR cache hit rate.
+    """
+    stats = pipeline.get_stats()
+    stats["tasks_by_status"] = await run_blocking(pipeline.store.count_by_status)
+    stats["ocr_cache"] = await run_blocking(ocr_cache.stats)
+    stats["response_cache"] = await run_blocking(response_cache.stats)
+    stats["hedging"] = hedger.snapshot()
+    stats["usage_ledger"] = usage_ledger.stats()
+    stats["db_pool"] = get_pool(DB_FILE).stats()
+    return stats
+
+
+@app.get("/usage")
+async def usage_report(
+    days: int = 30,
+    group_by: str = "flow",
+    client_id: Optional[int] = None,
+    user_id: int = Depends(get_user_id_from_token)
+):
+    """
+    Model spend for the logged-in user: calls, tokens, cost (USD) and latency,
+    grouped by flow (upload, jarvis, legal_notice, classify, pipeline_*),
+    task, model, client, key, lane or day. Optional client_id filter.
+    """
+    if group_by not in GROUP_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of: {', '.join(GROUP_COLUMNS)}")
+    # Rows still in the write buffer count too
+    await usage_ledger.flush()
+    rows = await run_blocking(
+        usage_ledger.report, group_by, since=time.time() - days * 86400, user_id=user_id, client_id=client_id
+    )
+    return {
+        "days": days,
+        "group_by": group_by,
+        "totals": {
+            "calls": sum(r["calls"] for r in rows),
+            "total_tokens": sum(r["total_tokens"] for r in rows),
+            "cost": round(sum(r["cost"] for r in rows), 6),
+            "model_seconds": round(sum(r["model_seconds"] for r in rows), 1),
+        },
+        "groups": rows,
     }
 
 
@@ -3017,7 +3262,7 @@ async def add_manual(
     data['math_status'] = "Manual"
     
     # 🤖 AI-powered HSN, Ledger, and Group detection for manual entries too
-    ai_classification = detect_hsn_ledger_group(data)
+    ai_classification = await detect_hsn_ledger_group(data)
     if not data.get('hsn_code'):
         data['hsn_code'] = ai_classification['hsn_code']
     if not data.get('ledger_name'):
@@ -3027,16 +3272,7 @@ async def add_manual(
     data['ai_confidence'] = ai_classification.get('ai_confidence', 'manual')
     print(f"🎯 Manual Entry AI Classification: HSN={data['hsn_code']}, Ledger={data['ledger_name']}, Group={data['group_name']}")
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO invoices (invoice_no, gst_no, invoice_date, vendor_name, grand_total, json_data, is_manual, hsn_code, ledger_name, group_name, user_id) VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?, ?, ?)", 
-        (data.get('invoice_no'), data.get('gst_no'), data.get('invoice_date'), data.get('vendor_name'), data.get('grand_total'), json.dumps(data), data.get('hsn_code'), data.get('ledger_name'), data.get('group_name'), user_id)
-    )
-    conn.commit()
-    new_id = cursor.lastrowid
-    conn.close()
-    data['id'] = new_id
+    data['id'] = await invoice_repo.create_manual(data, user_id)
     return data
 
 @app.put("/invoice/{invoice_id}")
@@ -3049,30 +3285,17 @@ async def update_invoice(
     Update invoice
     CRITICAL: Verifies user owns the invoice before allowing updates.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
     # CRITICAL: Verify ownership - only allow user to update their own invoices
-    row = cursor.execute(
-        "SELECT json_data FROM invoices WHERE id = ? AND user_id = ?", 
-        (invoice_id, user_id)
-    ).fetchone()
-    if not row: 
-        conn.close()
+    row = await invoice_repo.get_owned(invoice_id, user_id)
+    if not row:
         raise HTTPException(status_code=404, detail="Invoice not found or access denied")
     current_data = json.loads(row['json_data'])
     updates = update_data.dict(exclude_unset=True)
     current_data.update(updates)
     current_data = check_calculations(current_data)
     
-    # Update HSN, Ledger, Group columns if they were updated
-    hsn_code = current_data.get('hsn_code')
-    ledger_name = current_data.get('ledger_name')
-    group_name = current_data.get('group_name')
-    
-    cursor.execute("UPDATE invoices SET json_data = ?, grand_total = ?, vendor_name = ?, invoice_no = ?, payment_status = ?, hsn_code = ?, ledger_name = ?, group_name = ? WHERE id = ?", 
-                   (json.dumps(current_data), current_data.get('grand_total'), current_data.get('vendor_name'), current_data.get('invoice_no'), updates.get('payment_status', "Unpaid"), hsn_code, ledger_name, group_name, invoice_id))
-    conn.commit()
-    conn.close()
+    # json_data plus the HSN, Ledger, Group (and other mirrored) columns
+    await invoice_repo.update(invoice_id, current_data, updates.get('payment_status', "Unpaid"))
     current_data['id'] = invoice_id
     return current_data
 
@@ -3085,22 +3308,12 @@ async def delete_invoice(
     Delete invoice
     CRITICAL: Verifies user owns the invoice before allowing deletion.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
     # CRITICAL: Verify ownership before deletion
-    row = cursor.execute(
-        "SELECT file_path FROM invoices WHERE id = ? AND user_id = ?",
-        (invoice_id, user_id)
-    ).fetchone()
+    row = await invoice_repo.delete_owned(invoice_id, user_id)
     if not row:
-        conn.close()
         raise HTTPException(status_code=404, detail="Invoice not found or access denied")
-    # Delete file if it exists
-    if row['file_path'] and os.path.exists(row['file_path']): 
-        os.remove(row['file_path'])
-    cursor.execute("DELETE FROM invoices WHERE id = ?", (invoice_id,))
-    conn.commit()
-    conn.close()
+    # Uploads are shared by content - the file is only unlinked with its last reference
+    await run_blocking(upload_store.release, row['file_path'])
     return {"status": "success", "id": invoice_id}
 
 @app.get("/export/tally")
@@ -3114,10 +3327,7 @@ async def export_tally_xml(
     IMPORTANT: This now uses the GST-compliant generator by default!
     For GSTR-1/GSTR-3B compliance, use /export/tally/gst for more options.
     """
-    conn = get_db_connection()
-    rows = conn.execute("SELECT json_data FROM invoices").fetchall()
-    conn.close()
-    invoices = [json.loads(row['json_data']) for row in rows if row['json_data']]
+    invoices = await invoice_repo.all_data()
     
     # Use GST-compliant generator (NOT legacy)
     xml_content = generate_gst_tally_xml(
@@ -3155,10 +3365,8 @@ async def validate_export_endpoint(
     4. CGST/IGST state consistency
     5. Negative tax only for Credit Notes
     """
-    conn = get_db_connection()
     try:
-        rows = conn.execute("SELECT json_data FROM invoices").fetchall()
-        invoices = [json.loads(row['json_data']) for row in rows if row['json_data']]
+        invoices = await invoice_repo.all_data()
         
         validation = validate_before_export(
             invoices=invoices,
@@ -3170,8 +3378,6 @@ async def validate_export_endpoint(
     except Exception as e:
         print(f"❌ Validation Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 
 @app.get("/export/tally/gst")
@@ -3193,10 +3399,8 @@ async def export_gst_tally_xml_endpoint(
     
     Use /export/tally/validate first to check for errors.
     """
-    conn = get_db_connection()
     try:
-        rows = conn.execute("SELECT json_data FROM invoices").fetchall()
-        invoices = [json.loads(row['json_data']) for row in rows if row['json_data']]
+        invoices = await invoice_repo.all_data()
         
         # ===== VALIDATION LAYER (FINAL AUTHORITY) =====
         if not skip_validation:
@@ -3237,8 +3441,6 @@ async def export_gst_tally_xml_endpoint(
     except Exception as e:
         print(f"❌ GST Tally Export Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.get("/export/tally/gst/preview")
 async def preview_gst_tally_xml(
@@ -3250,10 +3452,8 @@ async def preview_gst_tally_xml(
     Preview the GST-compliant XML without downloading.
     Returns the XML content as formatted text for inspection.
     """
-    conn = get_db_connection()
     try:
-        rows = conn.execute("SELECT json_data FROM invoices LIMIT 3").fetchall()
-        invoices = [json.loads(row['json_data']) for row in rows if row['json_data']]
+        invoices = await invoice_repo.all_data(limit=3)
        # Generate XML
         try:
             xml_content = await generate_gst_tally_xml(
@@ -3277,8 +3477,6 @@ async def preview_gst_tally_xml(
     except Exception as e:
         print(f"❌ GST Preview Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 
 # ============================================================================
@@ -3289,22 +3487,9 @@ async def get_invoices_grouped_by_vendor():
     Get all invoices grouped by vendor name for bulk ledger assignment.
     Returns vendors with bill counts and current ledger assignments.
     """
-    conn = get_db_connection()
     try:
-        # Group invoices by vendor
-        groups = conn.execute('''
-            SELECT 
-                vendor_name,
-                COUNT(*) as bill_count,
-                SUM(grand_total) as total_amount,
-                ledger_name,
-                group_name,
-                MIN(id) as sample_id
-            FROM invoices 
-            WHERE vendor_name IS NOT NULL AND vendor_name != ''
-            GROUP BY vendor_name
-            ORDER BY bill_count DESC
-        ''').fetchall()
+        # Group invoices by vendor (+ count of bills without one)
+        groups, unassigned_count = await invoice_repo.group_by_vendor()
         
         result = []
         for group in groups:
@@ -3317,22 +3502,14 @@ async def get_invoices_grouped_by_vendor():
                 'sample_id': group['sample_id']
             })
         
-        # Also get unassigned count
-        unassigned = conn.execute('''
-            SELECT COUNT(*) as count FROM invoices 
-            WHERE vendor_name IS NULL OR vendor_name = '' OR vendor_name = 'Cash Sales'
-        ''').fetchone()
-        
         return {
             'vendors': result,
-            'unassigned_count': unassigned['count'],
+            'unassigned_count': unassigned_count,
             'total_vendors': len(result)
         }
     except Exception as e:
         print(f"❌ Error grouping invoices: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 # ============================================================================
 # TALLY SIMULATION - Pre-check bills before export
@@ -3344,9 +3521,8 @@ async def simulate_tally_export():
     Simulate Tally export to catch issues before actual export.
     Returns categorized list of: ready, warnings, and errors.
     """
-    conn = get_db_connection()
     try:
-        rows = conn.execute("SELECT id, json_data, vendor_name, grand_total, ledger_name, invoice_date FROM invoices").fetchall()
+        rows = await invoice_repo.export_rows()
         
         ready = []
         warnings = []
@@ -3359,11 +3535,6 @@ async def simulate_tally_export():
             ledger = row['ledger_name']
             date = row['invoice_date']
             
-            try:
-                data = json.loads(row['json_data']) if row['json_data'] else {}
-            except:
-                data = {}
-            
             issues = []
             is_error = False
             
@@ -3386,15 +3557,15 @@ async def simulate_tally_export():
             if vendor == 'Cash Sales':
                 issues.append("Generic 'Cash Sales' vendor")
             
-            gst_no = data.get('gst_no', '')
+            gst_no = row['gst_no']
             if not gst_no:
                 issues.append("No GSTIN - ledger won't have GST details")
             
-            # Math check
-            taxable = data.get('taxable_value', 0) or 0
-            cgst = data.get('cgst_amount', 0) or 0
-            sgst = data.get('sgst_amount', 0) or 0
-            igst = data.get('igst_amount', 0) or 0
+            # Math check (promoted columns - no json_data parsing)
+            taxable = row['taxable_value'] or 0
+            cgst = row['cgst_amount'] or 0
+            sgst = row['sgst_amount'] or 0
+            igst = row['igst_amount'] or 0
             calculated_total = taxable + cgst + sgst + igst
             
             if total > 0 and abs(calculated_total - total) > 1:
@@ -3403,7 +3574,7 @@ async def simulate_tally_export():
             invoice_summary = {
                 'id': invoice_id,
                 'vendor_name': vendor,
-                'invoice_no': data.get('invoice_no', 'N/A'),
+                'invoice_no': row['invoice_no'] or 'N/A',
                 'grand_total': total,
                 'ledger_name': ledger or 'Purchase A/c',
                 'issues': issues
@@ -3432,8 +3603,6 @@ async def simulate_tally_export():
     except Exception as e:
         print(f"❌ Simulation error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 
 @app.post("/invoices/bulk-update-ledger")
@@ -3447,49 +3616,17 @@ async def bulk_update_ledger(
     Bulk update ledger and group for all invoices from a specific vendor,
     or for a list of specific invoice IDs.
     """
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        updated_count = 0
+        if not invoice_ids and not vendor_name:
+            raise HTTPException(status_code=400, detail="Provide vendor_name or invoice_ids")
+        updated_count, corrected_vendors = await invoice_repo.bulk_update_ledger(
+            ledger_name, group_name, invoice_ids=invoice_ids, vendor_name=vendor_name
+        )
+        print(f"✅ Bulk updated {updated_count} invoices with ledger: {ledger_name}")
         
-        if invoice_ids:
-            # Update specific invoices
-            for inv_id in invoice_ids:
-                row = cursor.execute("SELECT json_data FROM invoices WHERE id = ?", (inv_id,)).fetchone()
-                if row:
-                    data = json.loads(row['json_data'])
-                    if ledger_name:
-                        data['ledger_name'] = ledger_name
-                    if group_name:
-                        data['group_name'] = group_name
-                    cursor.execute(
-                        "UPDATE invoices SET json_data = ?, ledger_name = ?, group_name = ? WHERE id = ?",
-                        (json.dumps(data), ledger_name, group_name, inv_id)
-                    )
-                    updated_count += 1
-        elif vendor_name:
-            # Update all invoices from this vendor
-            rows = cursor.execute(
-                "SELECT id, json_data FROM invoices WHERE vendor_name = ?", 
-                (vendor_name,)
-            ).fetchall()
-            
-            for row in rows:
-                data = json.loads(row['json_data'])
-                if ledger_name:
-                    data['ledger_name'] = ledger_name
-                if group_name:
-                    data['group_name'] = group_name
-                cursor.execute(
-                    "UPDATE invoices SET json_data = ?, ledger_name = ?, group_name = ? WHERE id = ?",
-                    (json.dumps(data), ledger_name, group_name, row['id'])
-                )
-                updated_count += 1
-        else:
-            raise HTTPException(status_code=400, detail="Provide vendor_name or invoice_ids")
-        
-        conn.commit()
-        print(f"✅ Bulk updated {updated_count} invoices with ledger: {ledger_name}")
+        # The user corrected these vendors - stop serving cached AI classifications for them
+        for corrected in corrected_vendors:
+            await run_blocking(response_cache.invalidate_vendor, corrected)
         
         return {
             'status': 'success',
@@ -3502,8 +3639,6 @@ async def bulk_update_ledger(
     except Exception as e:
         print(f"❌ Bulk update error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 # Standard Tally ledger options
 TALLY_LEDGERS = [
@@ -3573,7 +3708,8 @@ TEMPLATES = [
 ]
 
 @app.get("/communications/scheduled")
-async def get_scheduled_communications(user_id: int = Depends(get_user_id_from_token)):
+@on_db_thread
+def get_scheduled_communications(user_id: int = Depends(get_user_id_from_token)):
     """Get today's scheduled communications from database"""
     conn = get_db_connection()
     try:
@@ -3610,7 +3746,8 @@ async def get_scheduled_communications(user_id: int = Depends(get_user_id_from_t
         conn.close()
 
 @app.get("/communications/recent")
-async def get_recent_communications(user_id: int = Depends(get_user_id_from_token)):
+@on_db_thread
+def get_recent_communications(user_id: int = Depends(get_user_id_from_token)):
     """Get recent communication history from database"""
     conn = get_db_connection()
     try:
@@ -3656,7 +3793,8 @@ async def get_templates(channel: str = None):
     return TEMPLATES
 
 @app.post("/whatsapp/send")
-async def send_whatsapp(data: dict):
+@on_db_thread
+def send_whatsapp(data: dict):
     """
     Send WhatsApp message - generates a wa.me link and logs to database
     """
@@ -3718,7 +3856,8 @@ async def send_whatsapp(data: dict):
         conn.close()
 
 @app.post("/email/send")
-async def send_email(data: dict):
+@on_db_thread
+def send_email(data: dict):
     """Send email - logs to database (SMTP integration ready)"""
     conn = get_db_connection()
     try:
@@ -3764,7 +3903,8 @@ async def send_email(data: dict):
         conn.close()
 
 @app.post("/sms/send")
-async def send_sms(data: dict):
+@on_db_thread
+def send_sms(data: dict):
     """Send SMS - logs to database"""
     conn = get_db_connection()
     try:
@@ -3808,7 +3948,8 @@ async def send_sms(data: dict):
         conn.close()
 
 @app.post("/calls/schedule")
-async def schedule_call(data: dict):
+@on_db_thread
+def schedule_call(data: dict):
     """Schedule a call reminder"""
     conn = get_db_connection()
     try:
@@ -3854,7 +3995,8 @@ async def schedule_call(data: dict):
         conn.close()
 
 @app.get("/communications/analytics")
-async def get_communication_analytics(user_id: int = Depends(get_user_id_from_token)):
+@on_db_thread
+def get_communication_analytics(user_id: int = Depends(get_user_id_from_token)):
     """Get real communication statistics from database"""
     conn = get_db_connection()
     try:
@@ -3922,7 +4064,8 @@ async def get_communication_analytics(user_id: int = Depends(get_user_id_from_to
         conn.close()
 
 @app.get("/communications/client/{client_id}")
-async def get_client_communications(client_id: int):
+@on_db_thread
+def get_client_communications(client_id: int):
     """Get all communications for a specific client"""
     conn = get_db_connection()
     try:
@@ -3965,59 +4108,26 @@ async def get_clients(
     user_id: int = Depends(get_user_id_from_token)
 ):
     """Get all clients for the authenticated user with optional filtering"""
-    conn = get_db_connection()
     try:
-        # CRITICAL: Filter by user_id for multi-tenant isolation
-        query = "SELECT * FROM clients WHERE user_id = ?"
-        params = [user_id]
-        
-        if status:
-            query += " AND status = ?"
-            params.append(status)
-        
-        if search:
-            query += " AND (company_name LIKE ? OR gstin LIKE ? OR phone LIKE ?)"
-            search_term = f"%{search}%"
-            params.extend([search_term, search_term, search_term])
-        
-        query += " ORDER BY company_name ASC"
-        
-        clients = conn.execute(query, params).fetchall()
-        return [dict(row) for row in clients]
+        # CRITICAL: Filtered by user_id for multi-tenant isolation
+        return await client_repo.list(user_id, status=status, search=search)
     except Exception as e:
         print(f"❌ Error fetching clients: {e}")
         return []
-    finally:
-        conn.close()
 
 @app.get("/clients/{client_id}")
 async def get_client(client_id: int):
     """Get single client details with document count"""
-    conn = get_db_connection()
     try:
-        client = conn.execute("SELECT * FROM clients WHERE id = ?", (client_id,)).fetchone()
-        if not client:
+        result = await client_repo.get(client_id)
+        if not result:
             raise HTTPException(status_code=404, detail="Client not found")
-        
-        # Count documents for this client
-        doc_count = conn.execute("SELECT COUNT(*) as count FROM documents WHERE client_id = ?", (client_id,)).fetchone()
-        invoice_count = conn.execute("SELECT COUNT(*) as count FROM invoices WHERE client_id = ?", (client_id,)).fetchone()
-        
-        result = dict(client)
-        result['document_count'] = doc_count['count'] + invoice_count['count']
-        result['pending_review_count'] = conn.execute(
-            "SELECT COUNT(*) as count FROM documents WHERE client_id = ? AND review_status = 'pending'", 
-            (client_id,)
-        ).fetchone()['count']
-        
         return result
     except HTTPException:
         raise
     except Exception as e:
         print(f"❌ Error fetching client: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.post("/clients")
 async def create_client(
@@ -4025,20 +4135,8 @@ async def create_client(
     user_id: int = Depends(get_user_id_from_token)
 ):
     """Create new client for the authenticated user"""
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO clients (company_name, gstin, pan, contact_person, phone, email, 
-                                address, city, state, financial_year_start, client_type, user_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            client.company_name, client.gstin, client.pan, client.contact_person,
-            client.phone, client.email, client.address, client.city, client.state,
-            client.financial_year_start, client.client_type, user_id
-        ))
-        conn.commit()
-        new_id = cursor.lastrowid
+        new_id = await client_repo.create(client.dict(), user_id)
         print(f"✅ Client created: {client.company_name} (ID: {new_id}) for user_id: {user_id}")
         return {"id": new_id, "status": "success", "message": "Client created successfully"}
     except sqlite3.IntegrityError:
@@ -4046,26 +4144,16 @@ async def create_client(
     except Exception as e:
         print(f"❌ Error creating client: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.put("/clients/{client_id}")
 async def update_client(client_id: int, client: ClientUpdate):
     """Update client details"""
-    conn = get_db_connection()
     try:
         updates = client.dict(exclude_unset=True)
         if not updates:
             raise HTTPException(status_code=400, detail="No fields to update")
         
-        set_clause = ", ".join([f"{key} = ?" for key in updates.keys()])
-        query = f"UPDATE clients SET {set_clause}, last_activity_date = CURRENT_TIMESTAMP WHERE id = ?"
-        
-        cursor = conn.cursor()
-        cursor.execute(query, list(updates.values()) + [client_id])
-        conn.commit()
-        
-        if cursor.rowcount == 0:
+        if await client_repo.update(client_id, updates) == 0:
             raise HTTPException(status_code=404, detail="Client not found")
         
         print(f"✅ Client updated: ID {client_id}")
@@ -4075,19 +4163,12 @@ async def update_client(client_id: int, client: ClientUpdate):
     except Exception as e:
         print(f"❌ Error updating client: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.delete("/clients/{client_id}")
 async def delete_client(client_id: int):
     """Delete client (soft delete by setting status to Inactive)"""
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE clients SET status = 'Inactive' WHERE id = ?", (client_id,))
-        conn.commit()
-        
-        if cursor.rowcount == 0:
+        if await client_repo.deactivate(client_id) == 0:
             raise HTTPException(status_code=404, detail="Client not found")
         
         print(f"✅ Client deactivated: ID {client_id}")
@@ -4097,43 +4178,14 @@ async def delete_client(client_id: int):
     except Exception as e:
         print(f"❌ Error deleting client: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.get("/clients/{client_id}/stats")
 async def get_client_stats(client_id: int):
     """Get client statistics for profile page"""
-    conn = get_db_connection()
     try:
-        # Total documents (from both tables)
-        doc_count = conn.execute(
-            "SELECT COUNT(*) as count FROM documents WHERE client_id = ?", (client_id,)
-        ).fetchone()['count']
-        invoice_count = conn.execute(
-            "SELECT COUNT(*) as count FROM invoices WHERE client_id = ?", (client_id,)
-        ).fetchone()['count']
-        
-        # Pending review
-        pending = conn.execute(
-            "SELECT COUNT(*) as count FROM documents WHERE client_id = ? AND review_status = 'pending'",
-            (client_id,)
-        ).fetchone()['count']
-        
-        # Last activity
-        last_doc = conn.execute(
-            "SELECT upload_date FROM documents WHERE client_id = ? ORDER BY upload_date DESC LIMIT 1",
-            (client_id,)
-        ).fetchone()
-        last_inv = conn.execute(
-            "SELECT upload_date FROM invoices WHERE client_id = ? ORDER BY upload_date DESC LIMIT 1",
-            (client_id,)
-        ).fetchone()
-        
-        last_activity = None
-        if last_doc:
-            last_activity = last_doc['upload_date']
-        if last_inv and (not last_activity or last_inv['upload_date'] > last_activity):
-            last_activity = last_inv['upload_date']
+        # Documents, pending review, last upload
+        stats = await client_repo.stats(client_id)
+        last_activity = stats["last_activity"]
         
         # Format last activity
         if last_activity:
@@ -4145,18 +4197,17 @@ async def get_client_stats(client_id: int):
                 pass
         
         return {
-            "totalBills": doc_count + invoice_count,
-            "pending": pending,
+            "totalBills": stats["total_bills"],
+            "pending": stats["pending"],
             "lastActivity": last_activity or "No activity"
         }
     except Exception as e:
         print(f"❌ Error fetching client stats: {e}")
         return {"totalBills": 0, "pending": 0, "lastActivity": "N/A"}
-    finally:
-        conn.close()
 
 @app.post("/clients/{client_id}/generate-invite")
-async def generate_client_invite(client_id: int):
+@on_db_thread
+def generate_client_invite(client_id: int):
     """Generate a self-service invite link for client"""
     import secrets
     conn = get_db_connection()
@@ -4194,7 +4245,8 @@ async def generate_client_invite(client_id: int):
 # ============================================================================
 
 @app.get("/vendor/verify-gst/{gstin}")
-async def verify_vendor_gst(gstin: str):
+@on_db_thread
+def verify_vendor_gst(gstin: str):
     """
     Check if a vendor's GSTIN is active using pattern analysis.
     In production, this would call the actual GST API.
@@ -4273,35 +4325,29 @@ async def bulk_verify_vendors():
     Verify all vendors with GSTIN in the database.
     Returns list of vendors with their GST status.
     """
-    conn = get_db_connection()
-    try:
-        vendors = conn.execute(
-            "SELECT id, vendor_name, gstin FROM vendors WHERE gstin IS NOT NULL AND gstin != ''"
-        ).fetchall()
-        
-        results = []
-        for vendor in vendors:
-            result = await verify_vendor_gst(vendor['gstin'])
-            result['vendor_id'] = vendor['id']
-            result['vendor_name'] = vendor['vendor_name']
-            results.append(result)
-        
-        # Summary
-        active_count = sum(1 for r in results if r['status'] == 'active')
-        cancelled_count = sum(1 for r in results if r['status'] == 'cancelled')
-        invalid_count = sum(1 for r in results if r['status'] == 'invalid')
-        
-        return {
-            "vendors": results,
-            "summary": {
-                "total": len(results),
-                "active": active_count,
-                "cancelled": cancelled_count,
-                "invalid": invalid_count
-            }
+    vendors = await vendor_repo.with_gstin()
+    
+    results = []
+    for vendor in vendors:
+        result = await verify_vendor_gst(vendor['gstin'])
+        result['vendor_id'] = vendor['id']
+        result['vendor_name'] = vendor['vendor_name']
+        results.append(result)
+    
+    # Summary
+    active_count = sum(1 for r in results if r['status'] == 'active')
+    cancelled_count = sum(1 for r in results if r['status'] == 'cancelled')
+    invalid_count = sum(1 for r in results if r['status'] == 'invalid')
+    
+    return {
+        "vendors": results,
+        "summary": {
+            "total": len(results),
+            "active": active_count,
+            "cancelled": cancelled_count,
+            "invalid": invalid_count
         }
-    finally:
-        conn.close()
+    }
 
 # ============================================================================
 # LEGAL EAGLE - GST Notice Responder System
@@ -4319,10 +4365,62 @@ GST_NOTICE_TYPES = {
     'GSTR-3A': {'name': 'Default Notice', 'section': 'Section 46', 'severity': 'medium'}
 }
 
+def _save_legal_notice(client_id, notice_type, notice_details: dict, file_path, draft_reply) -> int:
+    """Store an analyzed notice in legal_notices (blocking - run via run_db). Returns its id."""
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS legal_notices (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                client_id INTEGER,
+                notice_type TEXT,
+                notice_date TEXT,
+                due_date TEXT,
+                issue_summary TEXT,
+                demand_amount REAL,
+                period TEXT,
+                officer_name TEXT,
+                reference_no TEXT,
+                file_path TEXT,
+                status TEXT DEFAULT 'pending',
+                draft_reply TEXT,
+                final_reply TEXT,
+                submitted_on TEXT,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO legal_notices (
+                client_id, notice_type, notice_date, due_date, issue_summary,
+                demand_amount, period, officer_name, reference_no, file_path,
+                draft_reply, status
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            client_id,
+            notice_type,
+            notice_details.get('NOTICE_DATE'),
+            notice_details.get('DUE_DATE'),
+            notice_details.get('ISSUE'),
+            notice_details.get('DEMAND_AMOUNT'),
+            notice_details.get('PERIOD'),
+            notice_details.get('OFFICER_NAME'),
+            notice_details.get('ARN/DIN'),
+            file_path,
+            draft_reply,
+            'pending'
+        ))
+        conn.commit()
+        return cursor.lastrowid
+    finally:
+        conn.close()
+
 @app.post("/legal/analyze-notice")
 async def analyze_legal_notice(
     file: UploadFile = File(...),
-    client_id: int = None
+    client_id: int = None,
+    authorization: str = Header(None)
 ):
     """
     Analyze a GST notice using AI and draft a formal reply.
@@ -4330,15 +4428,12 @@ async def analyze_legal_notice(
     2. Drafts professional reply citing GST sections
     """
     print(f"⚖️ Legal Eagle: Analyzing notice {file.filename}")
+    set_attribution(flow="legal_notice", user_id=_optional_user_id(authorization), client_id=client_id)
     
-    # Save the file
-    import uuid
-    unique_filename = f"notice_{uuid.uuid4()}_{file.filename}"
-    file_path = os.path.join(UPLOAD_DIR, unique_filename)
-    file_content = await file.read()
-    
-    with open(file_path, "wb") as buffer:
-        buffer.write(file_content)
+    # Save the file (streamed, content-addressed); the vision call below still needs the bytes
+    stored = await save_upload(file)
+    file_path = stored.path
+    file_content = await run_blocking(read_file, file_path)
     
     # Extract text using AI
     try:
@@ -4369,14 +4464,12 @@ Return as JSON only, no markdown."""
                 extracted_text = "" # Or handle as appropriate, e.g., re-raise or return error
             
             # Parse extraction response
-            extraction_text = clean_json_response(extracted_text)
-            
             try:
-                notice_details = json.loads(extraction_text)
+                notice_details = parse_json_tolerant(extracted_text)
             except:
                 notice_details = {
                     'NOTICE_TYPE': 'Unknown',
-                    'ISSUE': extraction_text[:200]
+                    'ISSUE': extracted_text[:200]
                 }
             
             # Get notice metadata
@@ -4401,7 +4494,7 @@ Draft a professional reply that:
 Keep the tone formal and respectful. Use proper legal formatting."""
             
             print("📝 Drafting reply with Hermes 3 405B...")
-            draft_reply = call_logic_model(reply_prompt)
+            draft_reply = await call_logic_model(reply_prompt)
 
             
         else:
@@ -4414,55 +4507,8 @@ Keep the tone formal and respectful. Use proper legal formatting."""
             notice_type = 'Unknown'
             notice_info = {'name': 'Unknown', 'section': 'N/A', 'severity': 'medium'}
         
-        # Store notice in database (create notices table if not exists)
-        conn = get_db_connection()
-        try:
-            conn.execute('''
-                CREATE TABLE IF NOT EXISTS legal_notices (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    client_id INTEGER,
-                    notice_type TEXT,
-                    notice_date TEXT,
-                    due_date TEXT,
-                    issue_summary TEXT,
-                    demand_amount REAL,
-                    period TEXT,
-                    officer_name TEXT,
-                    reference_no TEXT,
-                    file_path TEXT,
-                    status TEXT DEFAULT 'pending',
-                    draft_reply TEXT,
-                    final_reply TEXT,
-                    submitted_on TEXT,
-                    created_at TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO legal_notices (
-                    client_id, notice_type, notice_date, due_date, issue_summary,
-                    demand_amount, period, officer_name, reference_no, file_path,
-                    draft_reply, status
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                client_id,
-                notice_type,
-                notice_details.get('NOTICE_DATE'),
-                notice_details.get('DUE_DATE'),
-                notice_details.get('ISSUE'),
-                notice_details.get('DEMAND_AMOUNT'),
-                notice_details.get('PERIOD'),
-                notice_details.get('OFFICER_NAME'),
-                notice_details.get('ARN/DIN'),
-                file_path,
-                draft_reply,
-                'pending'
-            ))
-            conn.commit()
-            notice_id = cursor.lastrowid
-        finally:
-            conn.close()
+        # Store notice in database (create notices table if not exists) - on the DB threads
+        notice_id = await run_db(_save_legal_notice, client_id, notice_type, notice_details, file_path, draft_reply)
         
         return {
             "id": notice_id,
@@ -4484,7 +4530,8 @@ Keep the tone formal and respectful. Use proper legal formatting."""
         }
 
 @app.get("/legal/notices")
-async def get_legal_notices(client_id: int = None, user_id: int = Depends(get_user_id_from_token)):
+@on_db_thread
+def get_legal_notices(client_id: int = None, user_id: int = Depends(get_user_id_from_token)):
     """Get all legal notices, optionally filtered by client"""
     conn = get_db_connection()
     try:
@@ -4559,7 +4606,8 @@ async def get_legal_notices(client_id: int = None, user_id: int = Depends(get_us
         conn.close()
 
 @app.get("/legal/notice/{notice_id}")
-async def get_notice_detail(notice_id: int, user_id: int = Depends(get_user_id_from_token)):
+@on_db_thread
+def get_notice_detail(notice_id: int, user_id: int = Depends(get_user_id_from_token)):
     """Get detailed view of a specific notice including draft reply"""
     conn = get_db_connection()
     try:
@@ -4600,7 +4648,8 @@ async def get_notice_detail(notice_id: int, user_id: int = Depends(get_user_id_f
         conn.close()
 
 @app.put("/legal/notice/{notice_id}")
-async def update_notice(notice_id: int, final_reply: str = None, status: str = None):
+@on_db_thread
+def update_notice(notice_id: int, final_reply: str = None, status: str = None):
     """Update notice with final reply or status change"""
     conn = get_db_connection()
     try:
@@ -4634,53 +4683,11 @@ async def update_notice(notice_id: int, final_reply: str = None, status: str = N
 @app.get("/clients/{client_id}/documents")
 async def get_client_documents(client_id: int, doc_type: str = None):
     """Get all documents for a specific client"""
-    conn = get_db_connection()
     try:
-        # Get from new documents table
-        query = "SELECT * FROM documents WHERE client_id = ?"
-        params = [client_id]
-        
-        if doc_type:
-            query += " AND doc_type = ?"
-            params.append(doc_type)
-        
-        query += " ORDER BY invoice_date DESC, id DESC"
-        
-        documents = conn.execute(query, params).fetchall()
-        results = []
-        
-        for row in documents:
-            doc = dict(row)
-            # Parse json_data if exists
-            if doc.get('json_data'):
-                try:
-                    json_data = json.loads(doc['json_data'])
-                    doc.update(json_data)
-                except:
-                    pass
-            results.append(doc)
-        
-        # Also get from legacy invoices table
-        legacy = conn.execute(
-            "SELECT * FROM invoices WHERE client_id = ? ORDER BY id DESC",
-            (client_id,)
-        ).fetchall()
-        
-        for row in legacy:
-            try:
-                data = json.loads(row['json_data'])
-                data['id'] = row['id']
-                data['is_legacy'] = True
-                results.append(data)
-            except:
-                continue
-        
-        return results
+        return await client_repo.documents(client_id, doc_type=doc_type)
     except Exception as e:
         print(f"❌ Error fetching client documents: {e}")
         return []
-    finally:
-        conn.close()
 
 print("✅ Client Management System loaded!")
 print("📊 Client endpoints:")
@@ -4699,44 +4706,18 @@ print("   GET    /clients/{id}/documents")
 @app.get("/vendors")
 async def get_vendors(search: str = None, vendor_type: str = None):
     """Get all vendors with optional search and filtering"""
-    conn = get_db_connection()
     try:
-        query = "SELECT * FROM vendors WHERE 1=1"
-        params = []
-        
-        if search:
-            query += " AND vendor_name LIKE ?"
-            params.append(f"%{search}%")
-        
-        if vendor_type:
-            query += " AND vendor_type = ?"
-            params.append(vendor_type)
-        
-        query += " ORDER BY frequency_count DESC, vendor_name ASC"
-        
-        vendors = conn.execute(query, params).fetchall()
-        return [dict(row) for row in vendors]
+        return await vendor_repo.list(search=search, vendor_type=vendor_type)
     except Exception as e:
         print(f"❌ Error fetching vendors: {e}")
         return []
-    finally:
-        conn.close()
 
 @app.get("/vendors/autocomplete")
 async def vendor_autocomplete(q: str):
     """Smart vendor autocomplete with fuzzy matching and similarity scores"""
-    conn = get_db_connection()
     try:
         # First, try exact/LIKE search
-        search_term = f"%{q}%"
-        vendors = conn.execute('''
-            SELECT id, vendor_name, gstin, default_hsn, default_ledger, default_group, 
-                   frequency_count, last_used_date
-            FROM vendors 
-            WHERE vendor_name LIKE ? 
-            ORDER BY frequency_count DESC, vendor_name ASC 
-            LIMIT 10
-        ''', (search_term,)).fetchall()
+        vendors = await vendor_repo.search(q, limit=10)
         
         results = []
         q_lower = q.lower().strip()
@@ -4764,14 +4745,12 @@ async def vendor_autocomplete(q: str):
         
         # If no exact matches, try fuzzy matching
         if len(results) == 0 and len(q) >= 3:
-            fuzzy_matches = find_similar_vendors(q, threshold=0.4)
+            fuzzy_matches = await run_db(find_similar_vendors, q, threshold=0.4)
+            # Full vendor details in one query
+            details = await vendor_repo.get_many(vendor_id for vendor_id, _, _ in fuzzy_matches)
             for vendor_id, vendor_name, similarity in fuzzy_matches:
-                # Get full vendor details
-                vendor = conn.execute(
-                    "SELECT * FROM vendors WHERE id = ?", (vendor_id,)
-                ).fetchone()
-                if vendor:
-                    v = dict(vendor)
+                if vendor_id in details:
+                    v = dict(details[vendor_id])
                     v['similarity'] = similarity
                     v['fuzzy_match'] = True
                     v['usage_label'] = f"Used {v.get('frequency_count', 0)} times"
@@ -4785,41 +4764,23 @@ async def vendor_autocomplete(q: str):
     except Exception as e:
         print(f"❌ Error in vendor autocomplete: {e}")
         return []
-    finally:
-        conn.close()
 
 @app.post("/vendors")
 async def create_vendor(vendor: VendorCreate):
     """Create new vendor or return existing if similar name found"""
-    conn = get_db_connection()
     try:
         # Check for similar vendor names (prevent duplicates)
-        similar = conn.execute('''
-            SELECT * FROM vendors 
-            WHERE LOWER(vendor_name) = LOWER(?) 
-            OR LOWER(vendor_name) LIKE LOWER(?)
-        ''', (vendor.vendor_name, f"%{vendor.vendor_name}%")).fetchone()
+        similar = await vendor_repo.find_similar_name(vendor.vendor_name)
         
         if similar:
             return {
                 "status": "exists",
                 "message": f"Similar vendor exists: {similar['vendor_name']}",
-                "existing_vendor": dict(similar),
+                "existing_vendor": similar,
                 "suggestion": "Use existing vendor or modify name"
             }
         
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO vendors (vendor_name, gstin, pan, phone, email, address, 
-                                vendor_type, default_hsn, default_ledger, default_group)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            vendor.vendor_name, vendor.gstin, vendor.pan, vendor.phone, vendor.email,
-            vendor.address, vendor.vendor_type, vendor.default_hsn, 
-            vendor.default_ledger, vendor.default_group
-        ))
-        conn.commit()
-        new_id = cursor.lastrowid
+        new_id = await vendor_repo.create(vendor.dict())
         print(f"✅ Vendor created: {vendor.vendor_name} (ID: {new_id})")
         return {"id": new_id, "status": "success", "message": "Vendor created successfully"}
     except sqlite3.IntegrityError:
@@ -4827,62 +4788,30 @@ async def create_vendor(vendor: VendorCreate):
     except Exception as e:
         print(f"❌ Error creating vendor: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.get("/vendors/{vendor_id}")
 async def get_vendor(vendor_id: int):
     """Get vendor details with usage statistics"""
-    conn = get_db_connection()
     try:
-        vendor = conn.execute("SELECT * FROM vendors WHERE id = ?", (vendor_id,)).fetchone()
-        if not vendor:
+        # Vendor + document count + 5 most recent documents
+        result = await vendor_repo.get(vendor_id)
+        if not result:
             raise HTTPException(status_code=404, detail="Vendor not found")
-        
-        result = dict(vendor)
-        
-        # Get document count
-        result['document_count'] = conn.execute(
-            "SELECT COUNT(*) as count FROM documents WHERE vendor_id = ?", 
-            (vendor_id,)
-        ).fetchone()['count']
-        
-        # Get recent documents
-        recent_docs = conn.execute('''
-            SELECT invoice_no, invoice_date, grand_total 
-            FROM documents 
-            WHERE vendor_id = ? 
-            ORDER BY invoice_date DESC 
-            LIMIT 5
-        ''', (vendor_id,)).fetchall()
-        
-        result['recent_documents'] = [dict(doc) for doc in recent_docs]
-        
         return result
     except HTTPException:
         raise
     except Exception as e:
         print(f"❌ Error fetching vendor: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.put("/vendors/{vendor_id}")
 async def update_vendor(vendor_id: int, updates: dict):
     """Update vendor details"""
-    conn = get_db_connection()
     try:
         if not updates:
             raise HTTPException(status_code=400, detail="No fields to update")
         
-        set_clause = ", ".join([f"{key} = ?" for key in updates.keys()])
-        query = f"UPDATE vendors SET {set_clause} WHERE id = ?"
-        
-        cursor = conn.cursor()
-        cursor.execute(query, list(updates.values()) + [vendor_id])
-        conn.commit()
-        
-        if cursor.rowcount == 0:
+        if await vendor_repo.update(vendor_id, updates) == 0:
             raise HTTPException(status_code=404, detail="Vendor not found")
         
         print(f"✅ Vendor updated: ID {vendor_id}")
@@ -4892,8 +4821,6 @@ async def update_vendor(vendor_id: int, updates: dict):
     except Exception as e:
         print(f"❌ Error updating vendor: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 def update_vendor_usage(vendor_id: int, conn):
     """Helper function to update vendor frequency counter"""
@@ -4951,43 +4878,12 @@ print("   PUT  /vendors/{id}")
 @app.get("/documents/pending-review")
 async def get_pending_documents(client_id: int = None):
     """Get all documents pending review"""
-    conn = get_db_connection()
     try:
-        query = '''
-            SELECT d.*, c.company_name as client_name, v.vendor_name as vendor_full_name
-            FROM documents d
-            LEFT JOIN clients c ON d.client_id = c.id
-            LEFT JOIN vendors v ON d.vendor_id = v.id
-            WHERE d.review_status IN ('pending', 'needs_review')
-        '''
-        params = []
-        
-        if client_id:
-            query += " AND d.client_id = ?"
-            params.append(client_id)
-        
-        query += " ORDER BY d.confidence_level ASC, d.entered_date DESC"
-        
-        documents = conn.execute(query, params).fetchall()
-        results = []
-        
-        for row in documents:
-            doc = dict(row)
-            # Parse json_data
-            if doc.get('json_data'):
-                try:
-                    json_data = json.loads(doc['json_data'])
-                    doc.update(json_data)
-                except:
-                    pass
-            results.append(doc)
-        
-        return results
+        # Least confident first, json_data merged into each row
+        return await document_repo.pending_review(client_id)
     except Exception as e:
         print(f"❌ Error fetching pending documents: {e}")
         return []
-    finally:
-        conn.close()
 
 @app.put("/documents/{doc_id}/review")
 async def review_document(doc_id: int, action: str, reviewed_by: str = None, notes: str = None):
@@ -4995,7 +4891,6 @@ async def review_document(doc_id: int, action: str, reviewed_by: str = None, not
     Review and approve/reject document
     Actions: approve, reject, request_clarification
     """
-    conn = get_db_connection()
     try:
         if action not in ['approve', 'reject', 'request_clarification']:
             raise HTTPException(status_code=400, detail="Invalid action")
@@ -5008,19 +4903,7 @@ async def review_document(doc_id: int, action: str, reviewed_by: str = None, not
         
         new_status = status_map[action]
         
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE documents 
-            SET review_status = ?, 
-                reviewed_by = ?, 
-                reviewed_date = CURRENT_TIMESTAMP,
-                internal_notes = COALESCE(internal_notes || ' | ', '') || ?
-            WHERE id = ?
-        ''', (new_status, reviewed_by, notes or f"Action: {action}", doc_id))
-        
-        conn.commit()
-        
-        if cursor.rowcount == 0:
+        if await document_repo.review(doc_id, new_status, reviewed_by, notes or f"Action: {action}") == 0:
             raise HTTPException(status_code=404, detail="Document not found")
         
         print(f"✅ Document {doc_id} {action}ed by {reviewed_by}")
@@ -5030,27 +4913,15 @@ async def review_document(doc_id: int, action: str, reviewed_by: str = None, not
     except Exception as e:
         print(f"❌ Error reviewing document: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.put("/documents/{doc_id}/add-note")
 async def add_document_note(doc_id: int, note: str, added_by: str = None):
     """Add internal note to document"""
-    conn = get_db_connection()
     try:
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
         note_with_meta = f"[{timestamp} - {added_by or 'Unknown'}] {note}"
         
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE documents 
-            SET internal_notes = COALESCE(internal_notes || '\n', '') || ?
-            WHERE id = ?
-        ''', (note_with_meta, doc_id))
-        
-        conn.commit()
-        
-        if cursor.rowcount == 0:
+        if await document_repo.add_note(doc_id, note_with_meta) == 0:
             raise HTTPException(status_code=404, detail="Document not found")
         
         print(f"✅ Note added to document {doc_id}")
@@ -5060,53 +4931,15 @@ async def add_document_note(doc_id: int, note: str, added_by: str = None):
     except Exception as e:
         print(f"❌ Error adding note: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.get("/documents/stats")
 async def get_document_stats(client_id: int = None):
     """Get document statistics and counts"""
-    conn = get_db_connection()
     try:
-        base_query = "SELECT COUNT(*) as count FROM documents WHERE 1=1"
-        params = []
-        
-        if client_id:
-            base_query += " AND client_id = ?"
-            params.append(client_id)
-        
-        total = conn.execute(base_query, params).fetchone()['count']
-        
-        pending_query = base_query + " AND review_status = 'pending'"
-        pending = conn.execute(pending_query, params).fetchone()['count']
-        
-        needs_review_query = base_query + " AND review_status = 'needs_review'"
-        needs_review = conn.execute(needs_review_query, params).fetchone()['count']
-        
-        approved_query = base_query + " AND review_status = 'approved'"
-        approved = conn.execute(approved_query, params).fetchone()['count']
-        
-        # Document type breakdown
-        doc_types = conn.execute('''
-            SELECT doc_type, COUNT(*) as count 
-            FROM documents 
-            WHERE 1=1 {}
-            GROUP BY doc_type
-        '''.format("AND client_id = ?" if client_id else ""), params).fetchall()
-        
-        return {
-            "total": total,
-            "pending": pending,
-            "needs_review": needs_review,
-            "approved": approved,
-            "rejected": total - pending - needs_review - approved,
-            "by_type": {row['doc_type']: row['count'] for row in doc_types}
-        }
+        return await document_repo.stats(client_id)
     except Exception as e:
         print(f"❌ Error fetching stats: {e}")
         return {}
-    finally:
-        conn.close()
 
 print("✅ Review & Approval Workflow loaded!")
 print("📝 Review endpoints:")
@@ -5126,79 +4959,25 @@ async def get_unassigned_documents():
     Get all documents without a client assigned - The 'Inbox' for old/messy files
     This keeps clean client folders 100% clean
     """
-    conn = get_db_connection()
     try:
-        # From documents table
-        docs = conn.execute('''
-            SELECT d.*, 'document' as source_table
-            FROM documents d
-            WHERE d.client_id IS NULL
-            ORDER BY d.entered_date DESC
-        ''').fetchall()
-        
-        # From legacy invoices table
-        invoices = conn.execute('''
-            SELECT i.*, 'invoice' as source_table
-            FROM invoices i
-            WHERE i.client_id IS NULL
-            ORDER BY i.upload_date DESC
-        ''').fetchall()
-        
-        results = []
-        
-        for row in docs:
-            doc = dict(row)
-            if doc.get('json_data'):
-                try:
-                    json_data = json.loads(doc['json_data'])
-                    doc.update(json_data)
-                except:
-                    pass
-            results.append(doc)
-        
-        for row in invoices:
-            doc = dict(row)
-            doc['source_table'] = 'invoice'
-            if doc.get('json_data'):
-                try:
-                    json_data = json.loads(doc['json_data'])
-                    doc.update(json_data)
-                except:
-                    pass
-            results.append(doc)
-        
+        results = await document_repo.unassigned()
         print(f"📥 Triage Area: {len(results)} unassigned documents")
         return results
     except Exception as e:
         print(f"❌ Error fetching unassigned: {e}")
         return []
-    finally:
-        conn.close()
 
 @app.put("/documents/{doc_id}/assign")
 async def assign_document_to_client(doc_id: int, client_id: int, source_table: str = "invoice"):
     """
     Assign a single document to a client
-    source_table: 'invoice' or 'document' depending on which table it's from
+    source_table: 'invoice' or 'document' - kept for old clients; both are the documents table now
     """
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        
-        if source_table == "document":
-            cursor.execute("UPDATE documents SET client_id = ? WHERE id = ?", (client_id, doc_id))
-        else:  # invoice (legacy table)
-            cursor.execute("UPDATE invoices SET client_id = ? WHERE id = ?", (client_id, doc_id))
-        
-        conn.commit()
-        
-        if cursor.rowcount == 0:
+        # Also touches the client's last activity
+        if await document_repo.assign([doc_id], client_id) == 0:
             raise HTTPException(status_code=404, detail="Document not found")
         
-        # Update client's last activity
-        cursor.execute("UPDATE clients SET last_activity_date = CURRENT_TIMESTAMP WHERE id = ?", (client_id,))
-        conn.commit()
-        
         print(f"✅ Document {doc_id} assigned to client {client_id}")
         return {"status": "success", "message": f"Document assigned to client {client_id}"}
     except HTTPException:
@@ -5206,85 +4985,44 @@ async def assign_document_to_client(doc_id: int, client_id: int, source_table: s
     except Exception as e:
         print(f"❌ Error assigning document: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.put("/documents/bulk-assign")
 async def bulk_assign_documents(doc_ids: list, client_id: int):
     """
     Assign multiple documents to a client at once
     Format: {"doc_ids": [{"id": 1, "source": "invoice"}, {"id": 5, "source": "document"}], "client_id": 3}
+    ("source" is ignored - every bill is in the documents table)
     """
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        assigned_count = 0
-        
-        for doc in doc_ids:
-            doc_id = doc.get('id')
-            source = doc.get('source', 'invoice')
-            
-            if source == "document":
-                cursor.execute("UPDATE documents SET client_id = ? WHERE id = ?", (client_id, doc_id))
-            else:
-                cursor.execute("UPDATE invoices SET client_id = ? WHERE id = ?", (client_id, doc_id))
-            
-            if cursor.rowcount > 0:
-                assigned_count += 1
-        
-        conn.commit()
-        
-        # Update client's last activity
-        cursor.execute("UPDATE clients SET last_activity_date = CURRENT_TIMESTAMP WHERE id = ?", (client_id,))
-        conn.commit()
+        # One transaction for the whole batch
+        assigned_count = await document_repo.assign([doc.get('id') for doc in doc_ids], client_id)
         
         print(f"✅ Bulk assigned {assigned_count} documents to client {client_id}")
         return {"status": "success", "assigned_count": assigned_count, "client_id": client_id}
     except Exception as e:
         print(f"❌ Error in bulk assign: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.get("/triage/stats")
 async def get_triage_stats(user_id: int = Depends(get_user_id_from_token)):
     """Get statistics for Triage Area (Unassigned Documents)"""
-    conn = get_db_connection()
     try:
-        # Count unassigned documents for authenticated user
-        docs_count = conn.execute("SELECT COUNT(*) as count FROM documents WHERE client_id IS NULL AND user_id = ?", (user_id,)).fetchone()['count']
-        invoices_count = conn.execute("SELECT COUNT(*) as count FROM invoices WHERE client_id IS NULL AND user_id = ?", (user_id,)).fetchone()['count']
-        
-        # Get age breakdown for authenticated user
-        today_count = conn.execute('''
-            SELECT COUNT(*) as count FROM invoices 
-            WHERE client_id IS NULL AND DATE(upload_date) = DATE('now') AND user_id = ?
-        ''', (user_id,)).fetchone()['count']
-        
-        week_count = conn.execute('''
-            SELECT COUNT(*) as count FROM invoices 
-            WHERE client_id IS NULL AND DATE(upload_date) >= DATE('now', '-7 days') AND user_id = ?
-        ''', (user_id,)).fetchone()['count']
-        
-        old_count = conn.execute('''
-            SELECT COUNT(*) as count FROM invoices 
-            WHERE client_id IS NULL AND DATE(upload_date) < DATE('now', '-7 days') AND user_id = ?
-        ''', (user_id,)).fetchone()['count']
+        # Unassigned count + age breakdown for authenticated user
+        counts = await document_repo.triage_stats(user_id)
+        total = counts["total"]
         
         return {
-            "total_unassigned": docs_count + invoices_count,
-            "from_documents_table": docs_count,
-            "from_invoices_table": invoices_count,
-            "uploaded_today": today_count,
-            "uploaded_this_week": week_count,
-            "older_than_week": old_count,
-            "message": f"📥 {docs_count + invoices_count} documents waiting in Triage Area"
+            "total_unassigned": total,
+            "from_documents_table": total,
+            "from_invoices_table": 0,  # one bill table now - kept for the frontend
+            "uploaded_today": counts["today"],
+            "uploaded_this_week": counts["week"],
+            "older_than_week": counts["old"],
+            "message": f"📥 {total} documents waiting in Triage Area"
         }
     except Exception as e:
         print(f"❌ Error fetching triage stats: {e}")
         return {"total_unassigned": 0}
-    finally:
-        conn.close()
 
 print("✅ Triage Area (Unassigned Documents) loaded!")
 print("📥 Triage endpoints:")
@@ -5387,8 +5125,8 @@ async def detect_hsn_ledger_group(invoice_data: dict) -> dict:
     4. Gemini AI smart guessing
     """
     
-    vendor_name = invoice_data.get('vendor_name', '').lower()
-    party_name = invoice_data.get('party_name', '').lower()
+    vendor_name = (invoice_data.get('vendor_name') or '').lower()
+    party_name = (invoice_data.get('party_name') or '').lower()
     description = f"{vendor_name} {party_name}".lower()
     
     # Try to get from invoice data
@@ -5452,8 +5190,21 @@ async def detect_hsn_ledger_group(invoice_data: dict) -> dict:
 async def gemini_smart_classify(vendor_name: str, party_name: str, description: str) -> dict:
     """
     Use Gemini AI to intelligently classify the invoice
-    when HSN/Ledger/Group cannot be determined from rules
+    when HSN/Ledger/Group cannot be determined from rules.
+    Answers are cached per normalized vendor/party/description (repeat vendors skip the model).
     """
+    cache_key = response_key(
+        "smart_classify", AI_MODELS["logic"],
+        vendor=vendor_key(vendor_name), party=vendor_key(party_name), description=normalize_text(description)
+    )
+    # Filed under whichever name made it cacheable, so a correction for that vendor/party invalidates it
+    owner = vendor_name if vendor_key(vendor_name) else party_name
+    cacheable = bool(vendor_key(owner))
+    cached = await run_blocking(response_cache.get, cache_key) if cacheable else None
+    if cached is not None:
+        print(f"⚡ Classification cache hit for {vendor_name}")
+        return cached
+
     try:
         prompt = f"""Analyze this business transaction and suggest:
 
@@ -5484,11 +5235,14 @@ Return ONLY JSON format:
 
         # Use Hermes 3 405B for HSN/ledger classification (reasoning task)
         print("🏷️ Classifying with Hermes 3 405B...")
-        response = await call_logic_model(prompt)
+        # Booked separately so classification shows up apart from the OCR it follows
+        with attribute(flow="classify"):
+            response = await call_logic_model(prompt)
         
         # Extract JSON from response
-        text = clean_json_response(response)
-        result = json.loads(text)
+        result = parse_json_tolerant(response)
+        if cacheable:
+            await run_blocking(response_cache.put, cache_key, "smart_classify", owner, result)
         return result
     
     except Exception as e:
@@ -5505,6 +5259,7 @@ print(f"📁 Loaded {len(GROUP_MAPPING)} group mappings")
 @app.post("/legal/analyze-notice")
 async def analyze_notice(file: UploadFile = File(...)):
     print(f"⚖️ Analyzing Legal Notice: {file.filename}")
+    set_attribution(flow="legal_notice")
     
     try:
         content = await file.read()
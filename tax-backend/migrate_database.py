@@ -1,10 +1,18 @@
 """
-Database migration for multi-tenant architecture
-Adds user_id columns to enable data isolation between users
+Database migrations
+- Multi-tenant architecture: adds user_id columns to enable data isolation between users
+- Promoted columns: copies hot json_data fields into real columns (batched, resumable)
+- One bill store: folds the legacy invoices table into documents, leaves an invoices view
 """
 
+import json
 import sqlite3
 
+from document_writer import PROMOTED_COLUMNS, promoted_values
+
+# Rows per transaction for the promoted-column backfill
+BACKFILL_BATCH_SIZE = 500
+
 def migrate_database_for_multi_tenancy(db_path="tax_data.db"):
     """
     Add user_id columns to all data tables to enable proper multi-tenant isolation.
@@ -118,9 +126,246 @@ def migrate_database_for_multi_tenancy(db_path="tax_data.db"):
         conn.close()
 
 
+def promote_json_columns(db_path="tax_data.db", batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Add PROMOTED_COLUMNS (taxable_value, cgst/sgst/igst_amount, tax_rate,
+    place_of_supply, vendor_state, gst_no) to invoices and documents and fill
+    them from json_data.
+    
+    The backfill walks each table by id, batch_size rows per transaction, and
+    records the last id done in migration_progress in the same transaction -
+    an interrupted run resumes where it stopped, a finished one is a no-op.
+    Rows written after the columns exist are kept in sync by the write paths.
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS migration_progress (
+                name TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL DEFAULT 0,
+                completed INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        conn.commit()
+        
+        columns = list(PROMOTED_COLUMNS)
+        # Never blank a value the row already has (gst_no, documents.taxable_value)
+        set_clause = ", ".join(f"{column} = COALESCE(?, {column})" for column in columns)
+        
+        for table in ("invoices", "documents"):
+            if not conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone():
+                continue
+            
+            # Columns (cheap, idempotent)
+            existing = [col[1] for col in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+            added = [column for column in columns if column not in existing]
+            for column in added:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {PROMOTED_COLUMNS[column]}")
+            conn.commit()
+            if added:
+                print(f"   ⚙️  {table}: added {', '.join(added)}")
+            
+            # Backfill (resumable)
+            name = f"promote_json_columns:{table}"
+            conn.execute("INSERT OR IGNORE INTO migration_progress (name) VALUES (?)", (name,))
+            conn.commit()
+            progress = conn.execute("SELECT last_id, completed FROM migration_progress WHERE name = ?", (name,)).fetchone()
+            if progress['completed']:
+                continue
+            
+            last_id, filled = progress['last_id'], 0
+            print(f"🔧 Backfilling promoted columns on {table} from id {last_id}...")
+            while True:
+                rows = conn.execute(
+                    f"SELECT id, json_data FROM {table} WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                updates = []
+                for row in rows:
+                    try:
+                        data = json.loads(row['json_data']) if row['json_data'] else {}
+                    except ValueError:
+                        data = {}
+                    if not isinstance(data, dict) or not data:
+                        continue   # nothing to promote - leave the row's columns as they are
+                    values = promoted_values(data)
+                    updates.append(tuple(values[column] for column in columns) + (row['id'],))
+                last_id = rows[-1]['id']
+                conn.executemany(f"UPDATE {table} SET {set_clause} WHERE id = ?", updates)
+                conn.execute("UPDATE migration_progress SET last_id = ? WHERE name = ?", (last_id, name))
+                conn.commit()
+                filled += len(updates)
+            
+            conn.execute("UPDATE migration_progress SET completed = 1 WHERE name = ?", (name,))
+            conn.commit()
+            print(f"   ✅ {table}: {filled} rows backfilled")
+        
+        return True
+        
+    except Exception as e:
+        print(f"\n❌ PROMOTED COLUMN MIGRATION FAILED: {e}")
+        conn.rollback()
+        return False
+        
+    finally:
+        conn.close()
+
+
+# Legacy invoices columns, in the order the invoices view exposes them
+# (the promoted columns follow)
+LEGACY_INVOICE_COLUMNS = [
+    "id", "invoice_no", "gst_no", "invoice_date", "vendor_name", "grand_total", "json_data",
+    "upload_date", "file_path", "payment_status", "is_manual", "hsn_code", "ledger_name",
+    "group_name", "client_id", "user_id",
+]
+
+# Columns documents needs to stand in for invoices
+CONSOLIDATION_COLUMNS = {
+    "user_id": "INTEGER",
+    # 0 = the bill was deleted from /history before consolidation (the old DELETE
+    # only removed the invoices row) - kept for the client folders, hidden from the view
+    "show_in_history": "INTEGER DEFAULT 1",
+    # id the row had in the old invoices table, for tracing pre-migration references
+    "legacy_invoice_id": "INTEGER",
+}
+
+
+def _object_type(conn, name):
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def _twin_document(candidates, inv):
+    """The unpaired document /upload wrote alongside this invoices row (same upload, same data)."""
+    for match in (lambda d: d['json_data'] == inv['json_data'],
+                  lambda d: d['upload_date'] == inv['upload_date'],
+                  lambda d: True):
+        for doc in candidates:
+            if match(doc):
+                return doc
+    return None
+
+
+def consolidate_invoices_into_documents(db_path="tax_data.db"):
+    """
+    One-shot: make documents the only bill table.
+    
+    Every bill used to be written twice - documents + the legacy invoices table -
+    and edits from /history (PUT /invoice, bulk ledger) only reached the invoices copy.
+    This migration, in one transaction:
+    1. Pairs each invoices row with its documents twin (same upload file) and copies
+       the invoice-side fields onto it (they carry the user's edits)
+    2. Inserts invoices rows that have no twin (manual entries, pre-documents uploads)
+    3. Hides documents whose invoices row was deleted (show_in_history = 0)
+    4. Renames the table to invoices_legacy and creates the invoices VIEW over
+       documents, so SELECTs in the legacy shape keep working
+    Returns True when documents is canonical (already, or now).
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    
+    try:
+        if _object_type(conn, "invoices") == "view":
+            return True
+        
+        print("\n🔧 Consolidating invoices into documents...")
+        conn.execute("BEGIN IMMEDIATE")
+        
+        existing = [col[1] for col in conn.execute("PRAGMA table_info(documents)").fetchall()]
+        for column, sql_type in {**CONSOLIDATION_COLUMNS, **PROMOTED_COLUMNS}.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE documents ADD COLUMN {column} {sql_type}")
+        
+        paired, inserted, hidden = set(), 0, 0
+        if _object_type(conn, "invoices") == "table":
+            legacy_columns = [col[1] for col in conn.execute("PRAGMA table_info(invoices)").fetchall()]
+            # gst_no is a legacy column already; the rest of the promoted columns follow it
+            tax_columns = [column for column in PROMOTED_COLUMNS if column != "gst_no"]
+            promoted_set = "".join(f", {column} = ?" for column in tax_columns)
+            by_file = {}
+            for doc in conn.execute(
+                "SELECT id, file_path, json_data, upload_date FROM documents WHERE file_path IS NOT NULL ORDER BY id"
+            ).fetchall():
+                by_file.setdefault(doc['file_path'], []).append(doc)
+            
+            for inv in conn.execute("SELECT * FROM invoices ORDER BY id").fetchall():
+                inv = {column: (inv[column] if column in legacy_columns else None) for column in LEGACY_INVOICE_COLUMNS}
+                try:
+                    data = json.loads(inv['json_data']) if inv['json_data'] else {}
+                except ValueError:
+                    data = {}
+                promoted = promoted_values(data if isinstance(data, dict) else {})
+                edited = (
+                    inv['invoice_no'], inv['gst_no'], inv['invoice_date'], inv['vendor_name'], inv['grand_total'],
+                    inv['json_data'], inv['payment_status'] or 'Unpaid', inv['hsn_code'], inv['ledger_name'],
+                    inv['group_name'],
+                ) + tuple(promoted[column] for column in tax_columns)
+                
+                candidates = [d for d in by_file.get(inv['file_path'], []) if d['id'] not in paired]
+                twin = _twin_document(candidates, inv)
+                if twin:
+                    paired.add(twin['id'])
+                    conn.execute(f'''
+                        UPDATE documents
+                        SET invoice_no = ?, gst_no = ?, invoice_date = ?, vendor_name = ?, grand_total = ?,
+                            json_data = ?, payment_status = ?, hsn_code = ?, ledger_name = ?, group_name = ?
+                            {promoted_set},
+                            client_id = COALESCE(?, client_id), user_id = COALESCE(?, user_id),
+                            show_in_history = 1, legacy_invoice_id = ?
+                        WHERE id = ?
+                    ''', edited + (inv['client_id'], inv['user_id'], inv['id'], twin['id']))
+                else:
+                    # Never went through review in documents - it was already in the books
+                    cursor = conn.execute(f'''
+                        INSERT INTO documents (
+                            invoice_no, gst_no, invoice_date, vendor_name, grand_total, json_data,
+                            payment_status, hsn_code, ledger_name, group_name, {", ".join(tax_columns)},
+                            client_id, user_id, legacy_invoice_id, file_path, is_manual,
+                            doc_type, review_status, entered_date, upload_date, show_in_history
+                        ) VALUES ({", ".join("?" for _ in range(10 + len(tax_columns) + 5))},
+                                  'gst_invoice', 'approved', ?, ?, 1)
+                    ''', edited + (inv['client_id'], inv['user_id'], inv['id'], inv['file_path'],
+                                    inv['is_manual'] or 0, inv['upload_date'], inv['upload_date']))
+                    paired.add(cursor.lastrowid)
+                    inserted += 1
+            
+            # Documents whose invoices row is gone were deleted from /history
+            hidden = conn.execute(
+                "UPDATE documents SET show_in_history = 0 WHERE legacy_invoice_id IS NULL AND show_in_history = 1"
+            ).rowcount
+            conn.execute("ALTER TABLE invoices RENAME TO invoices_legacy")
+        
+        view_columns = LEGACY_INVOICE_COLUMNS + [c for c in PROMOTED_COLUMNS if c not in LEGACY_INVOICE_COLUMNS]
+        conn.execute(f'''
+            CREATE VIEW invoices AS
+            SELECT {", ".join(view_columns)}
+            FROM documents
+            WHERE show_in_history = 1
+        ''')
+        conn.commit()
+        
+        print(f"   ✅ {len(paired) - inserted} invoices merged into their documents, {inserted} copied over, "
+              f"{hidden} documents hidden from history")
+        print("   ℹ️  invoices is now a view over documents (old table kept as invoices_legacy)")
+        return True
+        
+    except Exception as e:
+        print(f"\n❌ CONSOLIDATION FAILED: {e}")
+        conn.rollback()
+        return False
+        
+    finally:
+        conn.close()
+
+
 if __name__ == "__main__":
-    # Run migration
+    # Run migrations
     success = migrate_database_for_multi_tenancy()
+    success = promote_json_columns() and success
+    success = consolidate_invoices_into_documents() and success
     
     if success:
         print("✅ Migration script completed successfully!")
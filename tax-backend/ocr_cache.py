@@ -0,0 +1,146 @@
+# ocr_cache.py
+# -----------------------------------------------------------------------------
+# OCR RESULT CACHE - Content-addressed (SHA-256 of the uploaded file)
+# The same bill arrives again and again (email forwards, WhatsApp re-sends,
+# retries after a timeout) - an exact re-upload skips the vision model entirely
+# -----------------------------------------------------------------------------
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+from typing import Dict, Any, Iterable, List, Optional
+
+from db_pool import get_pool
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# Size bound - least recently used entries are evicted past this many rows
+MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", "5000"))
+
+# Set OCR_CACHE_ENABLED=0 to always call the model
+ENABLED = os.getenv("OCR_CACHE_ENABLED", "1") != "0"
+
+
+def content_hash(file_bytes: bytes) -> str:
+    """SHA-256 of the raw upload. Run it in the I/O pool for large scans."""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def cache_version(model: str, prompt: str) -> str:
+    """
+    Version key for a cached result: changes whenever the model id or the
+    extraction prompt changes, so old results are never served for a new setup.
+    """
+    return hashlib.sha256(f"{model}\n{prompt}".encode("utf-8")).hexdigest()[:16]
+
+
+def cacheable(answered: List[str], primaries: Iterable[str], unresolved: List[str]) -> bool:
+    """
+    Whether an extraction may be stored under the primary model's version key:
+    only if every model call was answered by a primary model (not a fallback or
+    hedge) and no field is still unresolved - a degraded result would otherwise
+    be served for that file forever.
+    """
+    return bool(answered) and set(answered) <= set(primaries) and not unresolved
+
+
+class OCRCache:
+    """SQLite table of OCR(+validation) results keyed by (content_hash, version)."""
+
+    def __init__(self, db_path: str = "tax_data.db", max_entries: int = MAX_ENTRIES):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self._initialized = False
+        # Per-process counters for stats
+        self.hits = 0
+        self.misses = 0
+
+    def _init(self):
+        """Create the ocr_cache table on first use."""
+        if self._initialized:
+            return
+        with get_pool(self.db_path).write() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS ocr_cache (
+                    content_hash TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    created_at REAL,
+                    last_used_at REAL,
+                    hit_count INTEGER DEFAULT 0,
+                    PRIMARY KEY (content_hash, version)
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_ocr_cache_lru ON ocr_cache(last_used_at)')
+        self._initialized = True
+
+    def get(self, digest: str, version: str) -> Optional[Dict[str, Any]]:
+        """Cached result (a fresh dict) or None. A hit refreshes the entry's LRU position."""
+        if not ENABLED:
+            return None
+        self._init()
+        pool = get_pool(self.db_path)
+        try:
+            with pool.read() as conn:
+                row = conn.execute(
+                    "SELECT result FROM ocr_cache WHERE content_hash = ? AND version = ?",
+                    (digest, version)
+                ).fetchone()
+            if not row:
+                self.misses += 1
+                return None
+            # Only a hit takes the writer (to refresh the LRU position)
+            with pool.write() as conn:
+                conn.execute('''
+                    UPDATE ocr_cache SET last_used_at = ?, hit_count = hit_count + 1
+                    WHERE content_hash = ? AND version = ?
+                ''', (time.time(), digest, version))
+            self.hits += 1
+            return json.loads(row[0])
+        except (sqlite3.Error, ValueError) as e:
+            print(f"⚠️ OCR cache read failed: {e}")
+            return None
+
+    def put(self, digest: str, version: str, result: Dict[str, Any]):
+        """Store a successful extraction, evicting the least recently used rows past max_entries."""
+        if not ENABLED:
+            return
+        now = time.time()
+        self._init()
+        try:
+            with get_pool(self.db_path).write() as conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO ocr_cache (content_hash, version, result, created_at, last_used_at, hit_count)
+                    VALUES (?, ?, ?, ?, ?, 0)
+                ''', (digest, version, json.dumps(result), now, now))
+                conn.execute('''
+                    DELETE FROM ocr_cache WHERE rowid IN (
+                        SELECT rowid FROM ocr_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                    )
+                ''', (self.max_entries,))
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            print(f"⚠️ OCR cache write failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        entries = 0
+        if ENABLED:
+            self._init()
+            with get_pool(self.db_path).read() as conn:
+                entries = conn.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0]
+        return {
+            "enabled": ENABLED,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+# Global instance (shared by /upload and the async pipeline)
+ocr_cache = OCRCache()
@@ -0,0 +1,154 @@
+# offload.py
+# -----------------------------------------------------------------------------
+# BLOCKING WORK OFFLOAD - Keeps the event loop responsive during uploads
+# Thread pool for blocking I/O, process pool for PDF rasterization,
+# and a per-worker cap on how many uploads run their heavy stages at once
+# -----------------------------------------------------------------------------
+
+import os
+import asyncio
+import base64
+import functools
+from io import BytesIO
+from typing import Any, Callable, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# How many uploads may be inside OCR/classification at the same time on this worker.
+# Extra uploads wait their turn instead of piling work onto the loop.
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+
+# Threads for blocking I/O (file writes, sqlite lookups, base64 of big scans)
+IO_THREADS = int(os.getenv("OFFLOAD_IO_THREADS", "8"))
+
+# Processes for CPU-heavy PDF rasterization (poppler + PIL encode)
+PDF_PROCESSES = int(os.getenv("OFFLOAD_PDF_PROCESSES", str(max(1, min(4, (os.cpu_count() or 2) - 1)))))
+
+# =============================================================================
+# EXECUTORS (created lazily, one set per worker process)
+# =============================================================================
+
+_thread_pool: Optional[ThreadPoolExecutor] = None
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+# Per-worker upload limit - acquire with `async with upload_slots:`
+upload_slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+
+def get_thread_pool() -> ThreadPoolExecutor:
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="kairo-io")
+    return _thread_pool
+
+
+def get_process_pool() -> Optional[ProcessPoolExecutor]:
+    """Process pool for rasterization. Returns None if processes can't be spawned here."""
+    global _process_pool
+    if _process_pool is None:
+        try:
+            _process_pool = ProcessPoolExecutor(max_workers=PDF_PROCESSES)
+        except (OSError, NotImplementedError) as e:
+            print(f"⚠️ Process pool unavailable, using threads for PDF work: {e}")
+            return None
+    return _process_pool
+
+
+async def run_blocking(func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking function (I/O, sqlite, fuzzy matching) in the thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_thread_pool(), functools.partial(func, *args, **kwargs))
+
+
+async def run_cpu_bound(func: Callable, *args) -> Any:
+    """
+    Run a CPU-heavy, picklable top-level function in the process pool.
+    Falls back to the thread pool if the process pool is missing or broken.
+    """
+    global _process_pool
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool()
+    if pool is not None:
+        try:
+            return await loop.run_in_executor(pool, func, *args)
+        except BrokenProcessPool:
+            print("⚠️ PDF process pool crashed - recreating on next call")
+            _process_pool = None
+    return await loop.run_in_executor(get_thread_pool(), func, *args)
+
+
+def shutdown_executors():
+    """Release pools at app shutdown."""
+    global _thread_pool, _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=False, cancel_futures=True)
+        _thread_pool = None
+
+
+# =============================================================================
+# OFFLOADABLE WORK UNITS (top-level so they pickle into the process pool)
+# =============================================================================
+
+def render_pdf_page_png(file_bytes: bytes, dpi: int = 200, page: int = 1) -> bytes:
+    """Rasterize a single PDF page to PNG bytes. Raises ImportError without pdf2image."""
+    from pdf2image import convert_from_bytes
+    images = convert_from_bytes(file_bytes, first_page=page, last_page=page, dpi=dpi)
+    if not images:
+        raise ValueError("No images extracted from PDF")
+    img_buffer = BytesIO()
+    images[0].save(img_buffer, format='PNG')
+    return img_buffer.getvalue()
+
+
+def extract_pdf_text(file_bytes: bytes, page: int = 0) -> str:
+    """Pull the text layer of one PDF page with pypdf (empty string if none)."""
+    from pypdf import PdfReader
+    pdf = PdfReader(BytesIO(file_bytes))
+    if len(pdf.pages) <= page:
+        return ""
+    return pdf.pages[page].extract_text() or ""
+
+
+def inspect_pdf_pages(file_bytes: bytes) -> List[Dict[str, Any]]:
+    """
+    One pypdf pass over the whole document: per page its 1-based number,
+    text layer and MediaBox size in points (drives text-vs-raster and DPI).
+    """
+    from pypdf import PdfReader
+    pdf = PdfReader(BytesIO(file_bytes))
+    pages = []
+    for number, page in enumerate(pdf.pages, start=1):
+        try:
+            text = page.extract_text() or ""
+        except Exception:
+            text = ""
+        box = page.mediabox
+        pages.append({
+            "page": number,
+            "text": text,
+            "width_pt": float(box.width),
+            "height_pt": float(box.height),
+        })
+    return pages
+
+
+def encode_base64(file_bytes: bytes) -> str:
+    return base64.b64encode(file_bytes).decode('utf-8')
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def write_file(path: str, file_bytes: bytes) -> int:
+    with open(path, "wb") as buffer:
+        buffer.write(file_bytes)
+    return len(file_bytes)
@@ -0,0 +1,201 @@
+# pdf_ingest.py
+# -----------------------------------------------------------------------------
+# PAGE-AWARE PDF INGESTION - Text layer first, vision only where needed
+# Digital e-invoices carry a text layer: those pages go to the text model and
+# are never rasterized. Scanned pages are rendered in parallel in the process
+# pool (DPI sized to the page) and read one by one by the vision model.
+# The per-page results are merged into one invoice.
+# -----------------------------------------------------------------------------
+
+import os
+import re
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from offload import run_cpu_bound, run_blocking, inspect_pdf_pages, encode_base64
+from image_prep import render_pdf_page_for_vision
+from structured_output import parse_json_tolerant, response_format, validate_invoice
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# A page counts as "digital" when its text layer has at least this many
+# non-space characters and at least one digit (amounts, GSTIN, dates)
+MIN_TEXT_CHARS = int(os.getenv("PDF_MIN_TEXT_CHARS", "40"))
+
+# Longer documents keep their first (MAX_PAGES - 1) pages and the last page,
+# which is where the totals are
+MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "10"))
+
+# Adaptive DPI: render so the long edge is about this many pixels,
+# clamped to [MIN_DPI, MAX_DPI]. A4 lands around 170 dpi.
+TARGET_LONG_EDGE_PX = int(os.getenv("PDF_TARGET_LONG_EDGE_PX", "2000"))
+MIN_DPI = int(os.getenv("PDF_MIN_DPI", "100"))
+MAX_DPI = int(os.getenv("PDF_MAX_DPI", "200"))
+
+# Cap on text-layer characters sent to the text model
+MAX_TEXT_CHARS = int(os.getenv("PDF_MAX_TEXT_CHARS", "24000"))
+
+# Identity fields come from the first page that has them
+HEADER_FIELDS = (
+    "gst_no", "invoice_no", "invoice_date", "vendor_name", "buyer_name", "buyer_gstin",
+    "vendor_state", "place_of_supply", "hsn_code", "ledger_name", "group_name",
+)
+
+# Amounts come from the totals page (the last page that reports a grand total)
+TOTAL_FIELDS = (
+    "taxable_value", "cgst_amount", "sgst_amount", "igst_amount", "cess_amount",
+    "grand_total", "tax_rate",
+)
+
+ModelCall = Callable[..., Awaitable[str]]
+
+
+def has_text_layer(text: Optional[str]) -> bool:
+    """True if pypdf found real invoice text on the page (not just a stray header)."""
+    if not text:
+        return False
+    compact = re.sub(r"\s+", "", text)
+    return len(compact) >= MIN_TEXT_CHARS and any(ch.isdigit() for ch in compact)
+
+
+def adaptive_dpi(width_pt: float, height_pt: float) -> int:
+    """DPI that puts the page's long edge near TARGET_LONG_EDGE_PX."""
+    long_edge_in = max(width_pt or 0, height_pt or 0) / 72.0
+    if long_edge_in <= 0:
+        return MAX_DPI
+    return max(MIN_DPI, min(MAX_DPI, int(TARGET_LONG_EDGE_PX / long_edge_in)))
+
+
+def select_pages(pages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Apply MAX_PAGES, always keeping the last page."""
+    if len(pages) <= MAX_PAGES:
+        return pages
+    print(f"⚠️ PDF has {len(pages)} pages - reading first {MAX_PAGES - 1} and the last")
+    return pages[:MAX_PAGES - 1] + pages[-1:]
+
+
+def _is_empty(value: Any) -> bool:
+    return value is None or value == "" or (isinstance(value, str) and value.strip().lower() in ("null", "n/a", "none"))
+
+
+def _is_zero(value: Any) -> bool:
+    try:
+        return float(str(value).replace(",", "")) == 0
+    except (TypeError, ValueError):
+        return _is_empty(value)
+
+
+def merge_page_extractions(extractions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Combine per-page (or per-page-group) extractions, given in page order, into one invoice.
+    Header fields: first non-empty value. Totals: taken together from the last page
+    with a non-zero grand_total, each remaining gap filled from the latest page that has it.
+    Any other key keeps its first non-empty value.
+    """
+    extractions = [e for e in extractions if isinstance(e, dict)]
+    if not extractions:
+        return {}
+    if len(extractions) == 1:
+        return dict(extractions[0])
+
+    merged: Dict[str, Any] = {}
+    for extraction in extractions:
+        for key, value in extraction.items():
+            if key in TOTAL_FIELDS:
+                continue
+            if _is_empty(merged.get(key)) and not _is_empty(value):
+                merged[key] = value
+
+    totals_page = next((e for e in reversed(extractions) if not _is_zero(e.get("grand_total"))), None)
+    for key in TOTAL_FIELDS:
+        value = totals_page.get(key) if totals_page else None
+        if _is_empty(value):
+            value = next((e.get(key) for e in reversed(extractions) if not _is_empty(e.get(key))), None)
+        if value is not None:
+            merged[key] = value
+    return merged
+
+
+def _page_prompt(prompt: str, page: int, total: int) -> str:
+    if total == 1:
+        return prompt
+    return (f"{prompt}\n\nThis image is page {page} of {total} of the same invoice. "
+            f"Use null for any field that is not on this page.")
+
+
+def _text_prompt(prompt: str, pages: List[Dict[str, Any]], total: int) -> str:
+    body = "\n\n".join(f"--- Page {p['page']} of {total} ---\n{p['text'].strip()}" for p in pages)
+    if len(body) > MAX_TEXT_CHARS:
+        body = body[:MAX_TEXT_CHARS]
+    return (f"{prompt}\n\nThis invoice is a digital PDF, so there is no image. "
+            f"Read the values from its extracted text layer below instead:\n\n{body}")
+
+
+async def _vision_page(file_bytes: bytes, page: Dict[str, Any], total: int,
+                       prompt: str, vision_call: ModelCall) -> Dict[str, Any]:
+    dpi = adaptive_dpi(page["width_pt"], page["height_pt"])
+    # Render + pre-process in the same pool task; only the compact JPEG comes back
+    image_bytes, mime_type = await run_cpu_bound(render_pdf_page_for_vision, file_bytes, dpi, page["page"])
+    b64_data = await run_blocking(encode_base64, image_bytes)
+    response = await vision_call(b64_data, _page_prompt(prompt, page["page"], total), mime_type,
+                                 response_format=response_format())
+    return parse_json_tolerant(response)
+
+
+async def extract_pdf(file_bytes: bytes, prompt: str, vision_call: ModelCall, text_call: ModelCall) -> Dict[str, Any]:
+    """
+    Extract one invoice from a PDF of any length.
+    `vision_call(b64, prompt, mime, response_format=...)` and `text_call(prompt)` are the
+    caller's model functions (/upload and the async pipeline have their own wrappers).
+    A page whose reply can't be parsed, or that can't be rendered, is skipped and the
+    rest are merged. Only if no page yields usable JSON is the first page's error
+    raised (json.JSONDecodeError, ImportError, rasterization errors) - callers
+    already handle those.
+    """
+    try:
+        pages = await run_cpu_bound(inspect_pdf_pages, file_bytes)
+    except Exception as e:
+        # Damaged or encrypted PDF - fall back to rendering the first page
+        print(f"⚠️ pypdf could not read PDF ({e}) - rasterizing page 1")
+        pages = [{"page": 1, "text": "", "width_pt": 0, "height_pt": 0}]
+
+    total = len(pages)
+    pages = select_pages(pages)
+    text_pages = [p for p in pages if has_text_layer(p["text"])]
+    raster_pages = [p for p in pages if not has_text_layer(p["text"])]
+    print(f"📄 PDF: {total} page(s) - {len(text_pages)} with text layer, {len(raster_pages)} to rasterize")
+
+    # Text pages: one text-model call with the whole text layer (no image at all).
+    # Scanned pages: rendered + read concurrently, one vision call per page.
+    # A failed page doesn't fail the invoice (a terms & conditions page answered in prose).
+    jobs = []
+    if text_pages:
+        jobs.append((text_pages[0]["page"], "text", text_call(_text_prompt(prompt, text_pages, total))))
+    for page in raster_pages:
+        jobs.append((page["page"], "vision", _vision_page(file_bytes, page, total, prompt, vision_call)))
+    results = await asyncio.gather(*(job for _, _, job in jobs), return_exceptions=True)
+
+    parsed, sources, errors = [], set(), []
+    for (first_page, source, _), result in sorted(zip(jobs, results), key=lambda item: item[0][0]):
+        try:
+            if isinstance(result, BaseException):
+                raise result
+            if isinstance(result, str):
+                result = parse_json_tolerant(result)
+        except Exception as e:
+            print(f"⚠️ PDF page {first_page} skipped: {e}")
+            errors.append(e)
+            continue
+        parsed.append(result)
+        sources.add(source)
+    if not parsed:
+        raise errors[0]
+
+    # Per-page gaps are expected ("null if not on this page") - no follow-ups here,
+    # just the same per-field clean-up as single images
+    data, _ = validate_invoice(merge_page_extractions(parsed))
+    data["page_count"] = total
+    data["extraction_source"] = "mixed" if len(sources) > 1 else "text_layer" if "text" in sources else "vision"
+    return data
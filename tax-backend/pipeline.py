@@ -4,17 +4,70 @@
 # Producer-Consumer Architecture with 3-stage queue processing
 # -----------------------------------------------------------------------------
 
+import os
 import asyncio
 import json
 import uuid
 import time
+import socket
 import base64
-from typing import Dict, Any, Optional, Callable
+from typing import Dict, Any, List, Optional, Callable, AsyncIterator, Set
 from dataclasses import dataclass, field
+from collections import deque
 from enum import Enum
 from datetime import datetime
 
-from async_ai import call_ocr_async, call_logic_async, clean_json_response
+from async_ai import call_ocr_async, call_logic_async, MODELS as ASYNC_MODELS
+from ai_provider import provider
+from hedging import record_models
+from ocr_cache import ocr_cache, content_hash, cache_version, cacheable
+from response_cache import response_cache, response_key, vendor_key, hsn_key
+from upload_store import upload_store
+from priority_lanes import lanes, set_lane, BULK
+from usage_ledger import set_attribution
+from offload import run_blocking, encode_base64, read_file
+from pdf_ingest import extract_pdf
+from structured_output import extract_invoice_fields, missing_critical, parse_json_tolerant
+from image_prep import prepare_for_vision
+from db_pool import get_pool
+from task_store import TaskStore, HEARTBEAT_SECONDS
+from document_writer import insert_documents_batch, file_type_for
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# Save stage groups finished tasks into one transaction: whichever comes first,
+# this many tasks or this many milliseconds after the first one arrived
+SAVE_BATCH_SIZE = int(os.getenv("PIPELINE_SAVE_BATCH_SIZE", "25"))
+SAVE_BATCH_MS = int(os.getenv("PIPELINE_SAVE_BATCH_MS", "250"))
+
+# Backpressure: at most this many documents waiting for OCR (each holds its bytes).
+# Upload endpoints answer 429 once it's full.
+MAX_QUEUED = int(os.getenv("PIPELINE_MAX_QUEUED", "200"))
+
+# AIMD worker scaling bounds for the OCR and logic stages
+MIN_WORKERS = int(os.getenv("PIPELINE_MIN_WORKERS", "1"))
+MAX_WORKERS = int(os.getenv("PIPELINE_MAX_WORKERS", "16"))
+AIMD_INTERVAL_SECONDS = float(os.getenv("PIPELINE_AIMD_INTERVAL", "5"))
+
+# On shutdown, in-flight tasks get this long to finish before they are checkpointed
+DRAIN_SECONDS = float(os.getenv("PIPELINE_DRAIN_SECONDS", "20"))
+
+# Back off when a stage's median model latency goes above this (seconds)
+LATENCY_TARGETS = {
+    "ocr": float(os.getenv("PIPELINE_OCR_LATENCY_TARGET", "20")),
+    "logic": float(os.getenv("PIPELINE_LOGIC_LATENCY_TARGET", "15")),
+}
+
+
+class PipelineFull(Exception):
+    """Raised by submit() when the OCR queue is at capacity (or the pipeline is shutting down)."""
+    pass
+
+
+# Queue sentinel - a worker that takes it off its queue exits
+_STOP = object()
 
 # =============================================================================
 # TASK STATUS & DATA STRUCTURES
@@ -34,11 +87,14 @@ class ProcessingTask:
     """Represents a document being processed through the pipeline."""
     task_id: str
     filename: str
-    file_bytes: bytes
+    file_bytes: Optional[bytes]  # Dropped once OCR is done - file_path is the durable copy
     mime_type: str
     client_id: Optional[int] = None
     doc_type: str = "gst_invoice"
     entered_by: Optional[str] = None
+    file_path: Optional[str] = None
+    user_id: Optional[int] = None
+    batch_id: Optional[str] = None  # Groups the files of one /upload/bulk for /upload/stream
     
     # Processing state
     status: TaskStatus = TaskStatus.QUEUED
@@ -50,6 +106,9 @@ class ProcessingTask:
     # Timing
     created_at: float = field(default_factory=time.time)
     completed_at: Optional[float] = None
+    
+    # Set once the task reaches COMPLETED/FAILED - wait_for_task awaits it
+    done: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
 
 
 # =============================================================================
@@ -101,6 +160,61 @@ ACCOUNTING FIELDS:
 Return ONLY a valid JSON object."""
 
 
+# =============================================================================
+# ADAPTIVE CONCURRENCY - AIMD limit per model stage
+# =============================================================================
+
+class AdaptiveLimit:
+    """
+    How many workers of a stage may be calling the model at once.
+    Additive increase while the stage keeps up and OpenRouter is healthy,
+    multiplicative decrease on 429s or slow responses.
+    """
+    
+    def __init__(self, stage: str, initial: int, minimum: int, maximum: int):
+        self.stage = stage
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(initial, maximum))
+        self.in_flight = 0
+        self._cond = asyncio.Condition()
+    
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        return self
+    
+    async def __aexit__(self, *exc):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+    
+    async def increase(self):
+        async with self._cond:
+            if self.limit < self.maximum:
+                self.limit += 1
+                self._cond.notify()
+    
+    async def decrease(self, factor: float = 0.5):
+        async with self._cond:
+            self.limit = max(self.minimum, int(self.limit * factor))
+    
+    async def adjust(self, snapshot: Dict[str, Any], backlog: int) -> str:
+        """One AIMD step from the recent OpenRouter call stats for this stage."""
+        p50 = snapshot.get("p50_latency")
+        if snapshot.get("rate_limited"):
+            await self.decrease(0.5)
+            return "decrease (429)"
+        if p50 is not None and p50 > LATENCY_TARGETS.get(self.stage, 30):
+            await self.decrease(0.75)
+            return "decrease (latency)"
+        if backlog > 0 and self.in_flight >= self.limit:
+            await self.increase()
+            return "increase"
+        return "hold"
+
+
 # =============================================================================
 # PIPELINE MANAGER - The Conveyor Belt
 # =============================================================================
@@ -113,25 +227,46 @@ class AsyncPipeline:
     3. Save Queue → Store in database
     """
     
-    def __init__(self, max_concurrent: int = 5):
+    def __init__(self, max_concurrent: int = 5, store: Optional[TaskStore] = None):
         self.max_concurrent = max_concurrent
         
-        # Three processing queues
-        self.ocr_queue: asyncio.Queue = asyncio.Queue()
+        # Three processing queues - only the OCR queue is bounded, it's where file bytes wait
+        self.ocr_queue: asyncio.Queue = asyncio.Queue(maxsize=MAX_QUEUED)
         self.logic_queue: asyncio.Queue = asyncio.Queue()
         self.save_queue: asyncio.Queue = asyncio.Queue()
         
-        # Task tracking
+        # Task tracking - only in-flight tasks live in memory,
+        # finished ones are read back from the durable store
         self.tasks: Dict[str, ProcessingTask] = {}
-        self.results: Dict[str, Dict] = {}
+        self.store = store or TaskStore()
+        
+        # AIMD limits - max_concurrent is the starting point, not a fixed size
+        self.limits = {
+            "ocr": AdaptiveLimit("ocr", max_concurrent, MIN_WORKERS, MAX_WORKERS),
+            "logic": AdaptiveLimit("logic", max_concurrent, MIN_WORKERS, MAX_WORKERS),
+        }
+        
+        # Completion timestamps per stage, for throughput in /pipeline/stats
+        self._stage_done: Dict[str, deque] = {stage: deque(maxlen=5000) for stage in ("ocr", "logic", "save")}
+        self._started_at: Optional[float] = None
         
-        # Workers
+        # Lease owner id for this worker process
+        self.owner_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        
+        # Workers - handles kept so shutdown can drain and await them
         self._workers_started = False
         self._shutdown = False
+        self._ocr_workers: List[asyncio.Task] = []
+        self._logic_workers: List[asyncio.Task] = []
+        self._save_workers: List[asyncio.Task] = []
+        self._background: List[asyncio.Task] = []
         
         # Callbacks
         self.on_complete: Optional[Callable] = None
         
+        # Progress subscribers per batch_id (one queue per open /upload/stream connection)
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        
     async def start_workers(self):
         """Start background worker tasks."""
         if self._workers_started:
@@ -139,45 +274,364 @@ class AsyncPipeline:
             
         self._workers_started = True
         self._shutdown = False
+        self._started_at = time.time()
+        
+        # Durable task table
+        await run_blocking(self.store.init)
+        await run_blocking(self.store.purge_finished)
         
-        # Start multiple OCR workers (most CPU-bound)
-        for i in range(self.max_concurrent):
-            asyncio.create_task(self._ocr_worker(i))
+        # Workers up to MAX_WORKERS per model stage; the AIMD limits decide how many are active
+        self._ocr_workers = [asyncio.create_task(self._ocr_worker(i)) for i in range(MAX_WORKERS)]
+        self._logic_workers = [asyncio.create_task(self._logic_worker(i)) for i in range(MAX_WORKERS)]
         
-        # Start logic workers
-        for i in range(self.max_concurrent):
-            asyncio.create_task(self._logic_worker(i))
+        # One save worker - it batches, and SQLite only has one writer anyway
+        self._save_workers = [asyncio.create_task(self._save_worker(0))]
+        self._background = [asyncio.create_task(self._autoscale_loop())]
         
-        # Start save workers
-        for i in range(2):  # Fewer save workers needed
-            asyncio.create_task(self._save_worker(i))
+        # Heartbeat first, so leases on recovered tasks are renewed from the start
+        self._background.append(asyncio.create_task(self._heartbeat_loop()))
+        # Pick up anything a previous run left unfinished - in the background, startup
+        # never waits on it; what doesn't fit the OCR queue is claimed by a later heartbeat
+        self._background.append(asyncio.create_task(self._recover_on_start()))
             
-        print(f"🚀 Pipeline started: {self.max_concurrent} OCR + {self.max_concurrent} Logic + 2 Save workers")
+        print(f"🚀 Pipeline started: {self.max_concurrent} OCR + {self.max_concurrent} Logic "
+              f"(adaptive {MIN_WORKERS}-{MAX_WORKERS}) + 1 batching Save worker")
     
-    async def stop_workers(self):
-        """Signal workers to stop."""
+    async def stop_workers(self, drain_timeout: float = DRAIN_SECONDS):
+        """
+        Graceful shutdown.
+        Documents still waiting for OCR are not started - they stay in the store as queued.
+        Tasks already in a worker run to completion through the remaining stages, within
+        drain_timeout. Whatever is left after that is cancelled and checkpointed: its lease
+        is released so the next start (or a sibling worker) resumes it from its last stage.
+        """
+        if not self._workers_started or self._shutdown:
+            return
         self._shutdown = True
+        print("🛑 Pipeline draining...")
+        
+        for bg in self._background:
+            bg.cancel()
+        
+        # Unstarted documents: drop from memory, their rows stay 'queued'
+        skipped = 0
+        while True:
+            try:
+                task_id = self.ocr_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if self.tasks.pop(task_id, None):
+                skipped += 1
+        
+        # Stop each stage after the one before it has finished feeding it
+        drained = True
+        try:
+            await asyncio.wait_for(self._drain_stages(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            drained = False
+        
+        all_workers = self._ocr_workers + self._logic_workers + self._save_workers
+        for worker in all_workers:
+            worker.cancel()
+        await asyncio.gather(*all_workers, *self._background, return_exceptions=True)
+        
+        # Checkpoint whatever didn't finish
+        checkpointed = await run_blocking(self.store.release_leases, self.owner_id)
+        self.tasks.clear()
+        for queue in (self.ocr_queue, self.logic_queue, self.save_queue):
+            while not queue.empty():
+                queue.get_nowait()
+        self._ocr_workers, self._logic_workers, self._save_workers, self._background = [], [], [], []
+        self._workers_started = False
+        
+        print(f"🛑 Pipeline stopped ({'drained' if drained else 'drain timed out'}; "
+              f"{skipped} unstarted, {checkpointed} checkpointed for resume)")
+    
+    async def _drain_stages(self):
+        """Sentinel per worker, one stage at a time, so nothing in flight is left behind."""
+        stages = [
+            (self.ocr_queue, self._ocr_workers),
+            (self.logic_queue, self._logic_workers),
+            (self.save_queue, self._save_workers),
+        ]
+        for queue, workers in stages:
+            for _ in workers:
+                await queue.put(_STOP)
+            await asyncio.gather(*workers, return_exceptions=True)
+    
+    def has_capacity(self, count: int = 1) -> bool:
+        """Whether `count` more documents fit in the OCR queue right now."""
+        return not self._shutdown and self.ocr_queue.qsize() + count <= MAX_QUEUED
     
     async def submit(self, task: ProcessingTask) -> str:
-        """Submit a new document for processing."""
+        """Submit a new document for processing. Raises PipelineFull when the OCR queue is full."""
+        if self._shutdown:
+            raise PipelineFull("Pipeline is shutting down")
+        if self.ocr_queue.full():
+            raise PipelineFull(f"Pipeline queue is full ({MAX_QUEUED} documents waiting)")
+        await run_blocking(self.store.insert, {
+            "task_id": task.task_id,
+            "filename": task.filename,
+            "file_path": task.file_path,
+            "mime_type": task.mime_type,
+            "client_id": task.client_id,
+            "doc_type": task.doc_type,
+            "entered_by": task.entered_by,
+            "user_id": task.user_id,
+            "batch_id": task.batch_id,
+            "created_at": task.created_at,
+        }, self.owner_id)
         self.tasks[task.task_id] = task
-        await self.ocr_queue.put(task.task_id)
+        self._publish(task)
+        try:
+            self.ocr_queue.put_nowait(task.task_id)
+        except asyncio.QueueFull:
+            # Lost the race for the last slot while persisting
+            self.tasks.pop(task.task_id, None)
+            await run_blocking(self.store.update, task.task_id, TaskStatus.FAILED.value,
+                               error="Rejected: pipeline queue full")
+            raise PipelineFull(f"Pipeline queue is full ({MAX_QUEUED} documents waiting)")
         print(f"📥 Task {task.task_id[:8]} queued for processing")
         return task.task_id
     
     def get_status(self, task_id: str) -> Dict:
-        """Get current status of a task."""
+        """Get current status of a task (memory first, then the durable store)."""
         task = self.tasks.get(task_id)
-        if not task:
+        if task:
+            return {
+                "task_id": task_id,
+                "status": task.status.value,
+                "filename": task.filename,
+                "error": task.error,
+                "result": task.final_result if task.status == TaskStatus.COMPLETED else None
+            }
+        
+        row = self.store.get(task_id)
+        if not row:
             return {"status": "not_found"}
         
         return {
             "task_id": task_id,
-            "status": task.status.value,
+            "status": row["status"],
+            "filename": row["filename"],
+            "error": row["error"],
+            "result": row["final_result"] if row["status"] == TaskStatus.COMPLETED.value else None
+        }
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Queue depths, in-flight counts, per-stage throughput and the current AIMD limits."""
+        now = time.time()
+        in_flight: Dict[str, int] = {}
+        for task in list(self.tasks.values()):
+            in_flight[task.status.value] = in_flight.get(task.status.value, 0) + 1
+        
+        throughput = {}
+        for stage, done in self._stage_done.items():
+            last_minute = sum(1 for t in list(done) if t >= now - 60)
+            throughput[stage] = {"completed_last_60s": last_minute, "per_second": round(last_minute / 60, 2)}
+        
+        return {
+            "running": self._workers_started and not self._shutdown,
+            "uptime_seconds": round(now - self._started_at, 1) if self._started_at else 0,
+            "queues": {
+                "ocr": {"depth": self.ocr_queue.qsize(), "max": MAX_QUEUED},
+                "logic": {"depth": self.logic_queue.qsize()},
+                "save": {"depth": self.save_queue.qsize()},
+            },
+            "in_flight": in_flight,
+            "workers": {
+                stage: {"limit": limit.limit, "slots_in_use": limit.in_flight,
+                        "min": limit.minimum, "max": limit.maximum}
+                for stage, limit in self.limits.items()
+            },
+            "throughput": throughput,
+            "model_calls": {stage: provider.stats.snapshot(stage) for stage in self.limits},
+            "ai_backend": {"name": provider.backend.name, **provider.backend.snapshot()},
+            "ai_lanes": lanes.snapshot(),
+        }
+    
+    # =========================================================================
+    # PROGRESS EVENTS - pushed to /upload/stream instead of per-file polling
+    # =========================================================================
+    
+    def _publish(self, task: ProcessingTask):
+        """Fan a task's current state out to everyone watching its batch."""
+        if not task.batch_id or task.batch_id not in self._subscribers:
+            return
+        event = {
+            "task_id": task.task_id,
             "filename": task.filename,
+            "status": task.status.value,
             "error": task.error,
-            "result": task.final_result if task.status == TaskStatus.COMPLETED else None
+            "result": task.final_result if task.status == TaskStatus.COMPLETED else None,
         }
+        for queue in self._subscribers[task.batch_id]:
+            queue.put_nowait(event)
+    
+    async def watch_batch(self, batch_id: str, keepalive: float = 15.0) -> AsyncIterator[Optional[Dict]]:
+        """
+        Yield status events for every task of a batch until all of them are finished.
+        Starts with the current state of each task, then follows live transitions.
+        Yields None every `keepalive` seconds of silence; at those points the store is
+        re-checked too, which covers tasks being processed by another worker process.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(batch_id, set()).add(queue)
+        try:
+            last: Dict[str, str] = {}
+            
+            async def snapshot():
+                for row in await run_blocking(self.store.list_batch, batch_id):
+                    if not _advances(last.get(row["task_id"]), row["status"]):
+                        continue
+                    last[row["task_id"]] = row["status"]
+                    yield {
+                        "task_id": row["task_id"],
+                        "filename": row["filename"],
+                        "status": row["status"],
+                        "error": row["error"],
+                        "result": row["final_result"] if row["status"] == TaskStatus.COMPLETED.value else None,
+                    }
+            
+            async for event in snapshot():
+                yield event
+            if not last:
+                return
+            
+            while any(status not in ("completed", "failed") for status in last.values()):
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    async for event in snapshot():
+                        yield event
+                    yield None
+                    continue
+                # Events queued while the snapshot was read may be older than it
+                if not _advances(last.get(event["task_id"]), event["status"]):
+                    continue
+                last[event["task_id"]] = event["status"]
+                yield event
+        finally:
+            watchers = self._subscribers.get(batch_id)
+            if watchers is not None:
+                watchers.discard(queue)
+                if not watchers:
+                    self._subscribers.pop(batch_id, None)
+    
+    # =========================================================================
+    # DURABILITY - state transitions, leases, recovery
+    # =========================================================================
+    
+    async def _transition(self, task: ProcessingTask, status: TaskStatus, **fields):
+        """Move a task to a new state and persist it (plus any stage output)."""
+        changed = task.status != status
+        task.status = status
+        await run_blocking(self.store.update, task.task_id, status.value, **fields)
+        if changed or status in (TaskStatus.COMPLETED, TaskStatus.FAILED):
+            self._publish(task)
+    
+    async def _finish(self, task: ProcessingTask, status: TaskStatus, **fields):
+        """Persist a terminal state, then release the file bytes and the in-memory entry."""
+        task.completed_at = time.time()
+        await self._transition(task, status, **fields)
+        task.file_bytes = None
+        self.tasks.pop(task.task_id, None)
+        task.done.set()
+    
+    async def _fail(self, task: ProcessingTask, error: str):
+        task.error = error
+        await self._finish(task, TaskStatus.FAILED, error=error)
+        # No document will reference the upload - drop the reference its endpoint took
+        await _release_upload(task.file_path)
+    
+    async def _recover_on_start(self):
+        try:
+            recovered = await self._recover_stalled()
+            if recovered:
+                print(f"♻️ Pipeline recovered {recovered} unfinished task(s) from previous run")
+        except Exception as e:
+            print(f"⚠️ Pipeline recovery error: {e}")
+
+    async def _recover_stalled(self) -> int:
+        """
+        Claim unfinished tasks whose lease expired and put each back on
+        the queue for the stage it had reached. Never waits on the bounded
+        OCR queue: only as many OCR-stage tasks as it has room for are
+        claimed, and any that lose a slot to /upload/bulk are handed back.
+        Tasks given up on after MAX_ATTEMPTS drop their upload reference.
+        """
+        rows, given_up = await run_blocking(self.store.claim_stalled, self.owner_id,
+                                            self.ocr_queue.maxsize - self.ocr_queue.qsize())
+        for path in given_up:
+            await _release_upload(path)
+        overflow = []
+        for row in rows:
+            if row["task_id"] in self.tasks:
+                continue
+            task = ProcessingTask(
+                task_id=row["task_id"],
+                filename=row["filename"],
+                file_bytes=None,
+                mime_type=row["mime_type"] or "",
+                client_id=row["client_id"],
+                doc_type=row["doc_type"] or "gst_invoice",
+                entered_by=row["entered_by"],
+                file_path=row["file_path"],
+                user_id=row.get("user_id"),
+                batch_id=row.get("batch_id"),
+                status=TaskStatus(row["status"]),
+                ocr_result=row["ocr_result"],
+                logic_result=row["logic_result"],
+                created_at=row["created_at"] or time.time()
+            )
+            self.tasks[task.task_id] = task
+            
+            if task.status == TaskStatus.SAVING or task.logic_result:
+                self.save_queue.put_nowait(task.task_id)
+            elif task.ocr_result:
+                self.logic_queue.put_nowait(task.task_id)
+            else:
+                try:
+                    self.ocr_queue.put_nowait(task.task_id)
+                except asyncio.QueueFull:
+                    self.tasks.pop(task.task_id, None)
+                    overflow.append(task.task_id)
+        if overflow:
+            await run_blocking(self.store.release, overflow)
+        return len(rows) - len(overflow)
+    
+    async def _heartbeat_loop(self):
+        """Renew leases on our tasks and adopt tasks from workers that died."""
+        while True:
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            try:
+                await run_blocking(self.store.heartbeat, self.owner_id)
+                await self._recover_stalled()
+            except Exception as e:
+                print(f"⚠️ Pipeline heartbeat error: {e}")
+    
+    async def _autoscale_loop(self):
+        """AIMD step for each model stage every AIMD_INTERVAL_SECONDS."""
+        queues = {"ocr": self.ocr_queue, "logic": self.logic_queue}
+        while True:
+            await asyncio.sleep(AIMD_INTERVAL_SECONDS)
+            try:
+                for stage, limit in self.limits.items():
+                    before = limit.limit
+                    # Provider-wide stats: /upload traffic on the same model counts too
+                    snapshot = provider.stats.snapshot(stage, window=AIMD_INTERVAL_SECONDS * 2)
+                    action = await limit.adjust(snapshot, queues[stage].qsize())
+                    if limit.limit != before:
+                        print(f"⚖️ Pipeline {stage} workers {before} → {limit.limit} ({action})")
+            except Exception as e:
+                print(f"⚠️ Pipeline autoscale error: {e}")
+    
+    async def _load_file_bytes(self, task: ProcessingTask) -> bytes:
+        if task.file_bytes is not None:
+            return task.file_bytes
+        if not task.file_path or not os.path.exists(task.file_path):
+            raise FileNotFoundError(f"Upload file missing: {task.file_path}")
+        return await run_blocking(read_file, task.file_path)
     
     # =========================================================================
     # WORKER FUNCTIONS - Run concurrently
@@ -186,63 +640,70 @@ class AsyncPipeline:
     async def _ocr_worker(self, worker_id: int):
         """OCR Worker - Extracts text from images using vision model."""
         print(f"👁️ OCR Worker {worker_id} started")
+        # Pipeline model calls queue behind interactive and single-upload calls
+        set_lane(BULK)
         
-        while not self._shutdown:
+        while True:
             try:
-                # Wait for task with timeout
-                try:
-                    task_id = await asyncio.wait_for(self.ocr_queue.get(), timeout=1.0)
-                except asyncio.TimeoutError:
-                    continue
+                # Take a slot first - the AIMD limit decides how many OCR calls run at once
+                async with self.limits["ocr"]:
+                    task_id = await self.ocr_queue.get()
+                    if task_id is _STOP:
+                        break
                 
-                task = self.tasks.get(task_id)
-                if not task:
-                    continue
+                    task = self.tasks.get(task_id)
+                    if not task:
+                        continue
                 
-                task.status = TaskStatus.OCR_PROCESSING
-                print(f"👁️ Worker {worker_id}: OCR processing {task.filename}")
+                    await self._transition(task, TaskStatus.OCR_PROCESSING)
+                    set_attribution(flow="pipeline_ocr", user_id=task.user_id, client_id=task.client_id)
+                    print(f"👁️ Worker {worker_id}: OCR processing {task.filename}")
                 
-                try:
-                    # Handle PDF conversion
-                    file_bytes = task.file_bytes
-                    mime_type = task.mime_type
-                    
-                    if 'pdf' in mime_type.lower():
-                        print(f"📄 Converting PDF to image...")
-                        try:
-                            from pdf2image import convert_from_bytes
-                            from io import BytesIO
-                            images = convert_from_bytes(file_bytes, first_page=1, last_page=1, dpi=200)
-                            if images:
-                                img_buffer = BytesIO()
-                                images[0].save(img_buffer, format='PNG')
-                                file_bytes = img_buffer.getvalue()
-                                mime_type = 'image/png'
-                                print(f"✅ PDF converted to PNG")
-                        except Exception as pdf_err:
-                            print(f"❌ PDF conversion failed: {pdf_err}")
-                            task.error = f"PDF conversion failed: {pdf_err}"
-                            task.status = TaskStatus.FAILED
-                            continue
+                    try:
+                        # Handle PDF conversion (recovered tasks read the saved upload back from disk)
+                        file_bytes = await self._load_file_bytes(task)
+                        mime_type = task.mime_type
+                        
+                        # ⚡ Exact re-upload? Reuse the cached extraction
+                        digest = await run_blocking(content_hash, file_bytes)
+                        cache_key = cache_version(ASYNC_MODELS["ocr"], OCR_PROMPT)
+                        ocr_data = await run_blocking(ocr_cache.get, digest, cache_key)
+                        if ocr_data:
+                            print(f"⚡ Worker {worker_id}: OCR cache hit for {task.filename}")
+                        else:
+                            # Which models answered decides whether the result may be cached
+                            with record_models() as answered:
+                                if 'pdf' in mime_type.lower():
+                                    # Every page: text layer → text model, scanned pages → parallel raster + vision
+                                    ocr_data = await extract_pdf(file_bytes, OCR_PROMPT, call_ocr_async, call_logic_async)
+                                    unresolved = missing_critical(ocr_data)
+                                    print(f"✅ PDF read via {ocr_data.get('extraction_source')} ({ocr_data.get('page_count')} page(s))")
+                                else:
+                                    # Call async OCR
+                                    b64_data, vision_mime = await prepare_for_vision(file_bytes, mime_type)
+                                    
+                                    async def ask(text, max_tokens, response_format):
+                                        return await call_ocr_async(b64_data, text, vision_mime, max_tokens=max_tokens or 4096,
+                                                                    response_format=response_format)
+                                    
+                                    # Schema JSON mode; only failing fields get a follow-up
+                                    ocr_data, unresolved = await extract_invoice_fields(ask, OCR_PROMPT)
+                            if cacheable(answered, (ASYNC_MODELS["ocr"], ASYNC_MODELS["logic"]), unresolved):
+                                await run_blocking(ocr_cache.put, digest, cache_key, ocr_data)
                     
-                    # Call async OCR
-                    b64_data = base64.b64encode(file_bytes).decode('utf-8')
-                    response = await call_ocr_async(b64_data, OCR_PROMPT, mime_type)
+                        task.ocr_result = ocr_data
+                        await self._transition(task, TaskStatus.OCR_PROCESSING, ocr_result=ocr_data)
+                        # The bytes are only needed for OCR - free them now
+                        task.file_bytes = None
+                        self._stage_done["ocr"].append(time.time())
+                        print(f"✅ Worker {worker_id}: OCR complete for {task.filename}")
                     
-                    # Parse response
-                    json_text = clean_json_response(response)
-                    ocr_data = json.loads(json_text)
+                        # Send to logic queue
+                        await self.logic_queue.put(task_id)
                     
-                    task.ocr_result = ocr_data
-                    print(f"✅ Worker {worker_id}: OCR complete for {task.filename}")
-                    
-                    # Send to logic queue
-                    await self.logic_queue.put(task_id)
-                    
-                except Exception as e:
-                    print(f"❌ Worker {worker_id}: OCR failed for {task.filename}: {e}")
-                    task.error = str(e)
-                    task.status = TaskStatus.FAILED
+                    except Exception as e:
+                        print(f"❌ Worker {worker_id}: OCR failed for {task.filename}: {e}")
+                        await self._fail(task, str(e))
                     
             except Exception as e:
                 print(f"❌ OCR Worker {worker_id} error: {e}")
@@ -251,25 +712,28 @@ class AsyncPipeline:
     async def _logic_worker(self, worker_id: int):
         """Logic Worker - Classifies HSN, Ledger, Group using reasoning model."""
         print(f"🧠 Logic Worker {worker_id} started")
+        set_lane(BULK)
         
-        while not self._shutdown:
+        while True:
             try:
-                try:
-                    task_id = await asyncio.wait_for(self.logic_queue.get(), timeout=1.0)
-                except asyncio.TimeoutError:
-                    continue
+                # Same AIMD gate for the logic model
+                async with self.limits["logic"]:
+                    task_id = await self.logic_queue.get()
+                    if task_id is _STOP:
+                        break
                 
-                task = self.tasks.get(task_id)
-                if not task or not task.ocr_result:
-                    continue
+                    task = self.tasks.get(task_id)
+                    if not task or not task.ocr_result:
+                        continue
                 
-                task.status = TaskStatus.LOGIC_PROCESSING
-                print(f"🧠 Worker {worker_id}: Logic processing {task.filename}")
+                    await self._transition(task, TaskStatus.LOGIC_PROCESSING)
+                    set_attribution(flow="pipeline_logic", user_id=task.user_id, client_id=task.client_id)
+                    print(f"🧠 Worker {worker_id}: Logic processing {task.filename}")
                 
-                try:
-                    # Build classification prompt
-                    ocr = task.ocr_result
-                    prompt = f"""Classify this invoice for Indian GST accounting:
+                    try:
+                        # Build classification prompt
+                        ocr = task.ocr_result
+                        prompt = f"""Classify this invoice for Indian GST accounting:
 
 Vendor: {ocr.get('vendor_name', 'Unknown')}
 Invoice No: {ocr.get('invoice_no', 'N/A')}
@@ -285,79 +749,229 @@ Determine the correct:
 
 Return JSON: {{"hsn_code": "...", "ledger_name": "...", "group_name": "...", "confidence": "..."}}"""
 
-                    response = await call_logic_async(prompt)
-                    json_text = clean_json_response(response)
-                    logic_data = json.loads(json_text)
+                        # Classification only depends on vendor + HSN - repeat vendors reuse the answer
+                        # (no vendor name → nothing to key on, always ask)
+                        vendor = vendor_key(ocr.get('vendor_name'))
+                        cache_key = response_key("pipeline_logic", ASYNC_MODELS["logic"],
+                                                 vendor=vendor, hsn=hsn_key(ocr.get('hsn_code')))
+                        logic_data = await run_blocking(response_cache.get, cache_key) if vendor else None
+                        if logic_data is not None:
+                            print(f"⚡ Worker {worker_id}: classification cache hit for {task.filename}")
+                        else:
+                            response = await call_logic_async(prompt)
+                            logic_data = parse_json_tolerant(response)
+                            if vendor:
+                                await run_blocking(response_cache.put, cache_key, "pipeline_logic",
+                                                   ocr.get('vendor_name'), logic_data)
                     
-                    task.logic_result = logic_data
-                    print(f"✅ Worker {worker_id}: Logic complete for {task.filename}")
+                        task.logic_result = logic_data
+                        await self._transition(task, TaskStatus.LOGIC_PROCESSING, logic_result=logic_data)
+                        self._stage_done["logic"].append(time.time())
+                        print(f"✅ Worker {worker_id}: Logic complete for {task.filename}")
                     
-                    # Send to save queue
-                    await self.save_queue.put(task_id)
+                        # Send to save queue
+                        await self.save_queue.put(task_id)
                     
-                except Exception as e:
-                    print(f"❌ Worker {worker_id}: Logic failed for {task.filename}: {e}")
-                    # Still save with OCR result only
-                    await self.save_queue.put(task_id)
+                    except Exception as e:
+                        print(f"❌ Worker {worker_id}: Logic failed for {task.filename}: {e}")
+                        # Still save with OCR result only
+                        await self.save_queue.put(task_id)
                     
             except Exception as e:
                 print(f"❌ Logic Worker {worker_id} error: {e}")
                 await asyncio.sleep(1)
     
     async def _save_worker(self, worker_id: int):
-        """Save Worker - Combines results and stores in database."""
+        """
+        Save Worker - Combines results and stores them in the database.
+        Drains the save queue in batches (SAVE_BATCH_SIZE tasks or SAVE_BATCH_MS)
+        and writes each batch in a single transaction.
+        """
         print(f"💾 Save Worker {worker_id} started")
+        loop = asyncio.get_running_loop()
         
-        while not self._shutdown:
+        stopping = False
+        while not stopping:
             try:
-                try:
-                    task_id = await asyncio.wait_for(self.save_queue.get(), timeout=1.0)
-                except asyncio.TimeoutError:
-                    continue
-                
-                task = self.tasks.get(task_id)
-                if not task:
-                    continue
+                task_id = await self.save_queue.get()
+                if task_id is _STOP:
+                    break
                 
-                task.status = TaskStatus.SAVING
-                print(f"💾 Worker {worker_id}: Saving {task.filename}")
+                # Collect more tasks until the batch is full or the window closes
+                task_ids = [task_id]
+                deadline = loop.time() + SAVE_BATCH_MS / 1000
+                while len(task_ids) < SAVE_BATCH_SIZE:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        next_id = await asyncio.wait_for(self.save_queue.get(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        break
+                    if next_id is _STOP:
+                        # Flush what we have, then exit
+                        stopping = True
+                        break
+                    task_ids.append(next_id)
                 
-                try:
-                    # Combine OCR and Logic results
-                    final = task.ocr_result.copy() if task.ocr_result else {}
-                    
-                    if task.logic_result:
-                        final['hsn_code'] = task.logic_result.get('hsn_code', final.get('hsn_code', ''))
-                        final['ledger_name'] = task.logic_result.get('ledger_name', 'Purchase A/c')
-                        final['group_name'] = task.logic_result.get('group_name', 'Purchase Accounts')
-                        final['ai_confidence'] = task.logic_result.get('confidence', 'medium')
-                    
-                    final['filename'] = task.filename
-                    final['client_id'] = task.client_id
-                    final['doc_type'] = task.doc_type
-                    
-                    task.final_result = final
-                    task.completed_at = time.time()
-                    task.status = TaskStatus.COMPLETED
-                    
-                    # Store result
-                    self.results[task_id] = final
-                    
-                    duration = task.completed_at - task.created_at
-                    print(f"✅ Worker {worker_id}: Saved {task.filename} in {duration:.2f}s")
-                    
-                    # Callback if set
-                    if self.on_complete:
-                        await self.on_complete(task_id, final)
-                    
-                except Exception as e:
-                    print(f"❌ Worker {worker_id}: Save failed for {task.filename}: {e}")
-                    task.error = str(e)
-                    task.status = TaskStatus.FAILED
+                tasks = [self.tasks[t] for t in dict.fromkeys(task_ids) if t in self.tasks]
+                if tasks:
+                    await self._save_batch(worker_id, tasks)
                     
             except Exception as e:
                 print(f"❌ Save Worker {worker_id} error: {e}")
                 await asyncio.sleep(1)
+    
+    async def _save_batch(self, worker_id: int, tasks: List[ProcessingTask]):
+        """Enrich, insert and complete a batch of tasks - one commit for all of them."""
+        for task in tasks:
+            task.status = TaskStatus.SAVING
+        await run_blocking(self.store.update_many,
+                           [(task.task_id, TaskStatus.SAVING.value, {}) for task in tasks])
+        for task in tasks:
+            self._publish(task)
+        print(f"💾 Worker {worker_id}: Saving batch of {len(tasks)}")
+        
+        records = await asyncio.gather(*(self._prepare_record(task) for task in tasks),
+                                       return_exceptions=True)
+        ready = []
+        for task, record in zip(tasks, records):
+            if isinstance(record, Exception):
+                print(f"❌ Worker {worker_id}: Save failed for {task.filename}: {record}")
+                await self._fail(task, str(record))
+            else:
+                ready.append((task, record))
+        if not ready:
+            return
+        
+        try:
+            outcomes = await run_blocking(self._write_batch, ready)
+        except Exception as e:
+            print(f"❌ Worker {worker_id}: Batch save failed ({len(ready)} tasks): {e}")
+            for task, _ in ready:
+                await self._fail(task, str(e))
+            return
+        
+        for (task, record), final in zip(ready, outcomes):
+            task.final_result = final
+            task.status = TaskStatus.COMPLETED
+            task.completed_at = time.time()
+            task.file_bytes = None
+            self.tasks.pop(task.task_id, None)
+            task.done.set()
+            self._publish(task)
+            self._stage_done["save"].append(task.completed_at)
+            
+            duration = task.completed_at - task.created_at
+            print(f"✅ Worker {worker_id}: Saved {task.filename} in {duration:.2f}s")
+            
+            # Callback if set
+            if self.on_complete:
+                try:
+                    await self.on_complete(task.task_id, final)
+                except Exception as e:
+                    print(f"⚠️ on_complete callback failed for {task.filename}: {e}")
+    
+    async def _prepare_record(self, task: ProcessingTask) -> Dict[str, Any]:
+        """Combine OCR + Logic results and run the same post-processing as /upload."""
+        final = task.ocr_result.copy() if task.ocr_result else {}
+        
+        if task.logic_result:
+            final['hsn_code'] = task.logic_result.get('hsn_code', final.get('hsn_code', ''))
+            final['ledger_name'] = task.logic_result.get('ledger_name', 'Purchase A/c')
+            final['group_name'] = task.logic_result.get('group_name', 'Purchase Accounts')
+            final['ai_confidence'] = task.logic_result.get('confidence', 'medium')
+        
+        final['filename'] = task.filename
+        final['client_id'] = task.client_id
+        final['doc_type'] = task.doc_type
+        
+        # Vendor resolution reads the vendor master, so it runs in the I/O pool
+        final = await run_blocking(_enrich_for_save, final, task.doc_type)
+        
+        file_size = None
+        if task.file_path:
+            try:
+                file_size = await run_blocking(os.path.getsize, task.file_path)
+            except OSError:
+                pass
+        
+        return {
+            "data": final,
+            "client_id": task.client_id,
+            "user_id": task.user_id,
+            "doc_type": task.doc_type,
+            "entered_by": task.entered_by,
+            "file_path": task.file_path,
+            "file_type": file_type_for(task.filename),
+            "file_size": file_size,
+            "confidence_level": final.get('ai_confidence') or 'medium',
+        }
+    
+    def _write_batch(self, ready: List[tuple]) -> List[Dict]:
+        """
+        One transaction: documents rows and the tasks' completed state.
+        A crash before the commit leaves the tasks in SAVING, so recovery re-saves
+        them without creating duplicate documents.
+        """
+        # The pool's writer: commits on success, rolls back on error
+        with get_pool(self.store.db_path).write() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            outcomes = insert_documents_batch(conn, [record for _, record in ready])
+            
+            finals, updates, unreferenced = [], [], []
+            for (task, record), outcome in zip(ready, outcomes):
+                final = record["data"]
+                if outcome["duplicate"]:
+                    final['gst_status'] = "DUPLICATE BILL"
+                    final['error'] = "This bill already exists for this client"
+                    unreferenced.append(record["file_path"])
+                else:
+                    final['id'] = outcome["id"]
+                    final['review_status'] = outcome["review_status"]
+                    final['confidence_level'] = record["confidence_level"]
+                    final['vendor_id'] = outcome["vendor_id"]
+                finals.append(final)
+                updates.append((task.task_id, TaskStatus.COMPLETED.value, {"final_result": final}))
+            
+            self.store.update_many(updates, conn=conn)
+        
+        # Duplicates got no row - drop the upload reference their endpoint took
+        for path in unreferenced:
+            try:
+                upload_store.release(path)
+            except Exception as e:
+                print(f"⚠️ Could not release upload {path}: {e}")
+        return finals
+
+
+async def _release_upload(path: Optional[str]):
+    """Drop one reference to a task's stored upload (errors are logged, not raised)."""
+    if not path:
+        return
+    try:
+        await run_blocking(upload_store.release, path)
+    except Exception as e:
+        print(f"⚠️ Could not release upload {path}: {e}")
+
+
+def _advances(previous: Optional[str], status: str) -> bool:
+    """True if `status` is later in the pipeline than `previous`."""
+    order = [s.value for s in TaskStatus]
+    return previous is None or order.index(status) > order.index(previous)
+
+
+def _enrich_for_save(final: Dict, doc_type: str) -> Dict:
+    """
+    Vendor resolution, narration and ITC check from main.py.
+    Imported here rather than at module level - main.py imports this module.
+    """
+    from main import smart_resolve_vendor, generate_auto_narration, check_itc_eligibility
+    
+    final = smart_resolve_vendor(final)
+    final = generate_auto_narration(final)
+    final = check_itc_eligibility(final, doc_type)
+    return final
 
 
 # =============================================================================
@@ -372,16 +986,20 @@ pipeline = AsyncPipeline(max_concurrent=5)
 # =============================================================================
 
 async def process_document_async(
-    file_bytes: bytes,
+    file_bytes: Optional[bytes],
     mime_type: str,
     filename: str,
     client_id: Optional[int] = None,
     doc_type: str = "gst_invoice",
-    entered_by: Optional[str] = None
+    entered_by: Optional[str] = None,
+    file_path: Optional[str] = None,
+    user_id: Optional[int] = None,
+    batch_id: Optional[str] = None
 ) -> str:
     """
     Submit a document for async processing.
     Returns task_id immediately - caller can poll for status.
+    file_path should point at the saved upload so the task survives a restart.
     """
     # Ensure workers are started
     await pipeline.start_workers()
@@ -394,7 +1012,10 @@ async def process_document_async(
         mime_type=mime_type,
         client_id=client_id,
         doc_type=doc_type,
-        entered_by=entered_by
+        entered_by=entered_by,
+        file_path=file_path,
+        user_id=user_id,
+        batch_id=batch_id
     )
     
     # Submit to pipeline
@@ -403,20 +1024,34 @@ async def process_document_async(
 
 async def get_task_status(task_id: str) -> Dict:
     """Get the status of a processing task."""
-    return pipeline.get_status(task_id)
+    return await run_blocking(pipeline.get_status, task_id)
 
 
 async def wait_for_task(task_id: str, timeout: float = 60.0) -> Dict:
-    """Wait for a task to complete (for backward compatibility)."""
-    start = time.time()
+    """
+    Wait for a task to complete (for backward compatibility).
+    Tasks running in this process wake the caller the moment they finish;
+    tasks owned by another worker process are checked in the store once a second.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
     
-    while time.time() - start < timeout:
-        status = pipeline.get_status(task_id)
-        if status['status'] in ['completed', 'failed']:
+    while True:
+        task = pipeline.tasks.get(task_id)
+        remaining = deadline - loop.time()
+        if task is not None:
+            try:
+                await asyncio.wait_for(task.done.wait(), timeout=max(0.0, remaining))
+            except asyncio.TimeoutError:
+                return {"status": "timeout", "task_id": task_id}
+        
+        status = await get_task_status(task_id)
+        if status['status'] in ['completed', 'failed', 'not_found']:
             return status
-        await asyncio.sleep(0.5)
-    
-    return {"status": "timeout", "task_id": task_id}
+        if remaining <= 0:
+            return {"status": "timeout", "task_id": task_id}
+        if task_id not in pipeline.tasks:
+            await asyncio.sleep(min(1.0, remaining))
 
 
 # =============================================================================
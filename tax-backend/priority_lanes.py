@@ -0,0 +1,180 @@
+# priority_lanes.py
+# -----------------------------------------------------------------------------
+# PRIORITY LANES FOR MODEL CALLS - Interactive search never waits behind a bulk import
+# Every model call runs in a lane:
+#   interactive - Jarvis (/search/ai), a person is waiting on screen
+#   online      - single uploads and per-request classification (the default)
+#   bulk        - pipeline / bulk imports / background work
+# Lanes share a fixed number of call slots through weighted fair queuing, and
+# a few slots are held back for interactive calls only.
+# -----------------------------------------------------------------------------
+
+import os
+import time
+import asyncio
+import itertools
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, List, Optional
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+INTERACTIVE = "interactive"
+ONLINE = "online"
+BULK = "bulk"
+
+LANES = (INTERACTIVE, ONLINE, BULK)
+
+# Share of contended slots each lane gets (8:3:1 → a bulk import still progresses)
+LANE_WEIGHTS = {
+    INTERACTIVE: float(os.getenv("AI_LANE_WEIGHT_INTERACTIVE", "8")),
+    ONLINE: float(os.getenv("AI_LANE_WEIGHT_ONLINE", "3")),
+    BULK: float(os.getenv("AI_LANE_WEIGHT_BULK", "1")),
+}
+
+# Lower rank = served first where a strict order is needed (key scheduler line)
+LANE_RANK = {INTERACTIVE: 0, ONLINE: 1, BULK: 2}
+
+# Model calls in flight at once, across every lane and both AI clients
+LANE_CAPACITY = int(os.getenv("AI_LANE_CAPACITY", "12"))
+
+# Slots only interactive calls may take
+RESERVED_INTERACTIVE = int(os.getenv("AI_LANE_RESERVED_INTERACTIVE", "2"))
+
+# Lane of the current request/worker; set with `ai_lane(...)` or `set_lane(...)`
+_current_lane: ContextVar[str] = ContextVar("ai_lane", default=ONLINE)
+
+
+def current_lane() -> str:
+    return _current_lane.get()
+
+
+def set_lane(lane: str):
+    """Pin the lane for the rest of this task (e.g. at the top of a pipeline worker)."""
+    _current_lane.set(lane if lane in LANES else ONLINE)
+
+
+@contextmanager
+def ai_lane(lane: str) -> Iterator[None]:
+    """`with ai_lane(INTERACTIVE):` - model calls made inside run in that lane."""
+    token = _current_lane.set(lane if lane in LANES else ONLINE)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+class LaneScheduler:
+    """
+    Start-time fair queuing over a fixed pool of call slots.
+    Each waiter is tagged max(virtual_time, lane's last tag) + 1/weight when it
+    arrives; a freed slot goes to the smallest tag among lanes allowed to run.
+    Non-interactive lanes may only use capacity - reserved slots.
+    """
+
+    def __init__(self, capacity: int = LANE_CAPACITY, reserved_interactive: int = RESERVED_INTERACTIVE):
+        self.capacity = max(1, capacity)
+        self.reserved = max(0, min(reserved_interactive, self.capacity - 1))
+        self._in_use = 0
+        self._lane_in_use = {lane: 0 for lane in LANES}
+        self._queues: Dict[str, Deque] = {lane: deque() for lane in LANES}
+        self._last_tag = {lane: 0.0 for lane in LANES}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+        # Metrics
+        self._waits: Dict[str, Deque] = {lane: deque(maxlen=1000) for lane in LANES}
+        self._served = {lane: 0 for lane in LANES}
+
+    def _can_run(self, lane: str) -> bool:
+        limit = self.capacity if lane == INTERACTIVE else self.capacity - self.reserved
+        return self._in_use < limit
+
+    def _grant(self, lane: str):
+        self._in_use += 1
+        self._lane_in_use[lane] += 1
+        self._served[lane] += 1
+
+    def _dispatch(self):
+        while self._in_use < self.capacity:
+            best = None
+            for lane in LANES:
+                queue = self._queues[lane]
+                # Drop waiters that gave up (cancelled) before their turn
+                while queue and queue[0][2].done():
+                    queue.popleft()
+                if queue and self._can_run(lane) and (best is None or queue[0][:2] < self._queues[best][0][:2]):
+                    best = lane
+            if best is None:
+                return
+            tag, _, future, _ = self._queues[best].popleft()
+            self._virtual_time = max(self._virtual_time, tag)
+            self._grant(best)
+            future.set_result(None)
+
+    async def acquire(self, lane: str):
+        enqueued = time.monotonic()
+        if not any(self._queues.values()) and self._can_run(lane):
+            self._grant(lane)
+            self._waits[lane].append(0.0)
+            return
+        tag = max(self._virtual_time, self._last_tag[lane]) + 1.0 / LANE_WEIGHTS.get(lane, 1.0)
+        self._last_tag[lane] = tag
+        future = asyncio.get_running_loop().create_future()
+        self._queues[lane].append((tag, next(self._seq), future, enqueued))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Slot was granted just as we were cancelled - hand it back
+                self.release(lane)
+            raise
+        self._waits[lane].append(time.monotonic() - enqueued)
+
+    def release(self, lane: str):
+        self._in_use -= 1
+        self._lane_in_use[lane] -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, lane: Optional[str] = None) -> AsyncIterator[str]:
+        """`async with lanes.slot():` - hold one call slot in the current (or given) lane."""
+        lane = lane if lane in LANES else current_lane()
+        await self.acquire(lane)
+        try:
+            yield lane
+        finally:
+            self.release(lane)
+
+    def snapshot(self) -> Dict[str, Any]:
+        def pct(samples: List[float], p: float) -> Optional[float]:
+            if not samples:
+                return None
+            ordered = sorted(samples)
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 3)
+
+        lanes = {}
+        for lane in LANES:
+            waits = list(self._waits[lane])
+            lanes[lane] = {
+                "weight": LANE_WEIGHTS[lane],
+                "in_flight": self._lane_in_use[lane],
+                "waiting": sum(1 for item in self._queues[lane] if not item[2].done()),
+                "served": self._served[lane],
+                "wait_p50": pct(waits, 0.5),
+                "wait_p95": pct(waits, 0.95),
+                "wait_max": round(max(waits), 3) if waits else None,
+            }
+        return {
+            "capacity": self.capacity,
+            "reserved_interactive": self.reserved,
+            "in_flight": self._in_use,
+            "lanes": lanes,
+        }
+
+
+# Global instance shared by ai_config (sync paths) and async_ai (pipeline)
+lanes = LaneScheduler()
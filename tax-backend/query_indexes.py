@@ -0,0 +1,155 @@
+# query_indexes.py
+# -----------------------------------------------------------------------------
+# WORKLOAD INDEXES - composite + expression indexes for the hot queries
+# init_db's indexes are one column each, but the hot queries filter on
+# combinations (user + history flag, client + review status, the duplicate
+# check) or on an expression (UPPER(gstin), LOWER(vendor_name)), so SQLite
+# either picked a half-useful index or scanned. INDEXES is built from
+# HOT_QUERIES - the statements the routes actually run - and
+# benchmarks/query_plan_check.py fails if EXPLAIN QUERY PLAN shows a full
+# table scan for any of them. Add a query there when you add a hot path.
+# -----------------------------------------------------------------------------
+
+import sqlite3
+from typing import Dict, List, Tuple
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# name → table(columns). Created (IF NOT EXISTS) at startup, after the
+# migrations have added the columns they use.
+INDEXES: Dict[str, str] = {
+    # /history: the invoices view is documents WHERE show_in_history = 1 AND user_id = ?
+    # ORDER BY id DESC - both equalities, and rowid order comes free with the index
+    "idx_documents_user_history": "documents(user_id, show_in_history)",
+    # Client folder counts (COUNT + SUM(review_status = ...) WHERE client_id = ?),
+    # answered from the index alone; client_id IS NULL serves the triage inbox
+    "idx_documents_client_review": "documents(client_id, review_status)",
+    # Duplicate check before every insert (/upload, pipeline writer)
+    "idx_documents_duplicate": "documents(invoice_no, gst_no, client_id)",
+    # Sherlock vendor lookup by GSTIN and vendor matching by name - the
+    # plain column indexes can't serve a function of the column
+    "idx_vendors_gstin_upper": "vendors(UPPER(gstin))",
+    "idx_vendors_name_lower": "vendors(LOWER(vendor_name))",
+    # Multi-tenant filters join through clients.user_id
+    "idx_clients_user": "clients(user_id)",
+    # /communications/analytics counts per channel, per user's clients
+    "idx_comm_channel_client": "communications(channel, client_id)",
+    # A client's log newest first; today's count per client
+    "idx_comm_client_sent": "communications(client_id, sent_date)",
+}
+
+# Single-column index → the composite above it is a prefix of. Dropped once
+# the composite exists (every index costs a B-tree update on each write).
+SUPERSEDED_INDEXES: Dict[str, str] = {
+    "idx_documents_user": "idx_documents_user_history",
+    "idx_documents_client": "idx_documents_client_review",
+    "idx_comm_client": "idx_comm_client_sent",
+}
+
+# name → (sql, sample params), copied from the code that runs them
+HOT_QUERIES: Dict[str, Tuple[str, tuple]] = {
+    "history": (
+        "SELECT * FROM invoices WHERE user_id = ? ORDER BY id DESC", (1,)
+    ),
+    "invoice_owned": (
+        "SELECT * FROM invoices WHERE id = ? AND user_id = ?", (1, 1)
+    ),
+    "duplicate_check": (
+        "SELECT id FROM documents WHERE invoice_no = ? AND gst_no = ? AND client_id = ?", ("INV-1", "GSTIN", 1)
+    ),
+    "client_review_counts": (
+        "SELECT COUNT(*) as total, SUM(review_status = 'pending') as pending, MAX(upload_date) as last_upload "
+        "FROM documents WHERE client_id = ?", (1,)
+    ),
+    "client_pending": (
+        "SELECT id FROM documents WHERE client_id = ? AND review_status = ?", (1, "pending")
+    ),
+    "client_documents": (
+        "SELECT * FROM documents WHERE client_id = ? ORDER BY invoice_date DESC, id DESC", (1,)
+    ),
+    "triage_stats": (
+        "SELECT COUNT(*) as total FROM documents WHERE client_id IS NULL AND user_id = ?", (1,)
+    ),
+    "unassigned": (
+        "SELECT d.*, 'document' as source_table FROM documents d WHERE d.client_id IS NULL "
+        "ORDER BY d.entered_date DESC", ()
+    ),
+    "vendor_by_gstin": (
+        "SELECT id, vendor_name, default_hsn, default_ledger, default_group FROM vendors "
+        "WHERE UPPER(gstin) = UPPER(?)", ("27AAAAA0000A1Z5",)
+    ),
+    "vendor_by_name": (
+        "SELECT id FROM vendors WHERE LOWER(vendor_name) = LOWER(?)", ("ABC Traders",)
+    ),
+    "clients_of_user": (
+        "SELECT * FROM clients WHERE user_id = ?", (1,)
+    ),
+    "comm_channel_count": (
+        "SELECT COUNT(*) as count FROM communications c JOIN clients cl ON c.client_id = cl.id "
+        "WHERE c.channel = 'whatsapp' AND cl.user_id = ?", (1,)
+    ),
+    "comm_today_count": (
+        "SELECT COUNT(*) as count FROM communications c JOIN clients cl ON c.client_id = cl.id "
+        "WHERE DATE(c.sent_date) = DATE('now') AND cl.user_id = ?", (1,)
+    ),
+    "comm_recent": (
+        "SELECT c.*, cl.company_name as client_name, cl.phone as client_phone FROM communications c "
+        "JOIN clients cl ON c.client_id = cl.id WHERE cl.user_id = ? ORDER BY c.sent_date DESC LIMIT 20", (1,)
+    ),
+    "comm_client": (
+        "SELECT c.*, cl.company_name as client_name FROM communications c LEFT JOIN clients cl ON c.client_id = cl.id "
+        "WHERE c.client_id = ? ORDER BY c.sent_date DESC LIMIT 50", (1,)
+    ),
+}
+
+
+def ensure_indexes(db_path: str = "tax_data.db") -> List[str]:
+    """Create INDEXES, drop SUPERSEDED_INDEXES. Returns the names created now."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        created = []
+        for name, definition in INDEXES.items():
+            if name not in existing:
+                try:
+                    conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+                    created.append(name)
+                except sqlite3.OperationalError as e:
+                    # A migration that adds the column hasn't run (or failed) - next startup
+                    print(f"⚠️ Index {name} skipped: {e}")
+        for name, replacement in SUPERSEDED_INDEXES.items():
+            if replacement in existing or replacement in created:
+                conn.execute(f"DROP INDEX IF EXISTS {name}")
+        conn.commit()
+        if created:
+            print(f"🗂️ Created indexes: {', '.join(created)}")
+        return created
+    finally:
+        conn.close()
+
+
+def query_plan(conn: sqlite3.Connection, sql: str, params: tuple = ()) -> List[str]:
+    """EXPLAIN QUERY PLAN detail lines, e.g. 'SEARCH documents USING INDEX ... (client_id=?)'."""
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+
+
+def is_full_scan(detail: str) -> bool:
+    # "SCAN documents" reads the whole table, "SCAN vendors USING COVERING INDEX ..."
+    # the whole index - both grow with the table. Hot queries must SEARCH.
+    return detail.startswith("SCAN ") and detail != "SCAN CONSTANT ROW"
+
+
+def full_scans(db_path: str = "tax_data.db") -> Dict[str, List[str]]:
+    """Hot queries whose plan has a full table scan → their plan. Empty = all good."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        failing = {}
+        for name, (sql, params) in HOT_QUERIES.items():
+            plan = query_plan(conn, sql, params)
+            if any(is_full_scan(detail) for detail in plan):
+                failing[name] = plan
+        return failing
+    finally:
+        conn.close()
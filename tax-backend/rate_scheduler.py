@@ -0,0 +1,286 @@
+# rate_scheduler.py
+# -----------------------------------------------------------------------------
+# OPENROUTER KEY SCHEDULER - Token buckets per API key + one waiting line
+# Callers queue for the next key that actually has capacity instead of firing
+# at an exhausted key and retrying blindly. A 429 puts the key on cooldown for
+# its Retry-After (or an exponential, jittered backoff); a global semaphore
+# caps how many model calls are in flight at once. The line is ordered by
+# priority lane first, so interactive calls get the next free key.
+# -----------------------------------------------------------------------------
+
+import os
+import time
+import heapq
+import random
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# Per-key limits (OpenRouter free tier: 20 requests/minute, 50 requests/day)
+KEY_REQUESTS_PER_MINUTE = float(os.getenv("OPENROUTER_KEY_RPM", "20"))
+KEY_REQUESTS_PER_DAY = int(os.getenv("OPENROUTER_KEY_RPD", "50"))
+
+# Tokens a key can accumulate - how big a burst one idle key may take
+KEY_BURST = float(os.getenv("OPENROUTER_KEY_BURST", "5"))
+
+# Model calls in flight at once, across all keys
+MAX_CONCURRENCY = int(os.getenv("OPENROUTER_MAX_CONCURRENCY", "8"))
+
+# A caller gives up if no key will be free within this long
+MAX_WAIT_SECONDS = float(os.getenv("OPENROUTER_MAX_WAIT_SECONDS", "120"))
+
+# Exponential backoff with full jitter: uniform(0, min(MAX, BASE * 2^attempt))
+BACKOFF_BASE_SECONDS = float(os.getenv("OPENROUTER_BACKOFF_BASE", "1"))
+BACKOFF_MAX_SECONDS = float(os.getenv("OPENROUTER_BACKOFF_MAX", "60"))
+
+
+class NoKeyAvailable(Exception):
+    """No configured key can serve a request within MAX_WAIT_SECONDS (or all are out for the day)."""
+    pass
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff for retry number `attempt` (0-based)."""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After as seconds: either delta-seconds or an HTTP date. None if absent/garbled."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def _end_of_day(now: float) -> float:
+    """Daily quotas reset at UTC midnight."""
+    return now + (86400 - (now % 86400))
+
+
+class PrioritySemaphore:
+    """
+    Semaphore whose waiters are woken lowest priority value first, then in
+    arrival order. With value=1 it is the scheduler's waiting line.
+    """
+
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters: list = []
+        self._seq = itertools.count()
+
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def ticket(self) -> int:
+        """An arrival number - pass it to acquire() again to keep your place among equal priorities."""
+        return next(self._seq)
+
+    async def acquire(self, priority: int = 0, ticket: Optional[int] = None):
+        if self._value > 0 and not self.waiting():
+            self._value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, self.ticket() if ticket is None else ticket, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Woken just as we were cancelled - pass the permit on
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+
+@dataclass
+class KeyState:
+    key: str
+    tokens: float = KEY_BURST
+    updated: float = field(default_factory=time.monotonic)
+    daily_count: int = 0
+    daily_reset: float = field(default_factory=lambda: _end_of_day(time.time()))
+    cooldown_until: float = 0.0          # monotonic - set by 429s
+    consecutive_429: int = 0
+    in_flight: int = 0
+
+    def refill(self, now: float):
+        rate = KEY_REQUESTS_PER_MINUTE / 60.0
+        self.tokens = min(KEY_BURST, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if time.time() >= self.daily_reset:
+            self.daily_count = 0
+            self.daily_reset = _end_of_day(time.time())
+
+    def ready_in(self, now: float) -> Optional[float]:
+        """Seconds until this key can take a request (None = out for the day)."""
+        self.refill(now)
+        if self.daily_count >= KEY_REQUESTS_PER_DAY:
+            return None
+        token_wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) * 60.0 / KEY_REQUESTS_PER_MINUTE
+        return max(token_wait, self.cooldown_until - now, 0.0)
+
+
+class KeyScheduler:
+    """
+    Hands out API keys under per-key token buckets.
+    Waiters form one line ordered by priority, then arrival: the head of the
+    line sleeps until the soonest key is ready while later callers queue
+    behind it - no polling, no thundering herd on recovery. A more urgent
+    caller joining the line wakes the sleeping head, which steps back into
+    the line (same priority, same place) so the newcomer is served first.
+    """
+
+    def __init__(self, keys: List[str], max_concurrency: int = MAX_CONCURRENCY):
+        self.keys = [KeyState(key=k) for k in keys]
+        self.max_concurrency = max_concurrency
+        self._slots = PrioritySemaphore(max_concurrency)
+        self._line = PrioritySemaphore(1)
+        # (priority, wake-up event) of the head of the line while it sleeps
+        self._sleeper: Optional[tuple] = None
+        self._waiting = 0
+        self._in_flight = 0
+        self._rr = 0
+        self.waited_seconds = 0.0
+        self.rejected = 0
+
+    async def _take_key(self, max_wait: float, priority: int) -> KeyState:
+        if not self.keys:
+            raise NoKeyAvailable("No API keys available.")
+        deadline = time.monotonic() + max_wait
+        ticket = self._line.ticket()
+        while True:
+            if self._sleeper is not None and priority < self._sleeper[0]:
+                self._sleeper[1].set()
+            await self._line.acquire(priority, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    best, best_wait = None, None
+                    count = len(self.keys)
+                    for offset in range(count):
+                        # Round-robin among equally ready keys
+                        state = self.keys[(self._rr + offset) % count]
+                        wait = state.ready_in(now)
+                        if wait is not None and (best_wait is None or wait < best_wait):
+                            best, best_wait = state, wait
+                    if best is None:
+                        raise NoKeyAvailable("All OpenRouter keys have used their daily quota.")
+                    if best_wait <= 0:
+                        best.tokens -= 1
+                        best.daily_count += 1
+                        self._rr = (self.keys.index(best) + 1) % count
+                        return best
+                    if now + best_wait > deadline:
+                        raise NoKeyAvailable(f"No OpenRouter key free for {best_wait:.0f}s")
+                    if not await self._sleep_at_head(best_wait, priority):
+                        # A more urgent caller is waiting - hand it the line and queue again
+                        break
+            finally:
+                self._line.release()
+
+    async def _sleep_at_head(self, seconds: float, priority: int) -> bool:
+        """Sleep holding the line. False if a more urgent caller cut it short."""
+        woken = asyncio.Event()
+        self._sleeper = (priority, woken)
+        try:
+            await asyncio.wait_for(woken.wait(), timeout=seconds)
+            return False
+        except asyncio.TimeoutError:
+            return True
+        finally:
+            self._sleeper = None
+
+    @asynccontextmanager
+    async def slot(self, max_wait: float = MAX_WAIT_SECONDS, priority: int = 0) -> AsyncIterator[KeyState]:
+        """
+        `async with scheduler.slot() as key_state:` - one concurrency slot plus one
+        token from the soonest-available key, held for the duration of the request.
+        Lower `priority` values are served first when callers are queued.
+        """
+        started = time.monotonic()
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(priority), timeout=max_wait)
+        except asyncio.TimeoutError:
+            self._waiting -= 1
+            self.rejected += 1
+            raise NoKeyAvailable(f"{self.max_concurrency} OpenRouter calls already in flight")
+        try:
+            try:
+                state = await self._take_key(max(0.0, max_wait - (time.monotonic() - started)), priority)
+            except NoKeyAvailable:
+                self.rejected += 1
+                raise
+            finally:
+                self._waiting -= 1
+            self.waited_seconds += time.monotonic() - started
+            self._in_flight += 1
+            state.in_flight += 1
+            try:
+                yield state
+            finally:
+                state.in_flight -= 1
+                self._in_flight -= 1
+        finally:
+            self._slots.release()
+
+    def rate_limited(self, state: KeyState, retry_after: Optional[float] = None) -> float:
+        """Record a 429: empty the key's bucket and cool it down. Returns the cooldown in seconds."""
+        state.consecutive_429 += 1
+        cooldown = retry_after if retry_after is not None else backoff_delay(state.consecutive_429)
+        # A key that keeps getting 429s stays out at least as long as its backoff says
+        cooldown = max(cooldown, BACKOFF_BASE_SECONDS)
+        now = time.monotonic()
+        state.refill(now)
+        state.tokens = min(state.tokens, 0.0)
+        state.cooldown_until = max(state.cooldown_until, now + cooldown)
+        return cooldown
+
+    def succeeded(self, state: KeyState):
+        state.consecutive_429 = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        keys = []
+        for state in self.keys:
+            wait = state.ready_in(now)
+            keys.append({
+                "key": state.key[:10] + "...",
+                "tokens": round(state.tokens, 2),
+                "daily_used": state.daily_count,
+                "ready_in": None if wait is None else round(wait, 2),
+                "cooldown": round(max(0.0, state.cooldown_until - now), 2),
+                "in_flight": state.in_flight,
+            })
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self._in_flight,
+            "waiting": self._waiting,
+            "rejected": self.rejected,
+            "total_wait_seconds": round(self.waited_seconds, 2),
+            "keys": keys,
+        }
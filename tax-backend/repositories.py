@@ -0,0 +1,585 @@
+# repositories.py
+# -----------------------------------------------------------------------------
+# ASYNC DATA ACCESS - Invoices, documents, clients and vendors
+# Routes await repository methods instead of running sqlite3 on the event
+# loop. Each method's SQL (and the JSON decoding of json_data) runs on a
+# dedicated DB thread pool with pooled connections from db_pool, so a long
+# SELECT * FROM invoices in /history or /export/tally/simulate no longer
+# stalls every other request. Bills live in documents; `invoices` is a view
+# over it in the legacy shape, so invoice reads use the view and writes go
+# to documents. Reads use the pool's read connections, writes
+# its single writer (one transaction per method).
+# -----------------------------------------------------------------------------
+
+import os
+import json
+import asyncio
+import sqlite3
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from db_pool import get_pool
+from document_writer import PROMOTED_COLUMNS, promoted_values
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# Threads that run database work (kept apart from offload's I/O pool so a
+# burst of file writes can't queue queries, and vice versa)
+DB_THREADS = int(os.getenv("DB_THREADS", "8"))
+
+_db_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_db_executor() -> ThreadPoolExecutor:
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="kairo-db")
+    return _db_executor
+
+
+async def run_db(func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking database function on the DB thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_db_executor(), functools.partial(func, *args, **kwargs))
+
+
+def on_db_thread(route: Callable) -> Callable:
+    """
+    For routes whose body is plain sqlite3 work (get_db_connection() ...):
+    FastAPI still sees an async route with the same signature, but the body
+    runs on the DB thread pool, so waiting on the writer lock never blocks
+    the event loop.
+    """
+    @functools.wraps(route)
+    async def wrapper(*args, **kwargs):
+        return await run_db(route, *args, **kwargs)
+    return wrapper
+
+
+def shutdown_db_executor():
+    """Release the DB threads at app shutdown."""
+    global _db_executor
+    if _db_executor is not None:
+        _db_executor.shutdown(wait=False, cancel_futures=True)
+        _db_executor = None
+
+
+# "taxable_value = ?, cgst_amount = ?, ..." for keeping the promoted columns in sync
+_PROMOTED_SET = ", ".join(f"{column} = ?" for column in PROMOTED_COLUMNS)
+
+
+def _promoted(data: Dict[str, Any]) -> tuple:
+    values = promoted_values(data)
+    return tuple(values[column] for column in PROMOTED_COLUMNS)
+
+
+def _merge_json(row: sqlite3.Row) -> Dict[str, Any]:
+    """Row as a dict with its json_data fields merged over the columns (bad JSON ignored)."""
+    doc = dict(row)
+    if doc.get('json_data'):
+        try:
+            doc.update(json.loads(doc['json_data']))
+        except (TypeError, ValueError):
+            pass
+    return doc
+
+
+class Repository:
+    """Base: `await self._read(fn, ...)` / `await self._write(fn, ...)` run fn(conn, ...) on the DB pool."""
+
+    def __init__(self, db_path: str = "tax_data.db"):
+        self.db_path = db_path
+
+    def _run_read(self, fn: Callable, *args) -> Any:
+        with get_pool(self.db_path).read() as conn:
+            return fn(conn, *args)
+
+    def _run_write(self, fn: Callable, *args) -> Any:
+        with get_pool(self.db_path).write() as conn:
+            return fn(conn, *args)
+
+    async def _read(self, fn: Callable, *args) -> Any:
+        return await run_db(self._run_read, fn, *args)
+
+    async def _write(self, fn: Callable, *args) -> Any:
+        return await run_db(self._run_write, fn, *args)
+
+
+# =============================================================================
+# INVOICES (reads: the invoices view over documents; writes: documents)
+# =============================================================================
+
+class InvoiceRepository(Repository):
+
+    async def history(self, user_id: int) -> List[Dict[str, Any]]:
+        """The user's invoices, newest first, as /history returns them."""
+        def query(conn, user_id):
+            # CRITICAL: Filter by user_id to prevent cross-user data access
+            rows = conn.execute("SELECT * FROM invoices WHERE user_id = ? ORDER BY id DESC", (user_id,)).fetchall()
+            results = []
+            for row in rows:
+                try:
+                    data = json.loads(row['json_data'])
+                    keys = row.keys()
+                    data['id'] = row['id']
+                    data['file_path'] = row['file_path'] if 'file_path' in keys else None
+                    data['payment_status'] = row['payment_status'] if 'payment_status' in keys else "Unpaid"
+                    # HSN, Ledger, Group columns override json_data if present
+                    for column in ('hsn_code', 'ledger_name', 'group_name'):
+                        if column in keys and row[column]:
+                            data[column] = row[column]
+                except Exception:
+                    continue   # unreadable row - skipped, as before
+                results.append(data)
+            return results
+        return await self._read(query, user_id)
+
+    async def all_data(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Decoded json_data of every invoice (exports and export validation)."""
+        def query(conn, limit):
+            sql = "SELECT json_data FROM invoices" + (" LIMIT ?" if limit else "")
+            rows = conn.execute(sql, (limit,) if limit else ()).fetchall()
+            return [json.loads(row['json_data']) for row in rows if row['json_data']]
+        return await self._read(query, limit)
+
+    async def export_rows(self) -> List[Dict[str, Any]]:
+        """What the Tally simulation checks - plain columns, no json_data parsing."""
+        def query(conn):
+            rows = conn.execute('''
+                SELECT id, vendor_name, grand_total, ledger_name, invoice_date, invoice_no, gst_no,
+                       taxable_value, cgst_amount, sgst_amount, igst_amount
+                FROM invoices
+            ''').fetchall()
+            return [dict(row) for row in rows]
+        return await self._read(query)
+
+    async def get_owned(self, invoice_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        """The invoice row if it belongs to user_id, else None."""
+        def query(conn, invoice_id, user_id):
+            row = conn.execute(
+                "SELECT * FROM invoices WHERE id = ? AND user_id = ?", (invoice_id, user_id)
+            ).fetchone()
+            return dict(row) if row else None
+        return await self._read(query, invoice_id, user_id)
+
+    async def create_manual(self, data: Dict[str, Any], user_id: int) -> int:
+        def insert(conn, data, user_id):
+            columns = ", ".join(PROMOTED_COLUMNS)
+            placeholders = ", ".join("?" for _ in PROMOTED_COLUMNS)
+            # Entered by hand - nothing for the review queue to check
+            cursor = conn.execute(
+                f"INSERT INTO documents (doc_type, review_status, is_manual, invoice_no, invoice_date, vendor_name, grand_total, json_data, hsn_code, ledger_name, group_name, user_id, {columns}) VALUES ('gst_invoice', 'approved', 1, ?, ?, ?, ?, ?, ?, ?, ?, ?, {placeholders})",
+                (data.get('invoice_no'), data.get('invoice_date'), data.get('vendor_name'),
+                 data.get('grand_total'), json.dumps(data), data.get('hsn_code'), data.get('ledger_name'),
+                 data.get('group_name'), user_id) + _promoted(data)
+            )
+            return cursor.lastrowid
+        return await self._write(insert, data, user_id)
+
+    async def update(self, invoice_id: int, data: Dict[str, Any], payment_status: str):
+        """Store edited invoice data and its mirrored columns (promoted tax fields included)."""
+        def update(conn, invoice_id, data, payment_status):
+            conn.execute(
+                f"UPDATE documents SET json_data = ?, grand_total = ?, vendor_name = ?, invoice_no = ?, payment_status = ?, hsn_code = ?, ledger_name = ?, group_name = ?, {_PROMOTED_SET} WHERE id = ?",
+                (json.dumps(data), data.get('grand_total'), data.get('vendor_name'), data.get('invoice_no'),
+                 payment_status, data.get('hsn_code'), data.get('ledger_name'), data.get('group_name'))
+                + _promoted(data) + (invoice_id,)
+            )
+        await self._write(update, invoice_id, data, payment_status)
+
+    async def delete_owned(self, invoice_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        """Delete the bill if user_id owns it (gone from every view). Returns its file_path info, None if not found."""
+        def delete(conn, invoice_id, user_id):
+            # CRITICAL: Verify ownership before deletion (same transaction as the DELETE)
+            row = conn.execute(
+                "SELECT file_path FROM invoices WHERE id = ? AND user_id = ?", (invoice_id, user_id)
+            ).fetchone()
+            if not row:
+                return None
+            conn.execute("DELETE FROM documents WHERE id = ?", (invoice_id,))
+            return {"file_path": row['file_path']}
+        return await self._write(delete, invoice_id, user_id)
+
+    async def group_by_vendor(self) -> Tuple[List[Dict[str, Any]], int]:
+        """(per-vendor bill counts and current ledger/group, count of invoices without a real vendor)."""
+        def query(conn):
+            groups = conn.execute('''
+                SELECT
+                    vendor_name,
+                    COUNT(*) as bill_count,
+                    SUM(grand_total) as total_amount,
+                    ledger_name,
+                    group_name,
+                    MIN(id) as sample_id
+                FROM invoices
+                WHERE vendor_name IS NOT NULL AND vendor_name != ''
+                GROUP BY vendor_name
+                ORDER BY bill_count DESC
+            ''').fetchall()
+            unassigned = conn.execute('''
+                SELECT COUNT(*) as count FROM invoices
+                WHERE vendor_name IS NULL OR vendor_name = '' OR vendor_name = 'Cash Sales'
+            ''').fetchone()
+            return [dict(group) for group in groups], unassigned['count']
+        return await self._read(query)
+
+    async def bulk_update_ledger(self, ledger_name: Optional[str], group_name: Optional[str],
+                                 invoice_ids: Optional[List[int]] = None,
+                                 vendor_name: Optional[str] = None) -> Tuple[int, set]:
+        """Set ledger/group on the given invoices (or all of a vendor's). Returns (updated, vendors touched)."""
+        def update(conn, ledger_name, group_name, invoice_ids, vendor_name):
+            if invoice_ids:
+                placeholders = ",".join("?" * len(invoice_ids))
+                found = {row['id']: row for row in conn.execute(
+                    f"SELECT id, json_data, vendor_name FROM invoices WHERE id IN ({placeholders})", list(invoice_ids)
+                ).fetchall()}
+                rows = [found[inv_id] for inv_id in invoice_ids if inv_id in found]
+                corrected = {row['vendor_name'] for row in rows}
+            else:
+                rows = conn.execute(
+                    "SELECT id, json_data FROM invoices WHERE vendor_name = ?", (vendor_name,)
+                ).fetchall()
+                corrected = {vendor_name}
+            updates = []
+            for row in rows:
+                data = json.loads(row['json_data'])
+                if ledger_name:
+                    data['ledger_name'] = ledger_name
+                if group_name:
+                    data['group_name'] = group_name
+                # Re-derived from the same json_data, so rows missed by the backfill catch up here too
+                updates.append((json.dumps(data), ledger_name, group_name) + _promoted(data) + (row['id'],))
+            conn.executemany(
+                f"UPDATE documents SET json_data = ?, ledger_name = ?, group_name = ?, {_PROMOTED_SET} WHERE id = ?", updates
+            )
+            return len(updates), corrected
+        return await self._write(update, ledger_name, group_name, invoice_ids, vendor_name)
+
+
+# =============================================================================
+# CLIENTS
+# =============================================================================
+
+class ClientRepository(Repository):
+
+    async def list(self, user_id: int, status: Optional[str] = None,
+                   search: Optional[str] = None) -> List[Dict[str, Any]]:
+        def query(conn, user_id, status, search):
+            # CRITICAL: Filter by user_id for multi-tenant isolation
+            sql = "SELECT * FROM clients WHERE user_id = ?"
+            params: List[Any] = [user_id]
+            if status:
+                sql += " AND status = ?"
+                params.append(status)
+            if search:
+                sql += " AND (company_name LIKE ? OR gstin LIKE ? OR phone LIKE ?)"
+                search_term = f"%{search}%"
+                params.extend([search_term, search_term, search_term])
+            sql += " ORDER BY company_name ASC"
+            return [dict(row) for row in conn.execute(sql, params).fetchall()]
+        return await self._read(query, user_id, status, search)
+
+    async def get(self, client_id: int) -> Optional[Dict[str, Any]]:
+        """Client with document_count and pending_review_count."""
+        def query(conn, client_id):
+            client = conn.execute("SELECT * FROM clients WHERE id = ?", (client_id,)).fetchone()
+            if not client:
+                return None
+            counts = conn.execute('''
+                SELECT COUNT(*) as total, SUM(review_status = 'pending') as pending
+                FROM documents WHERE client_id = ?
+            ''', (client_id,)).fetchone()
+            result = dict(client)
+            result['document_count'] = counts['total']
+            result['pending_review_count'] = counts['pending'] or 0
+            return result
+        return await self._read(query, client_id)
+
+    async def create(self, client: Dict[str, Any], user_id: int) -> int:
+        """Insert a client. Raises sqlite3.IntegrityError on a duplicate company_name."""
+        def insert(conn, client, user_id):
+            cursor = conn.execute('''
+                INSERT INTO clients (company_name, gstin, pan, contact_person, phone, email,
+                                    address, city, state, financial_year_start, client_type, user_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                client.get('company_name'), client.get('gstin'), client.get('pan'), client.get('contact_person'),
+                client.get('phone'), client.get('email'), client.get('address'), client.get('city'),
+                client.get('state'), client.get('financial_year_start'), client.get('client_type'), user_id
+            ))
+            return cursor.lastrowid
+        return await self._write(insert, client, user_id)
+
+    async def update(self, client_id: int, updates: Dict[str, Any]) -> int:
+        """Rows updated (0 → no such client). Keys are ClientUpdate fields."""
+        def update(conn, client_id, updates):
+            set_clause = ", ".join([f"{key} = ?" for key in updates.keys()])
+            cursor = conn.execute(
+                f"UPDATE clients SET {set_clause}, last_activity_date = CURRENT_TIMESTAMP WHERE id = ?",
+                list(updates.values()) + [client_id]
+            )
+            return cursor.rowcount
+        return await self._write(update, client_id, updates)
+
+    async def deactivate(self, client_id: int) -> int:
+        def update(conn, client_id):
+            return conn.execute("UPDATE clients SET status = 'Inactive' WHERE id = ?", (client_id,)).rowcount
+        return await self._write(update, client_id)
+
+    async def stats(self, client_id: int) -> Dict[str, Any]:
+        """Bill count, pending review and the raw last upload_date."""
+        def query(conn, client_id):
+            row = conn.execute('''
+                SELECT COUNT(*) as total, SUM(review_status = 'pending') as pending, MAX(upload_date) as last_upload
+                FROM documents WHERE client_id = ?
+            ''', (client_id,)).fetchone()
+            return {"total_bills": row['total'], "pending": row['pending'] or 0, "last_activity": row['last_upload']}
+        return await self._read(query, client_id)
+
+    async def documents(self, client_id: int, doc_type: Optional[str] = None) -> List[Dict[str, Any]]:
+        """The client's documents, json_data merged in."""
+        def query(conn, client_id, doc_type):
+            sql = "SELECT * FROM documents WHERE client_id = ?"
+            params: List[Any] = [client_id]
+            if doc_type:
+                sql += " AND doc_type = ?"
+                params.append(doc_type)
+            sql += " ORDER BY invoice_date DESC, id DESC"
+            return [_merge_json(row) for row in conn.execute(sql, params).fetchall()]
+        return await self._read(query, client_id, doc_type)
+
+
+# =============================================================================
+# VENDORS
+# =============================================================================
+
+class VendorRepository(Repository):
+
+    async def list(self, search: Optional[str] = None, vendor_type: Optional[str] = None) -> List[Dict[str, Any]]:
+        def query(conn, search, vendor_type):
+            sql = "SELECT * FROM vendors WHERE 1=1"
+            params: List[Any] = []
+            if search:
+                sql += " AND vendor_name LIKE ?"
+                params.append(f"%{search}%")
+            if vendor_type:
+                sql += " AND vendor_type = ?"
+                params.append(vendor_type)
+            sql += " ORDER BY frequency_count DESC, vendor_name ASC"
+            return [dict(row) for row in conn.execute(sql, params).fetchall()]
+        return await self._read(query, search, vendor_type)
+
+    async def search(self, q: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Vendors whose name contains q, most used first (autocomplete)."""
+        def query(conn, q, limit):
+            rows = conn.execute('''
+                SELECT id, vendor_name, gstin, default_hsn, default_ledger, default_group,
+                       frequency_count, last_used_date
+                FROM vendors
+                WHERE vendor_name LIKE ?
+                ORDER BY frequency_count DESC, vendor_name ASC
+                LIMIT ?
+            ''', (f"%{q}%", limit)).fetchall()
+            return [dict(row) for row in rows]
+        return await self._read(query, q, limit)
+
+    async def with_gstin(self) -> List[Dict[str, Any]]:
+        """id, vendor_name, gstin of the vendors that have a GSTIN (bulk verification)."""
+        def query(conn):
+            rows = conn.execute(
+                "SELECT id, vendor_name, gstin FROM vendors WHERE gstin IS NOT NULL AND gstin != ''"
+            ).fetchall()
+            return [dict(row) for row in rows]
+        return await self._read(query)
+
+    async def get_many(self, vendor_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        """id → vendor row for the ids that exist."""
+        def query(conn, vendor_ids):
+            if not vendor_ids:
+                return {}
+            placeholders = ",".join("?" * len(vendor_ids))
+            rows = conn.execute(f"SELECT * FROM vendors WHERE id IN ({placeholders})", vendor_ids).fetchall()
+            return {row['id']: dict(row) for row in rows}
+        return await self._read(query, list(vendor_ids))
+
+    async def get(self, vendor_id: int) -> Optional[Dict[str, Any]]:
+        """Vendor with document_count and its 5 latest documents."""
+        def query(conn, vendor_id):
+            vendor = conn.execute("SELECT * FROM vendors WHERE id = ?", (vendor_id,)).fetchone()
+            if not vendor:
+                return None
+            result = dict(vendor)
+            result['document_count'] = conn.execute(
+                "SELECT COUNT(*) as count FROM documents WHERE vendor_id = ?", (vendor_id,)
+            ).fetchone()['count']
+            recent_docs = conn.execute('''
+                SELECT invoice_no, invoice_date, grand_total
+                FROM documents
+                WHERE vendor_id = ?
+                ORDER BY invoice_date DESC
+                LIMIT 5
+            ''', (vendor_id,)).fetchall()
+            result['recent_documents'] = [dict(doc) for doc in recent_docs]
+            return result
+        return await self._read(query, vendor_id)
+
+    async def find_similar_name(self, vendor_name: str) -> Optional[Dict[str, Any]]:
+        """An existing vendor with the same name (case-insensitive) or containing it."""
+        def query(conn, vendor_name):
+            row = conn.execute('''
+                SELECT * FROM vendors
+                WHERE LOWER(vendor_name) = LOWER(?)
+                OR LOWER(vendor_name) LIKE LOWER(?)
+            ''', (vendor_name, f"%{vendor_name}%")).fetchone()
+            return dict(row) if row else None
+        return await self._read(query, vendor_name)
+
+    async def create(self, vendor: Dict[str, Any]) -> int:
+        """Insert a vendor. Raises sqlite3.IntegrityError on a duplicate name."""
+        def insert(conn, vendor):
+            cursor = conn.execute('''
+                INSERT INTO vendors (vendor_name, gstin, pan, phone, email, address,
+                                    vendor_type, default_hsn, default_ledger, default_group)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                vendor.get('vendor_name'), vendor.get('gstin'), vendor.get('pan'), vendor.get('phone'),
+                vendor.get('email'), vendor.get('address'), vendor.get('vendor_type'), vendor.get('default_hsn'),
+                vendor.get('default_ledger'), vendor.get('default_group')
+            ))
+            return cursor.lastrowid
+        return await self._write(insert, vendor)
+
+    async def update(self, vendor_id: int, updates: Dict[str, Any]) -> int:
+        def update(conn, vendor_id, updates):
+            set_clause = ", ".join([f"{key} = ?" for key in updates.keys()])
+            return conn.execute(
+                f"UPDATE vendors SET {set_clause} WHERE id = ?", list(updates.values()) + [vendor_id]
+            ).rowcount
+        return await self._write(update, vendor_id, updates)
+
+
+# =============================================================================
+# DOCUMENTS (review workflow + triage)
+# =============================================================================
+
+class DocumentRepository(Repository):
+
+    async def pending_review(self, client_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        def query(conn, client_id):
+            sql = '''
+                SELECT d.*, c.company_name as client_name, v.vendor_name as vendor_full_name
+                FROM documents d
+                LEFT JOIN clients c ON d.client_id = c.id
+                LEFT JOIN vendors v ON d.vendor_id = v.id
+                WHERE d.review_status IN ('pending', 'needs_review')
+            '''
+            params: List[Any] = []
+            if client_id:
+                sql += " AND d.client_id = ?"
+                params.append(client_id)
+            sql += " ORDER BY d.confidence_level ASC, d.entered_date DESC"
+            return [_merge_json(row) for row in conn.execute(sql, params).fetchall()]
+        return await self._read(query, client_id)
+
+    async def review(self, doc_id: int, new_status: str, reviewed_by: Optional[str], note: str) -> int:
+        def update(conn, doc_id, new_status, reviewed_by, note):
+            return conn.execute('''
+                UPDATE documents
+                SET review_status = ?,
+                    reviewed_by = ?,
+                    reviewed_date = CURRENT_TIMESTAMP,
+                    internal_notes = COALESCE(internal_notes || ' | ', '') || ?
+                WHERE id = ?
+            ''', (new_status, reviewed_by, note, doc_id)).rowcount
+        return await self._write(update, doc_id, new_status, reviewed_by, note)
+
+    async def add_note(self, doc_id: int, note: str) -> int:
+        def update(conn, doc_id, note):
+            return conn.execute('''
+                UPDATE documents
+                SET internal_notes = COALESCE(internal_notes || '\n', '') || ?
+                WHERE id = ?
+            ''', (note, doc_id)).rowcount
+        return await self._write(update, doc_id, note)
+
+    async def stats(self, client_id: Optional[int] = None) -> Dict[str, Any]:
+        """Counts by review status and by doc_type (optionally for one client)."""
+        def query(conn, client_id):
+            where = " AND client_id = ?" if client_id else ""
+            params = [client_id] if client_id else []
+            counts = conn.execute(f'''
+                SELECT COUNT(*) as total,
+                       SUM(review_status = 'pending') as pending,
+                       SUM(review_status = 'needs_review') as needs_review,
+                       SUM(review_status = 'approved') as approved
+                FROM documents WHERE 1=1{where}
+            ''', params).fetchone()
+            doc_types = conn.execute(f'''
+                SELECT doc_type, COUNT(*) as count
+                FROM documents
+                WHERE 1=1{where}
+                GROUP BY doc_type
+            ''', params).fetchall()
+            total, pending = counts['total'] or 0, counts['pending'] or 0
+            needs_review, approved = counts['needs_review'] or 0, counts['approved'] or 0
+            return {
+                "total": total,
+                "pending": pending,
+                "needs_review": needs_review,
+                "approved": approved,
+                "rejected": total - pending - needs_review - approved,
+                "by_type": {row['doc_type']: row['count'] for row in doc_types}
+            }
+        return await self._read(query, client_id)
+
+    async def unassigned(self) -> List[Dict[str, Any]]:
+        """Documents with no client yet (the triage inbox), newest first."""
+        def query(conn):
+            docs = conn.execute('''
+                SELECT d.*, 'document' as source_table
+                FROM documents d
+                WHERE d.client_id IS NULL
+                ORDER BY d.entered_date DESC
+            ''').fetchall()
+            return [_merge_json(row) for row in docs]
+        return await self._read(query)
+
+    async def assign(self, doc_ids: List[int], client_id: int) -> int:
+        """Move documents to client_id and touch the client's last_activity_date. Returns rows moved."""
+        def update(conn, doc_ids, client_id):
+            assigned = conn.executemany(
+                "UPDATE documents SET client_id = ? WHERE id = ?", [(client_id, doc_id) for doc_id in doc_ids]
+            ).rowcount
+            if assigned:
+                conn.execute("UPDATE clients SET last_activity_date = CURRENT_TIMESTAMP WHERE id = ?", (client_id,))
+            return assigned
+        return await self._write(update, doc_ids, client_id)
+
+    async def triage_stats(self, user_id: int) -> Dict[str, int]:
+        """Unassigned documents for the user, split by upload age."""
+        def query(conn, user_id):
+            ages = conn.execute('''
+                SELECT COUNT(*) as total,
+                       SUM(DATE(upload_date) = DATE('now')) as today,
+                       SUM(DATE(upload_date) >= DATE('now', '-7 days')) as week,
+                       SUM(DATE(upload_date) < DATE('now', '-7 days')) as old
+                FROM documents
+                WHERE client_id IS NULL AND user_id = ?
+            ''', (user_id,)).fetchone()
+            return {
+                "total": ages['total'] or 0,
+                "today": ages['today'] or 0,
+                "week": ages['week'] or 0,
+                "old": ages['old'] or 0,
+            }
+        return await self._read(query, user_id)
+
+
+# Global instances (routes in main.py await these)
+invoice_repo = InvoiceRepository()
+client_repo = ClientRepository()
+vendor_repo = VendorRepository()
+document_repo = DocumentRepository()
@@ -0,0 +1,176 @@
+# response_cache.py
+# -----------------------------------------------------------------------------
+# LOGIC-MODEL RESPONSE CACHE - Same vendor, same question, same answer
+# HSN / ledger / group classification depends on who the vendor is and what
+# they sell, not on the invoice number or amount. Keys are built from those
+# normalized inputs ("M/s. ABC Traders Pvt. Ltd." == "abc traders"), so repeat
+# vendors skip the 405B model. Shared by /upload and the async pipeline.
+# A ledger/group correction for a vendor drops that vendor's entries.
+# -----------------------------------------------------------------------------
+
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+from typing import Dict, Any, Optional
+
+from db_pool import get_pool
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# Answers older than this are asked again (ledger conventions drift slowly)
+TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+
+# Size bound - least recently used entries are evicted past this many rows
+MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "20000"))
+
+# Set RESPONSE_CACHE_ENABLED=0 to always call the model
+ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") != "0"
+
+# Words that don't change who the vendor is
+_VENDOR_NOISE = {
+    "m", "s", "ms", "the", "pvt", "private", "ltd", "limited", "llp", "co", "company",
+    "corp", "corporation", "inc", "and",
+}
+
+
+def normalize_text(value: Any) -> str:
+    """Lowercase, punctuation → space, collapsed whitespace."""
+    text = re.sub(r"[^a-z0-9]+", " ", str(value or "").lower())
+    return " ".join(text.split())
+
+
+def vendor_key(vendor_name: Any) -> str:
+    """Canonical vendor identity used for keys and invalidation."""
+    words = [w for w in normalize_text(vendor_name).split() if w not in _VENDOR_NOISE]
+    return " ".join(words)
+
+
+def hsn_key(hsn_code: Any) -> str:
+    """Digits only; 'Not found' / None → ''."""
+    return re.sub(r"\D", "", str(hsn_code or ""))
+
+
+def response_key(kind: str, model: str, **inputs: Any) -> str:
+    """Stable key for one question: kind + model + already-normalized inputs."""
+    payload = json.dumps({"kind": kind, "model": model, "inputs": inputs}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """SQLite table of parsed model answers with TTL, LRU bound and per-vendor invalidation."""
+
+    def __init__(self, db_path: str = "tax_data.db", max_entries: int = MAX_ENTRIES, ttl: int = TTL_SECONDS):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._initialized = False
+        # Per-process counters for stats
+        self.hits = 0
+        self.misses = 0
+
+    def _init(self):
+        """Create the ai_response_cache table on first use."""
+        if self._initialized:
+            return
+        with get_pool(self.db_path).write() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS ai_response_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    vendor_key TEXT,
+                    result TEXT NOT NULL,
+                    created_at REAL,
+                    expires_at REAL,
+                    last_used_at REAL,
+                    hit_count INTEGER DEFAULT 0
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_ai_response_cache_vendor ON ai_response_cache(vendor_key)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_ai_response_cache_lru ON ai_response_cache(last_used_at)')
+        self._initialized = True
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Cached answer (a fresh dict) or None if missing/expired."""
+        if not ENABLED:
+            return None
+        now = time.time()
+        self._init()
+        pool = get_pool(self.db_path)
+        try:
+            with pool.read() as conn:
+                row = conn.execute(
+                    "SELECT result FROM ai_response_cache WHERE cache_key = ? AND expires_at > ?",
+                    (key, now)
+                ).fetchone()
+            if not row:
+                self.misses += 1
+                return None
+            # Only a hit takes the writer (to refresh the LRU position)
+            with pool.write() as conn:
+                conn.execute('''
+                    UPDATE ai_response_cache SET last_used_at = ?, hit_count = hit_count + 1
+                    WHERE cache_key = ?
+                ''', (now, key))
+            self.hits += 1
+            return json.loads(row[0])
+        except (sqlite3.Error, ValueError) as e:
+            print(f"⚠️ Response cache read failed: {e}")
+            return None
+
+    def put(self, key: str, kind: str, vendor_name: Any, result: Dict[str, Any]):
+        """Store a parsed answer; expired rows and rows past max_entries (LRU) are dropped."""
+        if not ENABLED or not result:
+            return
+        now = time.time()
+        self._init()
+        try:
+            with get_pool(self.db_path).write() as conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO ai_response_cache
+                        (cache_key, kind, vendor_key, result, created_at, expires_at, last_used_at, hit_count)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+                ''', (key, kind, vendor_key(vendor_name), json.dumps(result), now, now + self.ttl, now))
+                conn.execute("DELETE FROM ai_response_cache WHERE expires_at <= ?", (now,))
+                conn.execute('''
+                    DELETE FROM ai_response_cache WHERE rowid IN (
+                        SELECT rowid FROM ai_response_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                    )
+                ''', (self.max_entries,))
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            print(f"⚠️ Response cache write failed: {e}")
+
+    def invalidate_vendor(self, vendor_name: Any) -> int:
+        """Forget every cached answer for this vendor (after a user correction)."""
+        key = vendor_key(vendor_name)
+        if not key:
+            return 0
+        self._init()
+        with get_pool(self.db_path).write() as conn:
+            cursor = conn.execute("DELETE FROM ai_response_cache WHERE vendor_key = ?", (key,))
+            return cursor.rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        entries = 0
+        if ENABLED:
+            self._init()
+            with get_pool(self.db_path).read() as conn:
+                entries = conn.execute("SELECT COUNT(*) FROM ai_response_cache").fetchone()[0]
+        return {
+            "enabled": ENABLED,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+# Global instance (shared by /upload and the async pipeline)
+response_cache = ResponseCache()
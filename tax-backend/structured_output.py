@@ -0,0 +1,235 @@
+# structured_output.py
+# -----------------------------------------------------------------------------
+# STRUCTURED INVOICE EXTRACTION - Schema in, validated fields out
+# The vision call asks for JSON against the invoice schema (response_format),
+# the reply is read by a tolerant parser (first balanced object, trailing
+# commas, truncated output repaired by dropping the cut-off member), and each
+# field is validated on its own. Only fields that are still missing or
+# invalid get a short follow-up prompt - never a full re-OCR.
+# -----------------------------------------------------------------------------
+
+import os
+import re
+import json
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel, ConfigDict, ValidationError, field_validator
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# "json_schema" (constrained decoding where the model supports it), "json_object" or "off"
+RESPONSE_FORMAT_MODE = os.getenv("AI_STRUCTURED_OUTPUT", "json_schema")
+
+# Fields worth a follow-up call when missing (an invoice without these is useless)
+CRITICAL_FIELDS = ("vendor_name", "invoice_no", "grand_total")
+
+# One follow-up round, small output
+FOLLOW_UP_ENABLED = os.getenv("AI_FOLLOW_UP_ENABLED", "1") != "0"
+FOLLOW_UP_MAX_TOKENS = int(os.getenv("AI_FOLLOW_UP_MAX_TOKENS", "300"))
+
+_NULL_WORDS = {"", "null", "none", "n/a", "na", "not found", "not visible", "-", "nil"}
+_AMOUNT_NOISE = re.compile(r"(?i)₹|rs\.?|inr|%|,|\s")
+
+
+class InvoiceFields(BaseModel):
+    """What the OCR prompt asks for. Unknown keys are kept as-is."""
+
+    model_config = ConfigDict(extra="allow")
+
+    gst_no: Optional[str] = None
+    invoice_no: Optional[str] = None
+    invoice_date: Optional[str] = None
+    vendor_name: Optional[str] = None
+    buyer_name: Optional[str] = None
+    buyer_gstin: Optional[str] = None
+    vendor_state: Optional[str] = None
+    place_of_supply: Optional[str] = None
+    hsn_code: Optional[str] = None
+    tax_rate: Optional[float] = None
+    taxable_value: Optional[float] = None
+    cgst_amount: Optional[float] = None
+    sgst_amount: Optional[float] = None
+    igst_amount: Optional[float] = None
+    cess_amount: Optional[float] = None
+    grand_total: Optional[float] = None
+    ledger_name: Optional[str] = None
+    group_name: Optional[str] = None
+
+    @field_validator("tax_rate", "taxable_value", "cgst_amount", "sgst_amount", "igst_amount",
+                     "cess_amount", "grand_total", mode="before")
+    @classmethod
+    def _amount(cls, value: Any) -> Any:
+        """'₹ 1,180.00' / '18%' / 'Rs. 500' → float; null-ish → None."""
+        if isinstance(value, str):
+            if value.strip().lower() in _NULL_WORDS:
+                return None
+            return _AMOUNT_NOISE.sub("", value)
+        return value
+
+    @field_validator("gst_no", "invoice_no", "invoice_date", "vendor_name", "buyer_name", "buyer_gstin",
+                     "vendor_state", "place_of_supply", "hsn_code", "ledger_name", "group_name", mode="before")
+    @classmethod
+    def _text(cls, value: Any) -> Any:
+        """Numbers → str (HSN 8471), whitespace trimmed, null-ish → None."""
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = str(int(value)) if float(value).is_integer() else str(value)
+        if isinstance(value, str):
+            value = value.strip()
+            return None if value.lower() in _NULL_WORDS else value
+        return value
+
+
+def response_format(fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+    """OpenAI/OpenRouter response_format for the invoice schema (or just `fields` of it)."""
+    if RESPONSE_FORMAT_MODE == "off":
+        return None
+    if RESPONSE_FORMAT_MODE == "json_object":
+        return {"type": "json_object"}
+    schema = InvoiceFields.model_json_schema()
+    if fields:
+        schema = {
+            "type": "object",
+            "properties": {f: schema["properties"][f] for f in fields if f in schema["properties"]},
+        }
+    return {"type": "json_schema", "json_schema": {"name": "invoice", "strict": False, "schema": schema}}
+
+
+# =============================================================================
+# TOLERANT PARSER
+# =============================================================================
+
+def _loads(candidate: str) -> Dict[str, Any]:
+    try:
+        value = json.loads(candidate)
+    except json.JSONDecodeError:
+        # Trailing commas ({"a": 1,}) are the usual offender
+        value = json.loads(re.sub(r",(\s*[}\]])", r"\1", candidate))
+    if not isinstance(value, dict):
+        raise json.JSONDecodeError("Not a JSON object", candidate, 0)
+    return value
+
+
+def parse_json_tolerant(text: str) -> Dict[str, Any]:
+    """
+    The first JSON object in a model reply. Unlike the old greedy regex it
+    stops at the object's own closing brace, so prose or stray braces around
+    it don't matter. A truncated reply is closed after its last complete
+    member (the cut-off one is dropped, never half-read).
+    Raises json.JSONDecodeError if nothing usable is there.
+    """
+    text = (text or "").replace("```json", "").replace("```", "")
+    start = text.find("{")
+    while start >= 0:
+        stack: List[str] = []
+        in_string = escaped = False
+        cuts: List[Tuple[int, str]] = []   # (comma index, closers needed there)
+        for i in range(start, len(text)):
+            ch = text[i]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+                continue
+            if ch == '"':
+                in_string = True
+            elif ch in "{[":
+                stack.append("}" if ch == "{" else "]")
+            elif ch in "}]":
+                if stack:
+                    stack.pop()
+                if not stack:
+                    try:
+                        return _loads(text[start:i + 1])
+                    except json.JSONDecodeError:
+                        break   # not JSON after all ({the} in prose) - try the next "{"
+            elif ch == ",":
+                cuts.append((i, "".join(reversed(stack))))
+        else:
+            # Ran out of text inside the object: truncated output
+            for index, closers in reversed(cuts):
+                try:
+                    return _loads(text[start:index] + closers)
+                except json.JSONDecodeError:
+                    continue
+            break
+        start = text.find("{", start + 1)
+    raise json.JSONDecodeError("No usable JSON object in model reply", text, 0)
+
+
+# =============================================================================
+# VALIDATION + TARGETED FOLLOW-UP
+# =============================================================================
+
+def validate_invoice(raw: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    (cleaned fields, fields needing another look). Invalid fields are dropped
+    one by one so a bad tax_rate doesn't cost the rest of the invoice.
+    """
+    values = dict(raw)
+    invalid: List[str] = []
+    while True:
+        try:
+            model = InvoiceFields.model_validate(values)
+            break
+        except ValidationError as e:
+            bad = {err["loc"][0] for err in e.errors() if err.get("loc")}
+            if not bad:
+                raise
+            for field in bad:
+                values.pop(field, None)
+            invalid.extend(sorted(bad))
+    # Fields the model never sent, and null-like values the validators turned
+    # into None, stay absent - callers default them with .get(key, '')
+    data = model.model_dump(exclude_unset=True, exclude_none=True)
+    return data, sorted(set(invalid) | set(missing_critical(data)))
+
+
+def missing_critical(data: Dict[str, Any]) -> List[str]:
+    """CRITICAL_FIELDS an extraction still lacks (an incomplete result must not be cached)."""
+    return [f for f in CRITICAL_FIELDS if data.get(f) in (None, "", 0)]
+
+
+def follow_up_prompt(fields: List[str], partial: Dict[str, Any]) -> str:
+    known = {k: partial[k] for k in ("vendor_name", "invoice_no", "invoice_date", "grand_total")
+             if partial.get(k) not in (None, "")}
+    return (
+        "Look at this invoice again. Only these fields are needed - they were missing or unreadable "
+        f"in the first pass: {', '.join(fields)}.\n"
+        f"Already read (for orientation, do not repeat): {json.dumps(known, ensure_ascii=False)}\n"
+        "Amounts are plain numbers (no currency symbols or commas), tax_rate is a number like 18.\n"
+        f"Return ONLY a JSON object with exactly these keys: {', '.join(fields)}. Use null if a value is truly absent."
+    )
+
+
+# ask(prompt, max_tokens, response_format) -> raw model reply
+Ask = Callable[[str, Optional[int], Optional[Dict[str, Any]]], Awaitable[str]]
+
+
+async def extract_invoice_fields(ask: Ask, prompt: str) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    One structured extraction: schema-constrained call, tolerant parse, per-field
+    validation, then at most one follow-up limited to the fields that failed.
+    Returns (fields, fields still missing or invalid after the follow-up).
+    Raises json.JSONDecodeError only if the first reply has no usable JSON at all.
+    """
+    data, failing = validate_invoice(parse_json_tolerant(await ask(prompt, None, response_format())))
+    if not failing or not FOLLOW_UP_ENABLED:
+        return data, failing
+
+    print(f"🎯 Follow-up for {', '.join(failing)} only")
+    try:
+        reply = await ask(follow_up_prompt(failing, data), FOLLOW_UP_MAX_TOKENS, response_format(failing))
+        fixes, _ = validate_invoice(parse_json_tolerant(reply))
+    except Exception as e:
+        # The first pass is still worth keeping - triage will flag what's missing
+        print(f"⚠️ Follow-up failed ({e}) - keeping first pass")
+        return data, failing
+    for field in failing:
+        if fixes.get(field) not in (None, ""):
+            data[field] = fixes[field]
+    return data, [f for f in failing if data.get(f) in (None, "", 0)]
@@ -0,0 +1,262 @@
+# task_store.py
+# -----------------------------------------------------------------------------
+# DURABLE PIPELINE TASK STORE - SQLite-backed, restart-safe
+# Every pipeline task is a row: QUEUED → OCR → LOGIC → SAVING → COMPLETED/FAILED
+# Leases + heartbeats let a restarted (or sibling) worker re-queue stalled tasks
+# Reads and writes go through db_pool, so task writes queue behind the same
+# single writer as the routes instead of racing them for SQLite's lock
+# -----------------------------------------------------------------------------
+
+import json
+import time
+import sqlite3
+from typing import Dict, Any, List, Optional, Tuple
+
+from db_pool import get_pool
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# A worker owns a task for this long after its last heartbeat
+LEASE_SECONDS = 120
+
+# How often the pipeline renews its leases
+HEARTBEAT_SECONDS = 30
+
+# Tasks recovered this many times are given up on (poison documents)
+MAX_ATTEMPTS = 3
+
+# Completed/failed rows are kept this long for /upload/status lookups
+RETENTION_SECONDS = 7 * 24 * 3600
+
+TERMINAL_STATES = ("completed", "failed")
+
+# JSON columns round-tripped as dicts
+_JSON_FIELDS = ("ocr_result", "logic_result", "final_result")
+
+
+class TaskStore:
+    """
+    Persistent table of pipeline tasks.
+    File bytes are never stored here - only the path of the saved upload.
+    """
+
+    def __init__(self, db_path: str = "tax_data.db"):
+        self.db_path = db_path
+        self._initialized = False
+
+    def init(self):
+        """Create the pipeline_tasks table if it doesn't exist."""
+        if self._initialized:
+            return
+        with get_pool(self.db_path).write() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS pipeline_tasks (
+                    task_id TEXT PRIMARY KEY,
+                    filename TEXT,
+                    file_path TEXT,
+                    mime_type TEXT,
+                    client_id INTEGER,
+                    doc_type TEXT DEFAULT 'gst_invoice',
+                    entered_by TEXT,
+                    user_id INTEGER,
+                    batch_id TEXT,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    ocr_result TEXT,
+                    logic_result TEXT,
+                    final_result TEXT,
+                    error TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    lease_owner TEXT,
+                    lease_expires REAL,
+                    created_at REAL,
+                    updated_at REAL,
+                    completed_at REAL
+                )
+            ''')
+            # Columns added after the table first shipped
+            existing = {row['name'] for row in conn.execute("PRAGMA table_info(pipeline_tasks)")}
+            if 'user_id' not in existing:
+                conn.execute("ALTER TABLE pipeline_tasks ADD COLUMN user_id INTEGER")
+            if 'batch_id' not in existing:
+                conn.execute("ALTER TABLE pipeline_tasks ADD COLUMN batch_id TEXT")
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_pipeline_tasks_status ON pipeline_tasks(status, lease_expires)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_pipeline_tasks_owner ON pipeline_tasks(lease_owner)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_pipeline_tasks_batch ON pipeline_tasks(batch_id)')
+        self._initialized = True
+
+    # =========================================================================
+    # WRITES
+    # =========================================================================
+
+    def insert(self, task: Dict[str, Any], owner: str):
+        """Record a newly submitted task, leased to the submitting worker."""
+        now = time.time()
+        with get_pool(self.db_path).write() as conn:
+            conn.execute('''
+                INSERT INTO pipeline_tasks (
+                    task_id, filename, file_path, mime_type, client_id, doc_type, entered_by,
+                    user_id, batch_id, status, lease_owner, lease_expires, created_at, updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                task['task_id'], task['filename'], task.get('file_path'), task['mime_type'],
+                task.get('client_id'), task.get('doc_type', 'gst_invoice'), task.get('entered_by'),
+                task.get('user_id'), task.get('batch_id'), task.get('status', 'queued'), owner, now + LEASE_SECONDS,
+                task.get('created_at', now), now
+            ))
+
+    def update(self, task_id: str, status: str, **fields):
+        """
+        Move a task to a new state, saving any stage output passed in fields
+        (ocr_result, logic_result, final_result, error).
+        """
+        self.update_many([(task_id, status, fields)])
+
+    def update_many(self, updates: List[tuple], conn: Optional[sqlite3.Connection] = None):
+        """
+        Apply several (task_id, status, fields) updates in one transaction.
+        Pass `conn` to join a transaction the caller already holds (no commit is issued then).
+        """
+        if conn is None:
+            with get_pool(self.db_path).write() as conn:
+                self.update_many(updates, conn=conn)
+            return
+        now = time.time()
+        for task_id, status, fields in updates:
+            columns = {"status": status, "updated_at": now}
+            for key, value in fields.items():
+                columns[key] = json.dumps(value) if key in _JSON_FIELDS and value is not None else value
+            if status in TERMINAL_STATES:
+                columns["completed_at"] = now
+                columns["lease_owner"] = None
+                columns["lease_expires"] = None
+            assignments = ", ".join(f"{col} = ?" for col in columns)
+            conn.execute(f"UPDATE pipeline_tasks SET {assignments} WHERE task_id = ?",
+                         (*columns.values(), task_id))
+
+    def heartbeat(self, owner: str) -> int:
+        """Extend the lease on every live task owned by this worker."""
+        with get_pool(self.db_path).write() as conn:
+            cursor = conn.execute('''
+                UPDATE pipeline_tasks SET lease_expires = ?
+                WHERE lease_owner = ? AND status NOT IN ('completed', 'failed')
+            ''', (time.time() + LEASE_SECONDS, owner))
+            return cursor.rowcount
+
+    def claim_stalled(self, owner: str,
+                      ocr_slots: Optional[int] = None) -> Tuple[List[Dict[str, Any]], List[str]]:
+        """
+        Take over unfinished tasks whose lease has expired (their worker died or restarted).
+        Tasks that have already been recovered MAX_ATTEMPTS times are marked failed.
+        At most `ocr_slots` tasks that still need OCR are claimed (the OCR queue is
+        bounded) - the rest keep their expired lease for the next heartbeat.
+        Returns (claimed rows, file paths of the tasks given up on) - the caller
+        re-queues the rows and drops the upload references of the given-up tasks.
+        """
+        now = time.time()
+        with get_pool(self.db_path).write() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            given_up = [row['file_path'] for row in conn.execute('''
+                SELECT file_path FROM pipeline_tasks
+                WHERE status NOT IN ('completed', 'failed')
+                  AND (lease_expires IS NULL OR lease_expires < ?)
+                  AND attempts >= ? AND file_path IS NOT NULL
+            ''', (now, MAX_ATTEMPTS))]
+            conn.execute('''
+                UPDATE pipeline_tasks
+                SET status = 'failed', error = 'Gave up after repeated restarts',
+                    completed_at = ?, updated_at = ?, lease_owner = NULL, lease_expires = NULL
+                WHERE status NOT IN ('completed', 'failed')
+                  AND (lease_expires IS NULL OR lease_expires < ?)
+                  AND attempts >= ?
+            ''', (now, now, now, MAX_ATTEMPTS))
+            rows = conn.execute('''
+                SELECT * FROM pipeline_tasks
+                WHERE status NOT IN ('completed', 'failed')
+                  AND (lease_expires IS NULL OR lease_expires < ?)
+                ORDER BY created_at
+            ''', (now,)).fetchall()
+            if ocr_slots is not None:
+                claimed = []
+                for row in rows:
+                    if row['status'] == 'saving' or row['logic_result'] or row['ocr_result']:
+                        claimed.append(row)
+                    elif ocr_slots > 0:
+                        claimed.append(row)
+                        ocr_slots -= 1
+                rows = claimed
+            # Checkpointed tasks (lease released on a clean shutdown) don't count as an attempt
+            conn.executemany('''
+                UPDATE pipeline_tasks
+                SET lease_owner = ?, lease_expires = ?, updated_at = ?,
+                    attempts = attempts + CASE WHEN lease_owner IS NULL THEN 0 ELSE 1 END
+                WHERE task_id = ?
+            ''', [(owner, now + LEASE_SECONDS, now, row['task_id']) for row in rows])
+            return [self._row_to_dict(row) for row in rows], given_up
+
+    def release(self, task_ids: List[str]):
+        """Hand claimed tasks back unstarted (lease expired, no attempt counted) for the next claim."""
+        with get_pool(self.db_path).write() as conn:
+            conn.executemany('''
+                UPDATE pipeline_tasks SET lease_owner = NULL, lease_expires = 0, updated_at = ?
+                WHERE task_id = ? AND status NOT IN ('completed', 'failed')
+            ''', [(time.time(), task_id) for task_id in task_ids])
+
+    def release_leases(self, owner: str) -> int:
+        """
+        Checkpoint on clean shutdown: give up this worker's unfinished tasks so
+        they can be claimed straight away, keeping whatever stage output they have.
+        """
+        with get_pool(self.db_path).write() as conn:
+            cursor = conn.execute('''
+                UPDATE pipeline_tasks SET lease_owner = NULL, lease_expires = 0, updated_at = ?
+                WHERE lease_owner = ? AND status NOT IN ('completed', 'failed')
+            ''', (time.time(), owner))
+            return cursor.rowcount
+
+    def purge_finished(self, older_than: float = RETENTION_SECONDS) -> int:
+        """Delete terminal rows past the retention window."""
+        with get_pool(self.db_path).write() as conn:
+            cursor = conn.execute('''
+                DELETE FROM pipeline_tasks
+                WHERE status IN ('completed', 'failed') AND completed_at < ?
+            ''', (time.time() - older_than,))
+            return cursor.rowcount
+
+    # =========================================================================
+    # READS
+    # =========================================================================
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        self.init()
+        with get_pool(self.db_path).read() as conn:
+            row = conn.execute("SELECT * FROM pipeline_tasks WHERE task_id = ?", (task_id,)).fetchone()
+            return self._row_to_dict(row) if row else None
+
+    def list_batch(self, batch_id: str) -> List[Dict[str, Any]]:
+        """All tasks of one bulk upload, oldest first."""
+        self.init()
+        with get_pool(self.db_path).read() as conn:
+            rows = conn.execute('''
+                SELECT task_id, filename, status, error, final_result FROM pipeline_tasks
+                WHERE batch_id = ? ORDER BY created_at
+            ''', (batch_id,)).fetchall()
+            return [self._row_to_dict(row) for row in rows]
+
+    def count_by_status(self) -> Dict[str, int]:
+        self.init()
+        with get_pool(self.db_path).read() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM pipeline_tasks GROUP BY status").fetchall()
+            return {row['status']: row['n'] for row in rows}
+
+    @staticmethod
+    def _row_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        data = dict(row)
+        for key in _JSON_FIELDS:
+            if data.get(key):
+                try:
+                    data[key] = json.loads(data[key])
+                except (TypeError, ValueError):
+                    data[key] = None
+        return data
@@ -0,0 +1,153 @@
+# upload_store.py
+# -----------------------------------------------------------------------------
+# CONTENT-ADDRESSED UPLOAD STORAGE
+# Uploads are streamed to disk in chunks while being hashed and stored once
+# per unique content as uploads/<sha256><ext>. A refcount table tracks how
+# many records point at each file, so deleting one bill never removes a file
+# another bill still uses.
+# -----------------------------------------------------------------------------
+
+import os
+import re
+import time
+import uuid
+import hashlib
+from dataclasses import dataclass
+from typing import BinaryIO, Optional
+
+from db_pool import get_pool
+from offload import run_blocking
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+UPLOAD_DIR = "uploads"
+
+# Read/hash/write granularity - memory per upload stays at one chunk
+CHUNK_SIZE = 1024 * 1024
+
+_HASHED_NAME = re.compile(r"^[0-9a-f]{64}(\.[a-z0-9]{1,8})?$")
+
+
+@dataclass
+class StoredUpload:
+    path: str           # uploads/<sha256><ext> - what goes in file_path columns
+    content_hash: str
+    size: int
+
+    @property
+    def url(self) -> str:
+        return f"/files/{os.path.basename(self.path)}"
+
+
+def _extension(filename: Optional[str]) -> str:
+    ext = os.path.splitext(filename or "")[1].lower()
+    return ext if re.fullmatch(r"\.[a-z0-9]{1,8}", ext) else ""
+
+
+class UploadStore:
+    """Writes uploads under their content hash and refcounts them in SQLite."""
+
+    def __init__(self, db_path: str = "tax_data.db", upload_dir: str = UPLOAD_DIR):
+        self.db_path = db_path
+        self.upload_dir = upload_dir
+        self._initialized = False
+
+    def _init(self):
+        """Create the upload_blobs table on first use."""
+        if self._initialized:
+            return
+        with get_pool(self.db_path).write() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS upload_blobs (
+                    content_hash TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    size INTEGER,
+                    ref_count INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_upload_blobs_path ON upload_blobs(path)')
+        self._initialized = True
+
+    def store_stream(self, source: BinaryIO, filename: Optional[str] = None) -> StoredUpload:
+        """
+        Blocking - run in the I/O pool.
+        Copy `source` to a temp file chunk by chunk while hashing, then move it to
+        its content-addressed name (or drop it if that content is already stored)
+        and take one reference.
+        """
+        os.makedirs(self.upload_dir, exist_ok=True)
+        tmp_path = os.path.join(self.upload_dir, f".incoming_{uuid.uuid4().hex}")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, "wb") as out:
+                while True:
+                    chunk = source.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+            content_hash = digest.hexdigest()
+            final_path = os.path.join(self.upload_dir, content_hash + _extension(filename))
+
+            self._init()
+            # Write lock held across rename + refcount so a concurrent release can't unlink in between
+            with get_pool(self.db_path).write() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute("SELECT path FROM upload_blobs WHERE content_hash = ?", (content_hash,)).fetchone()
+                if row and os.path.exists(row[0]):
+                    final_path = row[0]
+                    os.remove(tmp_path)
+                else:
+                    os.replace(tmp_path, final_path)
+                conn.execute('''
+                    INSERT INTO upload_blobs (content_hash, path, size, ref_count, created_at)
+                    VALUES (?, ?, ?, 1, ?)
+                    ON CONFLICT(content_hash) DO UPDATE SET ref_count = ref_count + 1, path = excluded.path
+                ''', (content_hash, final_path, size, time.time()))
+            return StoredUpload(path=final_path, content_hash=content_hash, size=size)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def release(self, path: Optional[str]) -> bool:
+        """
+        Blocking - drop one reference to a stored upload; unlink it with the last one.
+        Files from before content addressing (uuid_name) have no refcount row and are
+        removed directly, as before. Returns True if the file was deleted.
+        """
+        if not path:
+            return False
+        self._init()
+        with get_pool(self.db_path).write() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT content_hash, ref_count FROM upload_blobs WHERE path = ?", (path,)).fetchone()
+            if row is None:
+                conn.commit()
+                if not _HASHED_NAME.match(os.path.basename(path)) and os.path.exists(path):
+                    os.remove(path)
+                    return True
+                return False
+            if row[1] > 1:
+                conn.execute("UPDATE upload_blobs SET ref_count = ref_count - 1 WHERE content_hash = ?", (row[0],))
+                conn.commit()
+                return False
+            conn.execute("DELETE FROM upload_blobs WHERE content_hash = ?", (row[0],))
+            if os.path.exists(path):
+                os.remove(path)
+            conn.commit()
+            return True
+
+
+# Global instance
+upload_store = UploadStore()
+
+
+async def save_upload(file, filename: Optional[str] = None) -> StoredUpload:
+    """Stream a FastAPI UploadFile into the store without reading it all into memory."""
+    await file.seek(0)
+    return await run_blocking(upload_store.store_stream, file.file, filename or file.filename)
@@ -0,0 +1,290 @@
+# usage_ledger.py
+# -----------------------------------------------------------------------------
+# TOKEN + COST LEDGER - Who spent what, on which flow
+# Every model call leaves one row: prompt/completion tokens, cost, latency,
+# model, task, key index and lane, attributed to the user / client / flow of
+# the request that made it (legal notice drafting vs OCR vs Jarvis, ...).
+# Rows are buffered in memory and written in batches off the event loop, so
+# a model call never waits on SQLite. GET /usage reads it back grouped.
+# -----------------------------------------------------------------------------
+
+import os
+import json
+import time
+import asyncio
+import sqlite3
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+from db_pool import get_pool
+from offload import run_blocking
+from priority_lanes import current_lane
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# Set AI_USAGE_ENABLED=0 to stop recording
+ENABLED = os.getenv("AI_USAGE_ENABLED", "1") != "0"
+
+# A batch is written when it reaches this many rows or is this old
+BATCH_SIZE = int(os.getenv("AI_USAGE_BATCH_SIZE", "50"))
+FLUSH_INTERVAL_SECONDS = float(os.getenv("AI_USAGE_FLUSH_INTERVAL", "5"))
+
+# Rows kept in memory if SQLite is unavailable (oldest dropped past this)
+MAX_BUFFER = int(os.getenv("AI_USAGE_MAX_BUFFER", "10000"))
+
+# USD per million tokens (prompt, completion) for backends that don't report
+# cost themselves, e.g. AI_MODEL_PRICES='{"gpt-4o-mini": [0.15, 0.6]}'.
+# OpenRouter's own usage.cost always wins; unknown models cost 0 (free tier).
+MODEL_PRICES: Dict[str, List[float]] = json.loads(os.getenv("AI_MODEL_PRICES", "{}") or "{}")
+
+# /usage group_by → SQL expression
+GROUP_COLUMNS = {
+    "flow": "flow",
+    "task": "task",
+    "model": "model",
+    "user": "user_id",
+    "client": "client_id",
+    "key": "key_index",
+    "lane": "lane",
+    "day": "date(created_at, 'unixepoch')",
+}
+
+# Who the current request is spending for; set with `attribute(...)` or `set_attribution(...)`
+_attribution: ContextVar[Dict[str, Any]] = ContextVar("ai_usage_attribution", default={})
+
+
+def current_attribution() -> Dict[str, Any]:
+    return _attribution.get()
+
+
+def _merged(flow: Optional[str], user_id: Optional[int], client_id: Optional[int]) -> Dict[str, Any]:
+    merged = dict(_attribution.get())
+    for key, value in (("flow", flow), ("user_id", user_id), ("client_id", client_id)):
+        if value is not None:
+            merged[key] = value
+    return merged
+
+
+def set_attribution(flow: Optional[str] = None, user_id: Optional[int] = None, client_id: Optional[int] = None):
+    """
+    Attribute the rest of this task's model calls (top of an endpoint, or per
+    task in a pipeline worker). Replaces the whole attribution - nothing leaks
+    from the previous task a worker handled.
+    """
+    _attribution.set({"flow": flow, "user_id": user_id, "client_id": client_id})
+
+
+@contextmanager
+def attribute(flow: Optional[str] = None, user_id: Optional[int] = None,
+              client_id: Optional[int] = None) -> Iterator[None]:
+    """`with attribute(flow="classify"):` - calls inside are booked to that flow (other fields kept)."""
+    token = _attribution.set(_merged(flow, user_id, client_id))
+    try:
+        yield
+    finally:
+        _attribution.reset(token)
+
+
+def _as_int(value: Any) -> int:
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class UsageLedger:
+    """Buffered writer + reader for the ai_usage table."""
+
+    def __init__(self, db_path: str = "tax_data.db", batch_size: int = BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL_SECONDS):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._initialized = False
+        self._buffer: List[tuple] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        # Per-process counters for stats
+        self.recorded = 0
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+
+    def _init(self):
+        """Create the ai_usage table on first use."""
+        if self._initialized:
+            return
+        with get_pool(self.db_path).write() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS ai_usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created_at REAL NOT NULL,
+                    flow TEXT,
+                    task TEXT,
+                    model TEXT,
+                    key_index INTEGER,
+                    lane TEXT,
+                    user_id INTEGER,
+                    client_id INTEGER,
+                    prompt_tokens INTEGER DEFAULT 0,
+                    completion_tokens INTEGER DEFAULT 0,
+                    total_tokens INTEGER DEFAULT 0,
+                    cost REAL DEFAULT 0,
+                    latency_ms INTEGER,
+                    streamed INTEGER DEFAULT 0
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_ai_usage_created ON ai_usage(created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_ai_usage_user ON ai_usage(user_id, created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_ai_usage_client ON ai_usage(client_id, created_at)')
+        self._initialized = True
+
+    # -------------------------------------------------------------------------
+    # Write side
+    # -------------------------------------------------------------------------
+
+    def record(self, task: str, model: str, usage: Optional[Dict[str, Any]], latency: float,
+               key_index: Optional[int] = None, lane: Optional[str] = None, streamed: bool = False):
+        """
+        Book one successful call to the current attribution. Never blocks:
+        the row joins the buffer and the flusher writes it with its batch.
+        `usage` is the response's usage object (missing → zero tokens).
+        """
+        if not ENABLED:
+            return
+        usage = usage or {}
+        prompt_tokens = _as_int(usage.get("prompt_tokens"))
+        completion_tokens = _as_int(usage.get("completion_tokens"))
+        cost = usage.get("cost")
+        if cost is None:
+            price = MODEL_PRICES.get(model)
+            cost = (prompt_tokens * price[0] + completion_tokens * price[1]) / 1e6 if price else 0.0
+        who = _attribution.get()
+        self._buffer.append((
+            time.time(), who.get("flow") or "other", task, model, key_index, lane or current_lane(),
+            who.get("user_id"), who.get("client_id"), prompt_tokens, completion_tokens,
+            _as_int(usage.get("total_tokens")) or prompt_tokens + completion_tokens,
+            float(cost), int(latency * 1000), int(streamed),
+        ))
+        self.recorded += 1
+        if len(self._buffer) > MAX_BUFFER:
+            self.dropped += len(self._buffer) - MAX_BUFFER
+            del self._buffer[:len(self._buffer) - MAX_BUFFER]
+        self._ensure_flusher()
+        if len(self._buffer) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def _ensure_flusher(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return   # no loop (scripts) - flush() writes the buffer
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._wakeup = asyncio.Event()
+            self._flusher = loop.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def _write(self, rows: List[tuple]):
+        self._init()
+        with get_pool(self.db_path).write() as conn:
+            conn.executemany('''
+                INSERT INTO ai_usage
+                    (created_at, flow, task, model, key_index, lane, user_id, client_id,
+                     prompt_tokens, completion_tokens, total_tokens, cost, latency_ms, streamed)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+
+    async def flush(self):
+        """Write everything buffered so far (one transaction per batch)."""
+        while self._buffer:
+            rows, self._buffer = self._buffer[:self.batch_size], self._buffer[self.batch_size:]
+            try:
+                await run_blocking(self._write, rows)
+            except sqlite3.Error as e:
+                # Put the batch back and try again on the next tick
+                self._buffer[:0] = rows
+                print(f"⚠️ Usage ledger write failed: {e}")
+                return
+            self.written += len(rows)
+            self.batches += 1
+
+    async def close(self):
+        """Final flush and stop the flusher (app shutdown)."""
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+        self._flusher = None
+        await self.flush()
+
+    # -------------------------------------------------------------------------
+    # Read side
+    # -------------------------------------------------------------------------
+
+    def report(self, group_by: str = "flow", since: Optional[float] = None, until: Optional[float] = None,
+               user_id: Optional[int] = None, client_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Calls, tokens, cost and latency per group, biggest spender first."""
+        column = GROUP_COLUMNS.get(group_by)
+        if column is None:
+            raise ValueError(f"group_by must be one of {', '.join(GROUP_COLUMNS)}")
+        where, params = ["created_at >= ?"], [since or 0]
+        if until is not None:
+            where.append("created_at < ?")
+            params.append(until)
+        if user_id is not None:
+            where.append("user_id = ?")
+            params.append(user_id)
+        if client_id is not None:
+            where.append("client_id = ?")
+            params.append(client_id)
+        self._init()
+        with get_pool(self.db_path).read() as conn:
+            rows = conn.execute(f'''
+                SELECT {column} AS grp, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens),
+                       SUM(total_tokens), SUM(cost), AVG(latency_ms), MAX(latency_ms), SUM(latency_ms)
+                FROM ai_usage
+                WHERE {" AND ".join(where)}
+                GROUP BY grp
+                ORDER BY SUM(cost) DESC, SUM(total_tokens) DESC
+            ''', params).fetchall()
+        return [
+            {
+                group_by: row[0],
+                "calls": row[1],
+                "prompt_tokens": row[2] or 0,
+                "completion_tokens": row[3] or 0,
+                "total_tokens": row[4] or 0,
+                "cost": round(row[5] or 0.0, 6),
+                "avg_latency_ms": int(row[6] or 0),
+                "max_latency_ms": row[7] or 0,
+                "model_seconds": round((row[8] or 0) / 1000, 1),
+            }
+            for row in rows
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": ENABLED,
+            "recorded": self.recorded,
+            "written": self.written,
+            "batches": self.batches,
+            "buffered": len(self._buffer),
+            "dropped": self.dropped,
+        }
+
+
+# Global instance (every backend books into it)
+usage_ledger = UsageLedger()
@@ -10,6 +10,8 @@ from typing import Optional
 import base64
 import io
 
+from db_pool import get_pool
+
 class WhatsAppMessageRequest(BaseModel):
     phone: str
     message: str
@@ -139,25 +141,22 @@ async def get_whatsapp_account_status(phone: str):
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Get user statistics
-        conn = get_db_connection()
-        
-        # Count active clients
-        active_clients = conn.execute(
-            "SELECT COUNT(DISTINCT client_id) FROM invoices WHERE client_id IN (SELECT id FROM clients)"
-        ).fetchone()[0]
-        
-        # Count pending invoices
-        pending_invoices = conn.execute(
-            "SELECT COUNT(*) FROM documents WHERE review_status = 'pending'"
-        ).fetchone()[0]
-        
-        # Count flagged items
-        flagged_items = conn.execute(
-            "SELECT COUNT(*) FROM documents WHERE review_status = 'needs_review' OR review_status = 'needs_clarification'"
-        ).fetchone()[0]
-        
-        conn.close()
+        # Get user statistics (read-only pooled connection)
+        with get_pool().read() as conn:
+            # Count active clients
+            active_clients = conn.execute(
+                "SELECT COUNT(DISTINCT client_id) FROM invoices WHERE client_id IN (SELECT id FROM clients)"
+            ).fetchone()[0]
+            
+            # Count pending invoices
+            pending_invoices = conn.execute(
+                "SELECT COUNT(*) FROM documents WHERE review_status = 'pending'"
+            ).fetchone()[0]
+            
+            # Count flagged items
+            flagged_items = conn.execute(
+                "SELECT COUNT(*) FROM documents WHERE review_status = 'needs_review' OR review_status = 'needs_clarification'"
+            ).fetchone()[0]
         
         return {
             "active_clients": active_clients,
@@ -181,21 +180,18 @@ async def get_whatsapp_dashboard_summary(phone: str):
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        conn = get_db_connection()
-        
-        # Get financial summary
-        summary = conn.execute("""
-            SELECT 
-                COUNT(*) as invoice_count,
-                SUM(CAST(json_extract(json_data, '$.total_amount') AS REAL)) as total_revenue,
-                SUM(CAST(json_extract(json_data, '$.gst_amount') AS REAL)) as total_gst
-            FROM invoices
-        """).fetchone()
-        
-        # Get client count
-        client_count = conn.execute("SELECT COUNT(*) FROM clients").fetchone()[0]
-        
-        conn.close()
+        with get_pool().read() as conn:
+            # Get financial summary
+            summary = conn.execute("""
+                SELECT 
+                    COUNT(*) as invoice_count,
+                    SUM(CAST(json_extract(json_data, '$.total_amount') AS REAL)) as total_revenue,
+                    SUM(CAST(json_extract(json_data, '$.gst_amount') AS REAL)) as total_gst
+                FROM invoices
+            """).fetchone()
+            
+            # Get client count
+            client_count = conn.execute("SELECT COUNT(*) FROM clients").fetchone()[0]
         
         return {
             "invoice_count": summary[0] or 0,